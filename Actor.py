@@ -1,19 +1,26 @@
 from abc import ABC, abstractmethod
 import json
 import time
-from google import genai
 
-from Formatter import GemmaFormatter
+from Formatter import GemmaFormatter, PromptCache
 from LLM import GemmaLLM
+from Telemetry import Telemetry
 
 # The Actor class represents the actor module of an agent.
 # It is responsible for generating the agent's response given the current history of the negotiation.
+# The caller names the actor in the Telemetry: Telemetry.ACTOR for the agents, or e.g. Telemetry.EVALUATOR,
+# Telemetry.HI, Telemetry.DI for the actors used to evaluate the negotiation.
 class Actor():
-    def __init__(self, description, client):
+    def __init__(self, description, client, caller: str = Telemetry.ACTOR):
         self.__description = description
         self.client = client
+        self.caller = caller
         self._formatter = client.get_formatter()
         self._initPrompt = f"\n".join(self.getDescription()['rules'])
+        self._ruleMessage = self._formatter.ruleMessage(self._initPrompt)
+        self._promptCache = PromptCache(self._formatter, self.getRole())
+        self._contextPolicy = None
+        self._validator = None
     
    
 
@@ -21,24 +28,45 @@ class Actor():
     # and generates the agent's response using the LLM client.
     # Before generating the response, it formats the history and the rules using the formatter of the LLM client.
     # All the messages generated by the same role, are considered model messages, otherwise they are considered user messages.
+    # The formatted history is kept in a PromptCache, so at every turn only the new messages are formatted.
+    # With the "prefix" layout of the client (see LLM.set_layout) the rules come before the history.
+    # With a context policy only a part of the history is sent (see ContextPolicy).
     def ask(self, data, hint="") -> str:
-        newMessages = []
-        for message in data:
-            if self.getRole().lower() == message['role'].lower():
-                newMessages.append(
-                    self._formatter.modelMessage(message['text'])
-                )
-            else:
-                newMessages.append(
-                    self._formatter.userMessage(message['text'])
-                )
+        with Telemetry.caller(self.caller):
+            response = self.client.generate(self._buildPrompt(data, hint))
+        return response 
+
+    # Async version of ask.
+    async def aask(self, data, hint="") -> str:
+        with Telemetry.caller(self.caller):
+            return await self.client.agenerate(await self._abuildPrompt(data, hint))
+
+    # The validator, if given, gives the offers of the agent to the policy (see OfferDigest).
+    def set_context_policy(self, policy, validator=None):
+        self._contextPolicy = policy
+        self._validator = validator
+        return self
+
+    def _buildPrompt(self, data, hint="") -> list:
+        history = self._promptCache.format(data)
+        if self._contextPolicy is not None:
+            history = self._contextPolicy.select(data, history, self._formatter, self._validator)
+        return self._layout(history, hint)
 
-        newMessages.append(self._formatter.ruleMessage(self._initPrompt))
+    async def _abuildPrompt(self, data, hint="") -> list:
+        history = self._promptCache.format(data)
+        if self._contextPolicy is not None:
+            history = await self._contextPolicy.aselect(data, history, self._formatter, self._validator)
+        return self._layout(history, hint)
+
+    def _layout(self, history: list, hint: str) -> list:
+        if self.client.getLayout() == "prefix":
+            newMessages = [self._ruleMessage, *history]
+        else:
+            newMessages = history + [self._ruleMessage]
         if hint != "":
             newMessages.append(self._formatter.ruleMessage(f"{hint}"))
-        
-        response = self.client.generate(newMessages)
-        return response 
+        return newMessages
     
     def getRole(self) -> str:
         return self.__description['role']
@@ -60,6 +88,9 @@ class NullBuyerActor(Actor):
     def ask(self, data, hint="") -> str:
         return ""
 
+    async def aask(self, data, hint="") -> str:
+        return ""
+
     def getRole(self) -> str:
         return "Buyer"
     
@@ -2,44 +2,83 @@ import json
 from Actor import Actor
 from Validator import Validator
 from Utilities import Utilities
-from LLM import LLM, GemmaLLM, LLamaLLM
+from ConfigRegistry import ConfigRegistry
+from Telemetry import Telemetry
+from LLM import LLM, GemmaLLM, LLamaLLM, LLM_Evaluator
 
 # The Agent class represents an agent in the negotiation. 
 # It has an actor module and a validator module.
 # The actor module is responsible for generating the agent's response given the current history of the negotiation.
 # The validator module is responsible for evaluating the agent's response and providing feedback to the actor module.
 # It is also responsible for keeping track of whether the agent has reached an agreement or not, and for analyzing the negotiation session at the end.
+# The evaluator, if given, is the LLM of the HI evaluator (by default LLamaLLM), e.g. a MockLLM for an offline run.
 class Agent():
-    def __init__(self, actor: Actor, validator: Validator, isJSON: bool):
+    def __init__(self, actor: Actor, validator: Validator, isJSON: bool, evaluator: LLM = None):
         self.__actor = actor
         self.__validator = validator
         self.__agreement = False
         self.__isJSON = isJSON
-        with open("DealingProblem/Rules.json", 'r') as file:
-            rules = json.load(file)
+        self.__contextPolicy = None
+        rules = ConfigRegistry.rules()
         type = "JSON" if isJSON else "NA"
         self._HI_Evaluator = Actor(
-                    description=rules[f'HI_Evaluator_{actor.getDescription()["role"]}_{type}'], client=LLamaLLM)
+                    description=rules[f'HI_Evaluator_{actor.getDescription()["role"]}_{type}'],
+                    client=evaluator if evaluator is not None else LLamaLLM, caller=Telemetry.HI)
 
 
-    def respond(self, history) -> dict:
-        count = 0
-        format_error = 0
+    # With deferSideTasks the side evaluations of the message (see sideTasks) are not computed:
+    # the caller runs them, e.g. the Arena runs them concurrently with the next turn.
+    def respond(self, history, deferSideTasks: bool = False) -> dict:
         actorResponse = self.__actor.ask(history)
         formattedAnalysis = self.__validator.formatResponse(history, actorResponse)
         validatorResponse = self.__validator.evaluateFormattedMessage(formattedAnalysis)
-        
+
+        count, format_error, hint = self._checkValidation(validatorResponse)
+        if hint is not None:
+            actorResponse = self.__actor.ask(history, hint=hint)
+
+        return self._buildMessage(actorResponse, count, format_error)
+
+    # Async version of respond.
+    async def arespond(self, history, deferSideTasks: bool = False) -> dict:
+        actorResponse = await self.__actor.aask(history)
+        formattedAnalysis = await self.__validator.aformatResponse(history, actorResponse)
+        validatorResponse = self.__validator.evaluateFormattedMessage(formattedAnalysis)
+
+        count, format_error, hint = self._checkValidation(validatorResponse)
+        if hint is not None:
+            actorResponse = await self.__actor.aask(history, hint=hint)
+
+        return self._buildMessage(actorResponse, count, format_error)
+
+    # The side evaluations of a message of the agent, as field of the message -> function computing its value.
+    # They depend only on the message, not on the next turns. The base agent has none.
+    def sideTasks(self, message) -> dict:
+        return {}
+
+    # Async version of sideTasks: field -> coroutine function.
+    def asideTasks(self, message) -> dict:
+        return {}
+
+    # It reads the response of the validator and updates the agreement.
+    # It returns the retry count, the format error and the hint for the actor (None if the actor doesn't have to retry).
+    def _checkValidation(self, validatorResponse):
+        count = 0
+        format_error = 0
+        hint = None
         message = validatorResponse.get("MessageType", "")
 
         if message == "DEAL":
             self.__agreement = True
         elif message == "INVALID":
             count = 1
-            actorResponse = self.__actor.ask(history, hint=validatorResponse.get("Hint", ""))
+            hint = validatorResponse.get("Hint", "")
         elif message == "ERROR" or message == "":
             count = 1
             format_error = 1
+        return count, format_error, hint
 
+    def _buildMessage(self, actorResponse, count, format_error) -> dict:
         if self.__isJSON:
             try:
                 json.loads(actorResponse)
@@ -61,8 +100,42 @@ class Agent():
     def getDescription(self) -> str:
         return self.__actor.getDescription()
     
+    def getOfferTrajectory(self) -> list:
+        return self.__validator.getOfferTrajectory()
+
+    # The context policy of the agent, shared by its actor and its validator (see ContextPolicy).
+    # The policy reads the offers of the agent from the validator.
+    def set_context_policy(self, policy):
+        self.__contextPolicy = policy
+        self.__actor.set_context_policy(policy, self.__validator)
+        self.__validator.set_context_policy(policy)
+        return self
+
+    # The tokens saved by the context policy in the session, or None without a policy.
+    def getContextStats(self):
+        return self.__contextPolicy.getStats() if self.__contextPolicy is not None else None
+
     def reset(self):
         self.__agreement = False
+        self.__validator.resetTrajectory()
+        if self.__contextPolicy is not None:
+            self.__contextPolicy.reset()
+        return self
+
+    # The state of the agent, saved in the checkpoints of a sweep: the agreement, the state of the validator
+    # and the state of the context policy, if any.
+    # The actor doesn't need to be saved, its prompt is rebuilt from the history.
+    def getState(self) -> dict:
+        state = {"agreement": self.__agreement, "validator": self.__validator.getState()}
+        if self.__contextPolicy is not None:
+            state["context"] = self.__contextPolicy.getState()
+        return state
+
+    def setState(self, state: dict):
+        self.__agreement = state["agreement"]
+        self.__validator.setState(state["validator"])
+        if self.__contextPolicy is not None and "context" in state:
+            self.__contextPolicy.setState(state["context"])
         return self
     
     # It analyzes the negotiation session at the end of the negotiation
@@ -107,31 +180,34 @@ class Agent():
             [{'text': longestMSG}]
         )
         try:
-            HI_response = Utilities.extract_json(HI_response)
+            HI_response = Utilities.extract_json(HI_response, keys=('format_violation_score', 'role_integrity_score'))
             FV_score = float(HI_response['format_violation_score'])
             RI_score = float(HI_response['role_integrity_score'])
             HI_score = (FV_score + RI_score) / 2
-        except ValueError:
+        except (ValueError, KeyError):
             HI_score = float('nan')
         return HI_score
 
     # It creates an agent from a JSON file, from its name and specifying the underlying LLM. 
     # The JSON file must contain a list of agents with their description, rules, and role.
+    # The evaluator, if given, is the LLM of the validator and of the HI evaluator (by default LLM_Evaluator and LLamaLLM).
     @staticmethod
-    def fromJSON(path: str, agentType: str, name: str, client: LLM, isJSON: bool) -> 'Agent':   
-        with open(path, 'r') as f:
-            agents = json.load(f)[agentType]
-        validators = json.load(open("DealingProblem/Rules.json", 'r'))
+    def fromJSON(path: str, agentType: str, name: str, client: LLM, isJSON: bool, evaluator: LLM = None) -> 'Agent':   
+        agents = ConfigRegistry.scenario(path)[agentType]
+        validators = ConfigRegistry.rules()
         for agent in agents:
             if agent["name"] == name:
+                agent = ConfigRegistry.thaw(agent)
                 if isJSON:
                     JSONRole = 'Json' + agent['role']
                     agent["rules"] = [*agent['rules'], *validators[JSONRole]['rules']]
 
                 return Agent(
                         actor  = Actor(agent, client=client),
-                        validator = Validator(validators[agent["role"]]),
-                        isJSON = isJSON
+                        validator = Validator(validators[agent["role"]],
+                                              client=evaluator if evaluator is not None else LLM_Evaluator),
+                        isJSON = isJSON,
+                        evaluator = evaluator
                 )
         raise Exception(f"Agent with name {name} not found")
     
@@ -1,8 +1,11 @@
+import asyncio
+import contextvars
 import hashlib
 import json
 from math import ceil
 import re
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import OrderedDict
 
 from Actor import Actor
@@ -13,38 +16,218 @@ from LLM import GemmaLLM, LLM, LLM_Evaluator
 from pathlib import Path
 
 from Utilities import Utilities
+from SessionStore import SessionStore
+from ConfigRegistry import ConfigRegistry
+from TerminationPolicy import TerminationPolicy
+from Telemetry import Telemetry
 
 # The Arena class represents the environment in which the agents negotiate.
 # It keeps track of the history of the negotiation and the agents involved in it.
 # It is responsible for running the negotiation session, saving the history of the session, and evaluating the session at the end.
+# The LLM calls of the negotiation and of the evaluation are traced by the Telemetry under the session name (see getSessionName).
 class Arena:
     def __init__(self, agentList: list[Agent], context, sessionName: str, LLMClient : LLM = LLM_Evaluator):
         self.__savePath = sessionName
         self.__agents = agentList
         self.__history = [{"role": "seller", "text": context}]
         self.__LLMClient = LLMClient
+        self.__termination = {}
+        self.__checkpoint = None
+        self.__speculative = False
+        self.__sideExecutor = None
+        self.__sideTasks = []
 
 
+    # A round starts from the agent whose turn it is, so a negotiation restored from a checkpoint
+    # in the middle of a round goes on from its last turn.
     def _nextRound(self):
-        for i in range(len(self.__agents)):
-            mess = self.__agents[i].respond(self.__history)
+        if any(agent.getAgreement() for agent in self.__agents):
+            return
+        for i in range(self._nextAgent(), len(self.__agents)):
+            mess = self.__agents[i].respond(self.__history, deferSideTasks=self.__speculative)
             self.__history.append(mess)
+            self._scheduleSideTasks(self.__agents[i], mess)
+            self._collectSideTasks()
+            self._saveCheckpoint()
             if self.__agents[i].getAgreement():
                 return
 
 
-    def negotiate(self, maxRounds: int = 10):
-        for _ in range(maxRounds):
-            self._nextRound()
-            allAgreed = any(agent.getAgreement() for agent in self.__agents)
-            if allAgreed:
-                break
-        
-        
-        self.save_history(self.__savePath)
+    async def _anextRound(self):
+        if any(agent.getAgreement() for agent in self.__agents):
+            return
+        for i in range(self._nextAgent(), len(self.__agents)):
+            mess = await self.__agents[i].arespond(self.__history, deferSideTasks=self.__speculative)
+            self.__history.append(mess)
+            self._ascheduleSideTasks(self.__agents[i], mess)
+            self._collectSideTasks()
+            self._saveCheckpoint()
+            if self.__agents[i].getAgreement():
+                return
+
+    # With speculative execution the side evaluations of the messages (e.g. the DI score of a deceptive seller,
+    # see Agent.sideTasks) don't delay the negotiation: they run in the background, concurrently with the next turns.
+    # In the threaded version they run one at a time on a worker of the arena, since the evaluators are not thread safe.
+    # Their values are attached to the messages as they finish (at the end of the following turns),
+    # and all of them before the negotiation ends, so the saved sessions are the same.
+    def set_speculative(self, speculative: bool = True):
+        self.__speculative = speculative
+        return self
+
+    def _scheduleSideTasks(self, agent: Agent, message: dict):
+        for field, task in agent.sideTasks(message).items() if self.__speculative else []:
+            if field not in message:
+                if self.__sideExecutor is None:
+                    self.__sideExecutor = ThreadPoolExecutor(max_workers=1)
+                future = self.__sideExecutor.submit(contextvars.copy_context().run, task)
+                self.__sideTasks.append((message, field, future))
+
+    def _ascheduleSideTasks(self, agent: Agent, message: dict):
+        for field, task in agent.asideTasks(message).items() if self.__speculative else []:
+            if field not in message:
+                self.__sideTasks.append((message, field, asyncio.ensure_future(task())))
+
+    # It schedules the side tasks missing from a restored history (still running when the checkpoint was saved).
+    def _resumeSideTasks(self, schedule):
+        for message in self.__history[1:]:
+            for agent in self.__agents:
+                if agent.getDescription()['role'].lower() == message['role'].lower():
+                    schedule(agent, message)
+
+    # It attaches the values of the finished side tasks to their messages.
+    # The error of a failed side task is raised, as it would have been by a serial evaluation.
+    def _collectSideTasks(self):
+        pending = []
+        for message, field, future in self.__sideTasks:
+            if future.done():
+                message[field] = future.result()
+            else:
+                pending.append((message, field, future))
+        self.__sideTasks = pending
+
+    # It waits for all the side tasks and attaches their values.
+    def _drainSideTasks(self):
+        for message, field, future in self.__sideTasks:
+            message[field] = future.result()
+        self.__sideTasks = []
+        if self.__sideExecutor is not None:
+            self.__sideExecutor.shutdown()
+            self.__sideExecutor = None
+
+    async def _adrainSideTasks(self):
+        if self.__sideTasks:
+            await asyncio.wait([future for _, _, future in self.__sideTasks])
+        self._collectSideTasks()
+
+    def _nextAgent(self) -> int:
+        if len(self.__agents) == 0:
+            return 0
+        return (len(self.__history) - 1) % len(self.__agents)
+
+    # The number of rounds completed so far (the first message of the history is the context).
+    def completedRounds(self) -> int:
+        if len(self.__agents) == 0:
+            return 0
+        return (len(self.__history) - 1) // len(self.__agents)
+
+    # The checkpoint, if set, is called with the arena after every turn (see Tournament and SweepManifest).
+    def set_checkpoint(self, checkpoint):
+        self.__checkpoint = checkpoint
+        return self
+
+    def _saveCheckpoint(self):
+        if self.__checkpoint is not None:
+            self.__checkpoint(self)
+
+    # The state of the negotiation: the history, the state of the agents and the termination.
+    def getState(self) -> dict:
+        return {
+            "history": self.__history,
+            "agents": [agent.getState() for agent in self.__agents],
+            "termination": self.__termination,
+        }
+
+    # It restores a state saved by getState, in an arena with the same agents.
+    def restore(self, state: dict):
+        self.__history = list(state["history"])
+        for agent, agentState in zip(self.__agents, state["agents"]):
+            agent.setState(agentState)
+        self.__termination = state.get("termination", {})
+        return self
+
+    # It runs the negotiation for at most maxRounds rounds.
+    # If save is False the session is not written to disk, so the caller can collect it with build_session
+    # (e.g. the Tournament, that writes all the sessions through a single writer).
+    # If evaluate is False the session is saved without evaluation, to be evaluated later by the EvaluationPipeline.
+    # The terminationPolicy, if given, can stop a stuck negotiation before maxRounds (see TerminationPolicy).
+    # The reason of the end of the negotiation is saved in the "termination" field of the session.
+    # A restored negotiation (see restore) goes on from its last turn, or is only saved if it had already ended.
+    def negotiate(self, maxRounds: int = 10, save: bool = True, evaluate: bool = True,
+                  terminationPolicy: TerminationPolicy = None):
+        with Telemetry.session(self.getSessionName()):
+            self._resumeSideTasks(self._scheduleSideTasks)
+            for round in self._remainingRounds(maxRounds):
+                self._nextRound()
+                if self._checkTermination(round + 1, maxRounds, terminationPolicy):
+                    break
+            self._drainSideTasks()
+
+            if save:
+                self.save_history(self.__savePath, evaluate)
         return
 
 
+    # Async version of negotiate. The LLM calls of the negotiation and of the evaluation don't block the event loop,
+    # so many sessions can run in the same process (see Tournament.arun).
+    async def anegotiate(self, maxRounds: int = 10, save: bool = True, evaluate: bool = True,
+                         terminationPolicy: TerminationPolicy = None):
+        with Telemetry.session(self.getSessionName()):
+            self._resumeSideTasks(self._ascheduleSideTasks)
+            for round in self._remainingRounds(maxRounds):
+                await self._anextRound()
+                if self._checkTermination(round + 1, maxRounds, terminationPolicy):
+                    break
+            await self._adrainSideTasks()
+
+            if save:
+                Arena.write_session(self.__savePath, await self.abuild_session(evaluate))
+        return
+
+    # The rounds left to play. A negotiation restored after its end (e.g. from a checkpoint saved when a termination
+    # policy stopped it) has none.
+    def _remainingRounds(self, maxRounds: int) -> range:
+        if self.__termination:
+            print(f"Negotiation already ended: {self.__termination['reason']}")
+            return range(0)
+        return range(self.completedRounds(), maxRounds)
+
+    # It returns True if the negotiation has to stop after the given round, and records why.
+    # The termination is saved in the checkpoint, so a negotiation that has ended isn't played again on resume.
+    def _checkTermination(self, round: int, maxRounds: int, terminationPolicy: TerminationPolicy) -> bool:
+        if any(agent.getAgreement() for agent in self.__agents):
+            self._terminate("agreement", round)
+            return True
+        if terminationPolicy is not None:
+            reason = terminationPolicy.check(self.__history, self.__agents)
+            if reason is not None:
+                print(f"Negotiation stopped early: {reason}")
+                self._terminate(reason, round)
+                return True
+        if round >= maxRounds:
+            self._terminate("max-rounds", round)
+        return False
+
+    def _terminate(self, reason: str, round: int):
+        self.__termination = {"reason": reason, "round": round}
+        self._saveCheckpoint()
+
+    def getTermination(self) -> dict:
+        return self.__termination
+
+    # The name of the session in the Telemetry: the history file and the id of the session.
+    def getSessionName(self) -> str:
+        return f"{self.__savePath}#{self._generateHashcode()}"
+
     def set_fileName(self, name: str):
         self.__savePath = name
         return self
@@ -53,30 +236,50 @@ class Arena:
     # contextPath is the path to the actor context. It has to be a json file formatted in the correct way.
     @staticmethod
     def load_session(contextPath : str, client : LLM = LLM_Evaluator):
-        with open(contextPath, 'r') as context_file:
-            actorInits = json.load(context_file)
+        actorInits = ConfigRegistry.scenario(contextPath)
         
         return Arena([], actorInits['scenario'], contextPath, client)
     
-    def _load_savepath(self, path: str):
-        agents = []
-        file_path = Path(path)
-
-        file_path.parent.mkdir(parents=True, exist_ok=True)
-        if not file_path.exists():
-            file_path.parent.mkdir(parents=True, exist_ok=True)
-            with open(file_path, "w", encoding="utf-8") as f:
-                json.dump({}, f)
-
-        with open(file_path, "r+", encoding="utf-8") as f:
-            return json.load(f)
+    # It saves the session in the history file. The JSON file read by the notebooks is written by export_history
+    # (or by python SessionStore.py export), once after all the sessions.
+    def save_history(self, path: str, evaluate: bool = True):
+        Arena.write_session(path, self.build_session(evaluate))
+        return
+
+    # It builds the session entry of the history file: agents, history and evaluation of the negotiation.
+    # Without evaluation, the "evaluation" field is left empty.
+    def build_session(self, evaluate: bool = True) -> dict:
+        session = self._sessionEntry()
+        if not evaluate:
+            session["evaluation"] = {}
+            return session
+        try:
+            with Telemetry.session(self.getSessionName()):
+                eval = self.evaluateHistory(self.getHistory())
+        except Exception as e:
+            print(f"Error during evaluation: {e}")
+            eval = {}
         
-    def save_history(self, path: str):
-        raw = self._load_savepath(path)
+        session["evaluation"] = eval
+        return session
+
+    # Async version of build_session.
+    async def abuild_session(self, evaluate: bool = True) -> dict:
+        session = self._sessionEntry()
+        if not evaluate:
+            session["evaluation"] = {}
+            return session
+        try:
+            with Telemetry.session(self.getSessionName()):
+                eval = await self.aevaluateHistory(self.getHistory())
+        except Exception as e:
+            print(f"Error during evaluation: {e}")
+            eval = {}
 
-        JSON = OrderedDict()
-        JSON['scenario'] = raw.get('scenario', self.__history[0]['text'])
-        JSON['sessions'] = raw.get('sessions', [])
+        session["evaluation"] = eval
+        return session
+
+    def _sessionEntry(self) -> dict:
         agentDescriptions = []
 
         # Remove rules from agent descriptions before saving, to avoid redundancy
@@ -86,33 +289,32 @@ class Arena:
         
         session = {
                 "id" : self._generateHashcode(),
+                "scenario": self.__history[0]['text'],
                 "agents":  agentDescriptions,
-                "history": self.getHistory()[1:] # The first message of the history is the context, we can omit it.
+                "history": self.getHistory()[1:], # The first message of the history is the context, we can omit it.
+                "termination": self.__termination
             }
+        # The tokens saved by the context policies of the agents, by role (see ContextPolicy).
+        context = {
+            agent.getDescription()['role']: agent.getContextStats()
+            for agent in self.__agents if agent.getContextStats() is not None
+        }
+        if context:
+            session["context"] = context
+        return session
 
-        try:
-            eval = self.evaluateHistory(self.getHistory())
-        except Exception as e:
-            print(f"Error during evaluation: {e}")
-            eval = {}
-        
-        session["evaluation"] = eval
+    # It adds a session built by build_session to the history file in path, overwriting the session with the same id.
+    # The session is appended to the log of the file (see SessionStore): call export_history to update the JSON file.
+    @staticmethod
+    def write_session(path: str, session: dict):
+        SessionStore.open(path).put(session)
+        return
 
-        self._add_and_remove(JSON, session)
-        
-        with open(Path(self.__savePath), "w", encoding="utf-8") as f:
-            json.dump(JSON, f, indent=4, sort_keys=False)
+    # It writes the JSON file of path with all the sessions saved so far, in the format read by the notebooks.
+    @staticmethod
+    def export_history(path: str):
+        SessionStore.open(path).export()
         return
-    
-    def _add_and_remove(self, JSON: dict, element: dict):
-        for s in JSON['sessions']:
-            if s['id'] == element['id']:
-                print("Session already exists in history file. Overwriting.")
-                JSON['sessions'].remove(s)
-                break
-
-        JSON['sessions'].append(element)
-    
 
     def _generateHashcode(self) -> int:
         s = "".join(
@@ -131,12 +333,28 @@ class Arena:
         return self
     
     def evaluateHistory(self, history):
-        with open("DealingProblem/Rules.json", 'r') as f:
-            evaluatorDescription = json.load(f)['Evaluator']
-        evaluator = Actor(evaluatorDescription, self.__LLMClient)
-        evaluationResponse = evaluator.ask(history)
+        evaluationResponse = self._evaluator().ask(history)
+        return self._analyzeEvaluation(history, evaluationResponse)
+
+    # Async version of evaluateHistory.
+    async def aevaluateHistory(self, history):
+        evaluationResponse = await self._evaluator().aask(history)
+        return self._analyzeEvaluation(history, evaluationResponse)
+
+    # The prompt of the evaluation of the history, to send it with other requests (see BatchLLM).
+    # The response is analyzed by analyzeEvaluation.
+    def evaluationPrompt(self, history) -> list:
+        return self._evaluator()._buildPrompt(history)
+
+    def analyzeEvaluation(self, history, evaluationResponse) -> dict:
+        return self._analyzeEvaluation(history, evaluationResponse)
+
+    def _evaluator(self) -> Actor:
+        return Actor(ConfigRegistry.rules()['Evaluator'], self.__LLMClient, caller=Telemetry.EVALUATOR)
+
+    def _analyzeEvaluation(self, history, evaluationResponse) -> dict:
         try:
-            evaluationResponse = Utilities.extract_json(evaluationResponse)
+            evaluationResponse = Utilities.extract_json(evaluationResponse, keys=("Result", "final_price"))
         except json.JSONDecodeError:
             print("Failed to parse JSON from evaluator response: " + evaluationResponse)
             evaluationResponse = {"Result": "ERROR", "initial_price": "NaN", "initial_buyer_offer": "NaN", "Error": "JSONDecodeError"}
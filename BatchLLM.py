@@ -0,0 +1,368 @@
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from JSONExtractor import JSONExtractor
+from LLM import LLM, LLM_Evaluator
+from Telemetry import Telemetry
+
+_PACK_RULES = (
+    "You are given several independent tasks. Each task is a JSON list of chat messages, "
+    "with its own instructions in the system messages. Solve every task separately, following only its own "
+    "instructions, as if it was the only one. "
+    'Answer with one JSON object that maps the id of each task to its JSON answer, e.g. {"t0": {...}, "t1": {...}}, '
+    "and nothing else."
+)
+
+
+# The BatchLLM collects many independent requests (e.g. the evaluations of all the sessions of a history file)
+# and sends them together, for the latency tolerant workloads, where the per request rate limits bound the throughput:
+# - with a service (the Groq client, or a LocalBatchService), they are submitted as one batch job: a JSONL file of
+#   chat completions is uploaded, the job is polled until it ends and its output file is mapped back to the requests;
+# - without a service, they are sent through client.generate, on workers threads.
+# With pack > 1, pack requests are packed in a single multi-item request (see pack), so one request of the
+# rate limit answers many of them. The items missing from a packed answer are sent again one by one.
+# The max tokens of each request come from the output profile of its caller (see LLM.profile).
+# The responses are read from and stored in the response cache of the LLMs, with the keys of the single calls.
+# run returns the responses by request id; a failed request gets "" (so its extraction fails as an empty response).
+class BatchLLM():
+    def __init__(self, client: LLM = LLM_Evaluator, model: str = None, service=None,
+                 pack: int = 1, workers: int = 8, completionWindow: str = "24h", pollInterval: float = 30.0,
+                 timeout: float = None):
+        self.__client = client
+        self.__model = model if model is not None else client.getModel()
+        self.__service = service
+        self.__pack = max(1, pack)
+        self.__workers = workers
+        self.__completionWindow = completionWindow
+        self.__pollInterval = pollInterval
+        self.__timeout = timeout
+        self.__requests = {}
+        self.errors = {}
+
+    # It adds a request and returns its id.
+    def add(self, messages: list, caller: str = Telemetry.EVALUATOR) -> str:
+        with Telemetry.caller(caller):
+            profile = LLM.profile()
+        id = f"r{len(self.__requests)}"
+        self.__requests[id] = {"messages": messages, "profile": profile, "caller": caller}
+        return id
+
+    def __len__(self) -> int:
+        return len(self.__requests)
+
+    # It sends all the requests added so far and returns their responses by id.
+    def run(self) -> dict:
+        requests, self.__requests = self.__requests, {}
+        self.errors = {}
+        results = {}
+        pending = []
+        for id, request in requests.items():
+            cached = self._fromCache(request)
+            if cached is not None:
+                results[id] = cached
+            else:
+                pending.append(id)
+
+        units = self._units(requests, pending, self.__pack)
+        answered = self._answerUnits(requests, units, results)
+        missing = [id for id in pending if id not in answered]
+        if missing and self.__pack > 1:
+            answered |= self._answerUnits(requests, self._units(requests, missing, 1), results)
+
+        for id in pending:
+            if id in answered:
+                self._toCache(requests[id], results[id])
+            else:
+                results[id] = ""
+        return results
+
+    # The units sent to the provider: single requests (id, messages, maxTokens, [id])
+    # or packed ones (unit id, packed messages, sum of the max tokens, ids of the items).
+    def _units(self, requests: dict, ids: list, pack: int) -> list:
+        units = []
+        for start in range(0, len(ids), pack):
+            items = ids[start:start + pack]
+            if len(items) == 1:
+                request = requests[items[0]]
+                units.append((items[0], request["messages"], request["profile"]["maxTokens"], items))
+            else:
+                maxTokens = min(BatchLLM._packedProfile()["maxTokens"],
+                                sum(requests[id]["profile"]["maxTokens"] for id in items))
+                units.append((f"p{start}", BatchLLM.pack({id: requests[id]["messages"] for id in items}), maxTokens, items))
+        return units
+
+    # It sends the units and stores the responses of the answered requests in results. It returns their ids.
+    def _answerUnits(self, requests: dict, units: list, results: dict) -> set:
+        if not units:
+            return set()
+        if self.__service is not None:
+            responses = self._submit(units)
+        else:
+            responses = self._direct(requests, units)
+
+        answered = set()
+        for unitId, _, _, items in units:
+            response = responses.get(unitId)
+            if response is None:
+                continue
+            if len(items) == 1 and unitId == items[0]:
+                results[unitId] = response
+                answered.add(unitId)
+                continue
+            for id, answer in BatchLLM.unpackResponse(response, items).items():
+                results[id] = answer
+                answered.add(id)
+        return answered
+
+    # The units are sent through the client, with the caller of their request, or as the packed caller.
+    def _direct(self, requests: dict, units: list) -> dict:
+        def send(unit):
+            unitId, messages, _, items = unit
+            caller = requests[items[0]]["caller"] if len(items) == 1 else Telemetry.PACKED
+            try:
+                with Telemetry.caller(caller):
+                    return unitId, self.__client.generate(messages)
+            except Exception as e:
+                self.errors[unitId] = f"{type(e).__name__}: {e}"
+                return unitId, None
+
+        with ThreadPoolExecutor(max_workers=self.__workers) as executor:
+            return {unitId: response for unitId, response in executor.map(send, units) if response is not None}
+
+    # It submits the units as a batch job of chat completions and waits for its output.
+    # The errors of the service (and the malformed lines of its output) are recorded in errors, by unit id,
+    # and the units they affect get no response.
+    def _submit(self, units: list) -> dict:
+        lines = [json.dumps({
+            "custom_id": unitId,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": self.__model,
+                "messages": messages,
+                "temperature": 0,
+                "max_completion_tokens": maxTokens,
+                "top_p": 1,
+            },
+        }, ensure_ascii=False) for unitId, messages, maxTokens, _ in units]
+
+        service = self.__service
+        try:
+            inputFile = service.files.create(file=("batch.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+            job = service.batches.create(
+                completion_window=self.__completionWindow, endpoint="/v1/chat/completions", input_file_id=inputFile.id
+            )
+            start = time.monotonic()
+            while job.status not in ("completed", "failed", "expired", "cancelled"):
+                if self.__timeout is not None and time.monotonic() - start > self.__timeout:
+                    print(f"Batch job {job.id} timed out after {self.__timeout}s, it is cancelled")
+                    self._failUnits(units, f"the batch job timed out after {self.__timeout}s")
+                    service.batches.cancel(job.id)
+                    return {}
+                time.sleep(self.__pollInterval)
+                job = service.batches.retrieve(job.id)
+        except Exception as e:
+            print(f"Error during the batch job: {e}")
+            self._failUnits(units, f"{type(e).__name__}: {e}")
+            return {}
+
+        if job.status != "completed":
+            print(f"Batch job {job.id} ended with status {job.status}")
+        responses = {}
+        for fileId in (job.output_file_id, job.error_file_id):
+            if not fileId:
+                continue
+            try:
+                lines = service.files.content(fileId).read().decode("utf-8").splitlines()
+            except Exception as e:
+                print(f"Error while reading the file {fileId} of batch job {job.id}: {e}")
+                continue
+            for line in lines:
+                if not line.strip():
+                    continue
+                try:
+                    result = json.loads(line)
+                    response = result.get("response") or {}
+                    if response.get("status_code") == 200:
+                        responses[result["custom_id"]] = response["body"]["choices"][0]["message"]["content"] or ""
+                    else:
+                        self.errors[result["custom_id"]] = json.dumps(result.get("error") or response.get("body"))
+                except Exception as e:
+                    print(f"Skipped a malformed line of batch job {job.id}: {e}")
+        self._failUnits([unit for unit in units if unit[0] not in responses],
+                        f"no response in the output of batch job {job.id}")
+        return responses
+
+    # It records the error of the units that have no error yet.
+    def _failUnits(self, units: list, error: str):
+        for unitId, _, _, _ in units:
+            self.errors.setdefault(unitId, error)
+
+    @staticmethod
+    def _packedProfile() -> dict:
+        with Telemetry.caller(Telemetry.PACKED):
+            return LLM.profile()
+
+    def _fromCache(self, request: dict):
+        cache = LLM._cache
+        if cache is None:
+            return None
+        return cache.get(LLM._key(self.__model, request["messages"], request["profile"]))
+
+    def _toCache(self, request: dict, response: str):
+        cache = LLM._cache
+        if cache is not None and response != "":
+            cache.put(LLM._key(self.__model, request["messages"], request["profile"]), response)
+
+    # It packs many requests (id -> chat messages) in the messages of a single request.
+    @staticmethod
+    def pack(requests: dict) -> list:
+        tasks = "\n".join(f"Task {id}: {json.dumps(messages, ensure_ascii=False)}" for id, messages in requests.items())
+        return [{"role": "system", "content": _PACK_RULES}, {"role": "user", "content": tasks}]
+
+    # It returns the requests (id -> chat messages) of packed messages, or None if the messages are not packed.
+    @staticmethod
+    def unpack(messages: list):
+        if len(messages) != 2 or messages[0].get("content") != _PACK_RULES:
+            return None
+        requests = {}
+        for line in messages[1]["content"].splitlines():
+            id, _, task = line[len("Task "):].partition(": ")
+            requests[id] = json.loads(task)
+        return requests
+
+    # It maps the answer of a packed request back to its items: the JSON answer of each item, as a text.
+    @staticmethod
+    def unpackResponse(response: str, ids: list) -> dict:
+        answer = JSONExtractor.extract(response, keys=ids)
+        return {
+            id: answer[id] if isinstance(answer[id], str) else json.dumps(answer[id], ensure_ascii=False)
+            for id in ids if id in answer
+        }
+
+
+# A local stand-in of the batch API of Groq (files.create, batches.create/retrieve/cancel, files.content),
+# to test the batch jobs without network. The requests of a job are answered in a background thread by the
+# _create method of llm (e.g. MockLLM, or its default instance if it is a class), on workers threads,
+# after a queueDelay in seconds.
+class LocalBatchService():
+    def __init__(self, llm, workers: int = 8, queueDelay: float = 0.0):
+        self.__llm = llm.default() if isinstance(llm, type) else llm
+        self.__workers = workers
+        self.__queueDelay = queueDelay
+        self.__files = {}
+        self.__jobs = {}
+        self.__ids = itertools.count()
+        self.__lock = threading.Lock()
+        self.files = _LocalFiles(self)
+        self.batches = _LocalBatches(self)
+
+    def _newId(self, prefix: str) -> str:
+        return f"{prefix}_{next(self.__ids)}"
+
+    def _storeFile(self, content: bytes) -> str:
+        with self.__lock:
+            id = self._newId("file")
+            self.__files[id] = content
+        return id
+
+    def _file(self, id: str) -> bytes:
+        with self.__lock:
+            return self.__files[id]
+
+    def _createJob(self, inputFileId: str, completionWindow: str) -> "_LocalJob":
+        with self.__lock:
+            job = _LocalJob(self._newId("batch"), inputFileId, completionWindow)
+            self.__jobs[job.id] = job
+        threading.Thread(target=self._process, args=(job,), daemon=True).start()
+        return job.snapshot()
+
+    def _job(self, id: str) -> "_LocalJob":
+        with self.__lock:
+            return self.__jobs[id]
+
+    def _process(self, job: "_LocalJob"):
+        time.sleep(self.__queueDelay)
+        if job.status == "cancelling":
+            job.status = "cancelled"
+            return
+        job.status = "in_progress"
+        requests = [json.loads(line) for line in self._file(job.input_file_id).decode("utf-8").splitlines() if line]
+
+        def answer(request):
+            body = request["body"]
+            profile = {"maxTokens": body.get("max_completion_tokens", 512), "stopAtJSON": False}
+            try:
+                content = self.__llm._create(body["model"], body["messages"], profile)
+                return {"custom_id": request["custom_id"], "response": {"status_code": 200, "body": {
+                    "model": body["model"], "choices": [{"index": 0, "message": {"role": "assistant", "content": content}}]
+                }}, "error": None}
+            except Exception as e:
+                return {"custom_id": request["custom_id"], "response": None,
+                        "error": {"code": type(e).__name__, "message": str(e)}}
+
+        with ThreadPoolExecutor(max_workers=self.__workers) as executor:
+            results = list(executor.map(answer, requests))
+        outputs = [result for result in results if result["error"] is None]
+        errors = [result for result in results if result["error"] is not None]
+        job.output_file_id = self._storeFile("\n".join(map(json.dumps, outputs)).encode("utf-8")) if outputs else None
+        job.error_file_id = self._storeFile("\n".join(map(json.dumps, errors)).encode("utf-8")) if errors else None
+        job.request_counts = {"total": len(results), "completed": len(outputs), "failed": len(errors)}
+        job.status = "completed"
+
+
+class _LocalJob():
+    def __init__(self, id: str, inputFileId: str, completionWindow: str):
+        self.id = id
+        self.input_file_id = inputFileId
+        self.completion_window = completionWindow
+        self.status = "validating"
+        self.output_file_id = None
+        self.error_file_id = None
+        self.request_counts = {"total": 0, "completed": 0, "failed": 0}
+
+    def snapshot(self) -> "_LocalJob":
+        copy = _LocalJob(self.id, self.input_file_id, self.completion_window)
+        copy.__dict__.update(self.__dict__)
+        return copy
+
+
+class _LocalFile():
+    def __init__(self, id: str, content: bytes):
+        self.id = id
+        self.__content = content
+
+    def read(self) -> bytes:
+        return self.__content
+
+
+class _LocalFiles():
+    def __init__(self, service: LocalBatchService):
+        self.__service = service
+
+    def create(self, file, purpose: str = "batch") -> _LocalFile:
+        content = file[1] if isinstance(file, tuple) else file.read()
+        return _LocalFile(self.__service._storeFile(content), content)
+
+    def content(self, fileId: str) -> _LocalFile:
+        return _LocalFile(fileId, self.__service._file(fileId))
+
+
+class _LocalBatches():
+    def __init__(self, service: LocalBatchService):
+        self.__service = service
+
+    def create(self, completion_window: str, endpoint: str, input_file_id: str, **kwargs) -> _LocalJob:
+        return self.__service._createJob(input_file_id, completion_window)
+
+    def retrieve(self, id: str) -> _LocalJob:
+        return self.__service._job(id).snapshot()
+
+    def cancel(self, id: str) -> _LocalJob:
+        job = self.__service._job(id)
+        if job.status in ("validating", "in_progress"):
+            job.status = "cancelling"
+        return job.snapshot()
@@ -0,0 +1,62 @@
+import json
+import os
+import threading
+from types import MappingProxyType
+
+RULES_PATH = "DealingProblem/Rules.json"
+
+
+# The ConfigRegistry loads the JSON configuration files (the rules and the scenario files) once,
+# and gives back the same parsed content to every agent, validator and arena that needs it.
+# A file is parsed again only if its modification time changes.
+# The content is shared, so it is given as an immutable view (dicts become MappingProxyType and lists become tuples):
+# use thaw to get a mutable copy, e.g. to add rules to an agent description.
+class ConfigRegistry():
+    _entries = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def load(path: str):
+        mtime = os.stat(path).st_mtime_ns
+        entry = ConfigRegistry._entries.get(path)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+
+        with ConfigRegistry._lock:
+            entry = ConfigRegistry._entries.get(path)
+            if entry is not None and entry[0] == mtime:
+                return entry[1]
+            with open(path, 'r') as f:
+                content = ConfigRegistry._freeze(json.load(f))
+            ConfigRegistry._entries[path] = (mtime, content)
+            return content
+
+    @staticmethod
+    def rules():
+        return ConfigRegistry.load(RULES_PATH)
+
+    @staticmethod
+    def scenario(path: str):
+        return ConfigRegistry.load(path)
+
+    # It returns a mutable deep copy of an immutable view.
+    @staticmethod
+    def thaw(content):
+        if isinstance(content, MappingProxyType):
+            return {key: ConfigRegistry.thaw(value) for key, value in content.items()}
+        if isinstance(content, tuple):
+            return [ConfigRegistry.thaw(value) for value in content]
+        return content
+
+    @staticmethod
+    def clear():
+        with ConfigRegistry._lock:
+            ConfigRegistry._entries.clear()
+
+    @staticmethod
+    def _freeze(content):
+        if isinstance(content, dict):
+            return MappingProxyType({key: ConfigRegistry._freeze(value) for key, value in content.items()})
+        if isinstance(content, list):
+            return tuple(ConfigRegistry._freeze(value) for value in content)
+        return content
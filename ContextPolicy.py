@@ -0,0 +1,243 @@
+from abc import ABC, abstractmethod
+import json
+import math
+
+from LLM import LLM, LLM_Evaluator
+from Telemetry import Telemetry
+
+
+# Base class for context policies.
+# A context policy chooses the part of the negotiation history that an agent sends to the LLM at every turn,
+# in the prompts of its actor and of its validator (see Agent.set_context_policy).
+# Without a policy the whole history is sent: the prompts grow at every turn, and the prompt tokens of a session
+# grow quadratically with its rounds. With a policy the first message of the history (the scenario) is always sent,
+# followed by an optional note about the older messages (e.g. a digest of the offers) and by the recent messages.
+# The policy counts the tokens it saves, estimated as 4 characters per token of the formatted messages (see getStats):
+# the counters are saved in the "context" field of the sessions.
+# Unlike the termination policies, a context policy keeps a state (the counters and, for RollingSummary, the summary),
+# so every agent needs its own instance.
+class ContextPolicy(ABC):
+    def __init__(self):
+        self._stats = self._emptyStats()
+
+    # It returns (start, note): the messages of the history from start on are sent after the scenario,
+    # preceded by the note if it isn't None. The validator gives the offers of the agent (see OfferDigest).
+    @abstractmethod
+    def window(self, history, validator) -> tuple:
+        pass
+
+    # Async version of window.
+    async def awindow(self, history, validator) -> tuple:
+        return self.window(history, validator)
+
+    # It applies the policy to the formatted history (formatted[i] is the formatted history[i]).
+    def select(self, history, formatted: list, formatter, validator=None) -> list:
+        if len(history) <= 1:
+            return formatted
+        return self._apply(formatted, formatter, *self.window(history, validator))
+
+    # Async version of select.
+    async def aselect(self, history, formatted: list, formatter, validator=None) -> list:
+        if len(history) <= 1:
+            return formatted
+        return self._apply(formatted, formatter, *(await self.awindow(history, validator)))
+
+    def _apply(self, formatted: list, formatter, start: int, note) -> list:
+        start = max(1, min(start, len(formatted)))
+        selected = formatted[:1] + ([formatter.ruleMessage(note)] if note is not None else []) + formatted[start:]
+        sent = ContextPolicy.tokens(selected)
+        self._stats["calls"] += 1
+        self._stats["sentTokens"] += sent
+        self._stats["savedTokens"] += ContextPolicy.tokens(formatted) - sent
+        return selected
+
+    def getName(self) -> str:
+        return type(self).__name__
+
+    # The counters of the policy: the prompts built with it, the tokens of history sent in them
+    # and the tokens saved with respect to the whole history.
+    def getStats(self) -> dict:
+        return {"policy": self.getName(), **self._stats}
+
+    # The state of the policy, saved in the checkpoints of a sweep (see Agent.getState).
+    def getState(self) -> dict:
+        return {"stats": dict(self._stats)}
+
+    def setState(self, state: dict):
+        self._stats = {**self._emptyStats(), **state["stats"]}
+        return self
+
+    def reset(self):
+        self._stats = self._emptyStats()
+        return self
+
+    def _emptyStats(self) -> dict:
+        return {"calls": 0, "sentTokens": 0, "savedTokens": 0}
+
+    # The estimated number of tokens of formatted messages.
+    @staticmethod
+    def tokens(messages) -> int:
+        return -(-len(json.dumps(messages, ensure_ascii=False)) // 4)
+
+    @staticmethod
+    def _omitted(count: int) -> str:
+        return f"The {count} earlier messages of the negotiation are omitted."
+
+
+# The whole history, as without a policy. It only counts the tokens sent.
+class FullHistory(ContextPolicy):
+    def window(self, history, validator) -> tuple:
+        return 1, None
+
+
+# The last k messages of the history.
+class LastK(ContextPolicy):
+    def __init__(self, k: int = 4):
+        super().__init__()
+        if k < 1:
+            raise ValueError(f"Invalid window for LastK: {k}. It must be at least 1.")
+        self.__k = k
+
+    def window(self, history, validator) -> tuple:
+        start = max(1, len(history) - self.__k)
+        return start, ContextPolicy._omitted(start - 1) if start > 1 else None
+
+
+# The last k messages of the history, preceded by a digest of the offers of the negotiation:
+# the offer trajectory of the validator of the agent (the first offers and the last ones, at most `offers` entries,
+# so the digest doesn't grow with the rounds) and the best buyer and seller offers it has accepted
+# (see Validator.getState). Without a validator or without offers, it is the same as LastK.
+class OfferDigest(ContextPolicy):
+    def __init__(self, k: int = 2, offers: int = 6):
+        super().__init__()
+        if k < 1 or offers < 2:
+            raise ValueError(f"Invalid window for OfferDigest: k={k}, offers={offers}. They must be at least 1 and 2.")
+        self.__k = k
+        self.__offers = offers
+
+    def window(self, history, validator) -> tuple:
+        start = max(1, len(history) - self.__k)
+        if start == 1:
+            return start, None
+        digest = OfferDigest.digest(validator.getState(), self.__offers) if validator is not None else None
+        return start, ContextPolicy._omitted(start - 1) + (f" {digest}" if digest is not None else "")
+
+    # The digest of the offers of a validator state, or None if there are no offers.
+    @staticmethod
+    def digest(state: dict, limit: int = 6):
+        offers = [
+            f"buyer {OfferDigest._price(entry['buyer'])} / seller {OfferDigest._price(entry['seller'])}"
+            for entry in state["offerTrajectory"] if entry["type"] == "counter-offer"
+        ]
+        if len(offers) > limit:
+            offers = offers[:1] + ["..."] + offers[-(limit - 1):]
+        best = [
+            f"best {role} offer {OfferDigest._price(state[key])}"
+            for role, key in (("buyer", "actualBuyerOffer"), ("seller", "actualSellerOffer"))
+            if not math.isinf(state[key])
+        ]
+        if not offers and not best:
+            return None
+        text = "Offers so far: " + ("; ".join(offers) if offers else "none") + "."
+        return text + (" Accepted: " + ", ".join(best) + "." if best else "")
+
+    @staticmethod
+    def _price(value) -> str:
+        if value != value:
+            return "-"
+        return f"${int(value)}" if value == int(value) else f"${value}"
+
+
+# The last messages of the history, preceded by a summary of the older ones written by an LLM.
+# The summary is updated every `every` messages, with the messages that left the window of the last k
+# (and the previous summary), so the window grows from k to k + every - 1 messages between two updates.
+# The summary calls are traced by the Telemetry with the summary caller (Telemetry.SUMMARY), and their prompt tokens are counted
+# in the summaryTokens of the stats (the net saving is savedTokens - summaryTokens).
+class RollingSummary(ContextPolicy):
+    RULES = ("NEGOTIATION SUMMARY. You summarize a negotiation between a buyer and a seller for the agents taking part "
+             "in it. Write a short summary (at most 80 words) of the previous summary and of the new messages: "
+             "the offers made by each party in order, the concessions and the arguments that still matter. "
+             "Write only the summary.")
+
+    def __init__(self, client: LLM = LLM_Evaluator, k: int = 4, every: int = 4):
+        super().__init__()
+        if k < 1 or every < 1:
+            raise ValueError(f"Invalid window for RollingSummary: k={k}, every={every}. They must be at least 1.")
+        self.__client = client
+        self.__k = k
+        self.__every = every
+        self.__summary = RollingSummary._emptySummary()
+
+    def window(self, history, validator) -> tuple:
+        update = self._update(history)
+        if update is not None:
+            with Telemetry.caller(Telemetry.SUMMARY):
+                summary = self.__client.generate(update[0])
+            self._store(history, update[1], summary)
+        return self.__summary["upTo"], self.__summary["text"]
+
+    async def awindow(self, history, validator) -> tuple:
+        update = self._update(history)
+        if update is not None:
+            with Telemetry.caller(Telemetry.SUMMARY):
+                summary = await self.__client.agenerate(update[0])
+            self._store(history, update[1], summary)
+        return self.__summary["upTo"], self.__summary["text"]
+
+    # It returns the prompt of the summary update and the new end of the summary, or None if it isn't due.
+    # A summary of another history (e.g. of a previous session of the agent) is dropped.
+    def _update(self, history):
+        upTo = self.__summary["upTo"]
+        if upTo > len(history) or (upTo > 1 and history[upTo - 1]["text"] != self.__summary["last"]):
+            self.__summary = RollingSummary._emptySummary()
+            upTo = 1
+        if len(history) - upTo < self.__k + self.__every:
+            return None
+        end = len(history) - self.__k
+        formatter = self.__client.get_formatter()
+        previous = f"Previous summary: {self.__summary['text']}\n\n" if self.__summary["text"] is not None else ""
+        messages = "\n".join(message["text"] for message in history[upTo:end])
+        prompt = [
+            formatter.ruleMessage(RollingSummary.RULES), formatter.userMessage(f"{previous}New messages:\n{messages}")
+        ]
+        self._stats["summaryTokens"] += ContextPolicy.tokens(prompt)
+        return prompt, end
+
+    def _store(self, history, end: int, summary: str):
+        self.__summary = {
+            "upTo": end, "last": history[end - 1]["text"], "text": "Summary of the earlier messages: " + summary.strip()
+        }
+
+    def getState(self) -> dict:
+        return {**super().getState(), "summary": dict(self.__summary)}
+
+    def setState(self, state: dict):
+        super().setState(state)
+        self.__summary = dict(state.get("summary", RollingSummary._emptySummary()))
+        return self
+
+    def reset(self):
+        self.__summary = RollingSummary._emptySummary()
+        return super().reset()
+
+    def _emptyStats(self) -> dict:
+        return {**super()._emptyStats(), "summaryTokens": 0}
+
+    @staticmethod
+    def _emptySummary() -> dict:
+        return {"upTo": 1, "last": None, "text": None}
+
+
+# It builds a context policy from its name, with an optional window: "full", "last-k:4", "offer-digest:2"
+# or "rolling-summary:4". The rolling summaries are written by the client.
+def context_policy(spec: str, client: LLM = LLM_Evaluator) -> ContextPolicy:
+    name, _, k = spec.partition(":")
+    if name == "full":
+        return FullHistory()
+    if name == "last-k":
+        return LastK(int(k)) if k else LastK()
+    if name == "offer-digest":
+        return OfferDigest(int(k)) if k else OfferDigest()
+    if name == "rolling-summary":
+        return RollingSummary(client, int(k)) if k else RollingSummary(client)
+    raise ValueError(f"Invalid context policy: {spec}. It must be full, last-k, offer-digest or rolling-summary.")
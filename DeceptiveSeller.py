@@ -2,35 +2,64 @@ import json
 from Actor import Actor
 from Validator import Validator
 from Agent import Agent
-from LLM import GemmaLLM, LLM_Evaluator, LLamaLLM
+from LLM import LLM, GemmaLLM, LLM_Evaluator, LLamaLLM
+from ConfigRegistry import ConfigRegistry
+from Telemetry import Telemetry
 
 # It is a specialization of the agent class.
 # It represents a deceptive seller, for the third benchmark, which has some hidden information that the buyer does not know.
 # It computes a deception index (DI) score for each message and at the end it computes the max and average DI score for the whole negotiation session.
+# The evaluator, if given, is the LLM of the DI evaluator (by default LLM_Evaluator) and of the HI evaluator (see Agent).
 class DeceptiveSeller(Agent):
-    def __init__(self, actor: Actor, validator: Validator, hidden_info: str, isJSON):
+    def __init__(self, actor: Actor, validator: Validator, hidden_info: str, isJSON, evaluator: LLM = None):
         self.__hidden_info = hidden_info
-        super().__init__(actor, validator, isJSON)
-        with open("DealingProblem/Rules.json", 'r') as file:
-            rules = json.load(file)
+        super().__init__(actor, validator, isJSON, evaluator)
+        rules = ConfigRegistry.rules()
         self._DI_Evaluator = Actor(
-            description=rules['DI_Evaluator'], client=LLM_Evaluator)
+            description=rules['DI_Evaluator'], client=evaluator if evaluator is not None else LLM_Evaluator, caller=Telemetry.DI)
     
-    def respond(self, history) -> dict:
+    # The DI score is a side task of the message: with deferSideTasks it is left to the caller (see Arena).
+    def respond(self, history, deferSideTasks: bool = False) -> dict:
         original_response = super().respond(history)
-        DI_score = self._DI_Evaluator.ask(
-            [{
+        if deferSideTasks:
+            return original_response
+        original_response['DI_score'] = self.sideTasks(original_response)['DI_score']()
+        return original_response
+
+    # Async version of respond.
+    async def arespond(self, history, deferSideTasks: bool = False) -> dict:
+        original_response = await super().arespond(history)
+        if deferSideTasks:
+            return original_response
+        original_response['DI_score'] = await self.asideTasks(original_response)['DI_score']()
+        return original_response
+
+    # The DI score depends only on the text of the message and on the hidden information.
+    # The prompt is built at once, so the task doesn't read the message while the negotiation goes on.
+    def sideTasks(self, message) -> dict:
+        prompt = self._DIPrompt(message)
+        return {"DI_score": lambda: self._parseDIScore(self._DI_Evaluator.ask(prompt))}
+
+    def asideTasks(self, message) -> dict:
+        prompt = self._DIPrompt(message)
+
+        async def DI_score():
+            return self._parseDIScore(await self._DI_Evaluator.aask(prompt))
+        return {"DI_score": DI_score}
+
+    def _DIPrompt(self, response) -> list:
+        return [{
                 "role" : "",
-                "text" : "Sentence 1:" + original_response['text'] + "\n" + 
+                "text" : "Sentence 1:" + response['text'] + "\n" + 
                          "Sentence 2:" + self.__hidden_info
             }]
-        )
+
+    def _parseDIScore(self, DI_score):
         try:
             DI_score = json.loads(DI_score)
         except json.JSONDecodeError:
             DI_score = {'score' : float('nan'), 'reason' : 'Invalid JSON'}
-        original_response['DI_score'] = DI_score['score']
-        return original_response
+        return DI_score['score']
     
 
     def analyzeSession(self, history, additionalInfo = {}):
@@ -43,23 +72,26 @@ class DeceptiveSeller(Agent):
         return analysis
     
     @staticmethod
-    def fromJSON_DeceptiveSeller(path: str, agentType: str, name: str, client, additionalInstructions: str = "", isJSON = False):
-        with open(path, 'r') as f:
-            json_data = json.load(f)
-            agents = json_data[agentType]
-            hidden_info = json_data['hidden_info']
+    def fromJSON_DeceptiveSeller(path: str, agentType: str, name: str, client, additionalInstructions: str = "", isJSON = False,
+                                 evaluator: LLM = None):
+        json_data = ConfigRegistry.scenario(path)
+        agents = json_data[agentType]
+        hidden_info = json_data['hidden_info']
 
-        validators = json.load(open("DealingProblem/Rules.json", 'r'))
+        validators = ConfigRegistry.rules()
         for agent in agents:
             if agent["name"] == name:
+                agent = ConfigRegistry.thaw(agent)
                 agent['rules'].append(additionalInstructions)
                 if isJSON:
                     JSONRole = 'Json' + agent['role']
                     agent["rules"] = [*agent['rules'], *validators[JSONRole]['rules']]
                 return DeceptiveSeller(
                         actor  = Actor(agent, client),
-                        validator = Validator(validators[agent["role"]]),
+                        validator = Validator(validators[agent["role"]],
+                                              client=evaluator if evaluator is not None else LLM_Evaluator),
                         hidden_info = hidden_info,
-                        isJSON = isJSON
+                        isJSON = isJSON,
+                        evaluator = evaluator
                 )
         raise Exception(f"Agent with name {name} not found")
@@ -0,0 +1,176 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from Arena import Arena
+from Agent import Agent
+from BatchLLM import BatchLLM, LocalBatchService
+from DeceptiveSeller import DeceptiveSeller
+from LLM import LLM, LLM_Evaluator
+from ConfigRegistry import ConfigRegistry
+from SessionStore import SessionStore
+from Utilities import Utilities
+from Telemetry import Telemetry
+
+
+# The EvaluationPipeline evaluates stored sessions, separately from the negotiations
+# (see the evaluate flag of Arena.negotiate and Tournament).
+# It reads a history file, finds the sessions that have no evaluation or whose evaluation failed (result "ERROR"),
+# and evaluates them in parallel, batchSize sessions at a time, with the same evaluation of Arena.evaluateHistory.
+# The evaluated sessions of each batch are saved in the history file, then the JSON file is exported.
+# With force=True every session is evaluated again, e.g. to re-score the existing Sessions_* files.
+# The agents of a session are rebuilt from the scenario file, isJSON defaults to the mode in the file name (_JSA).
+# The client is the LLM of the evaluation and of the HI and DI evaluators of the agents.
+# With a BatchLLM (batch), the evaluator requests of each batch of sessions are sent together by it
+# (as a batch job of the provider and/or packed in multi-item requests) instead of one call per session.
+class EvaluationPipeline():
+    def __init__(self, scenarioPath: str, sessionPath: str, isJSON: bool = None, client: LLM = LLM_Evaluator,
+                 maxWorkers: int = 8, batchSize: int = 32, deceptive: bool = None, force: bool = False,
+                 batch: BatchLLM = None):
+        self.__scenarioPath = scenarioPath
+        self.__sessionPath = sessionPath
+        self.__isJSON = "_JSA" in sessionPath if isJSON is None else isJSON
+        self.__client = client
+        self.__maxWorkers = maxWorkers
+        self.__batchSize = batchSize
+        self.__force = force
+        self.__batch = batch
+
+        self.__scenario = ConfigRegistry.scenario(scenarioPath)
+        self.__deceptive = 'hidden_info' in self.__scenario if deceptive is None else deceptive
+
+    @staticmethod
+    def needsEvaluation(session: dict) -> bool:
+        evaluation = session.get('evaluation') or {}
+        return evaluation.get('result', 'ERROR') == 'ERROR'
+
+    # It returns the sessions of the history file that have to be evaluated.
+    def pending(self) -> list:
+        sessions = SessionStore.open(self.__sessionPath).sessions()
+        if self.__force:
+            return sessions
+        return [session for session in sessions if EvaluationPipeline.needsEvaluation(session)]
+
+    def _buildAgent(self, description: dict) -> Agent:
+        if self.__deceptive and description['role'] == "Seller":
+            return DeceptiveSeller.fromJSON_DeceptiveSeller(
+                path=self.__scenarioPath,
+                agentType="sellers",
+                name=description['name'],
+                isJSON=self.__isJSON,
+                client=self.__client,
+                evaluator=self.__client
+            )
+        return Agent.fromJSON(
+            path=self.__scenarioPath,
+            agentType=description['role'].lower() + "s",
+            name=description['name'],
+            isJSON=self.__isJSON,
+            client=self.__client,
+            evaluator=self.__client
+        )
+
+    # The arena of a stored session, and its history with the context message.
+    def _arena(self, session: dict) -> tuple:
+        agents = [self._buildAgent(description) for description in session['agents']]
+        arena = Arena(agents, self.__scenario['scenario'], self.__sessionPath, self.__client)
+        return arena, [arena.getHistory()[0], *session['history']]
+
+    # It evaluates a single session and returns it with the new evaluation.
+    # A session that can't be evaluated, e.g. whose agents are not in the scenario file, gets an empty evaluation
+    # and is counted as failed.
+    def evaluate(self, session: dict) -> dict:
+        try:
+            arena, history = self._arena(session)
+            with Telemetry.session(arena.getSessionName()):
+                evaluation = arena.evaluateHistory(history)
+        except Exception as e:
+            print(f"Error during evaluation of session {session['id']}: {e}")
+            evaluation = {}
+        return {**session, "evaluation": evaluation}
+
+    # It evaluates the sessions with a single batch of evaluator requests and returns them with the new evaluations.
+    # As in evaluate, a session that can't be evaluated (or whose batch can't be run) gets an empty evaluation.
+    def evaluateBatch(self, sessions: list) -> list:
+        requests = []
+        for session in sessions:
+            try:
+                arena, history = self._arena(session)
+                requests.append((session, arena, history, self.__batch.add(arena.evaluationPrompt(history))))
+            except Exception as e:
+                print(f"Error during evaluation of session {session['id']}: {e}")
+                requests.append((session, None, None, None))
+        try:
+            responses = self.__batch.run()
+        except Exception as e:
+            print(f"Error during the batch evaluation: {e}")
+            responses = {}
+
+        evaluated = []
+        for session, arena, history, id in requests:
+            if arena is None:
+                evaluated.append({**session, "evaluation": {}})
+                continue
+            try:
+                evaluation = arena.analyzeEvaluation(history, responses.get(id, ""))
+            except Exception as e:
+                print(f"Error during evaluation of session {session['id']}: {e}")
+                evaluation = {}
+            evaluated.append({**session, "evaluation": evaluation})
+        return evaluated
+
+    # It evaluates all the pending sessions and returns how many have been evaluated and how many failed.
+    def run(self) -> dict:
+        store = SessionStore.open(self.__sessionPath)
+        pending = self.pending()
+        evaluated = 0
+        failed = 0
+
+        with ThreadPoolExecutor(max_workers=self.__maxWorkers) as executor:
+            for start in range(0, len(pending), self.__batchSize):
+                batch = pending[start:start + self.__batchSize]
+                # The messages of the whole batch are tokenized at once, for the analysis of the sessions
+                Utilities.token_counts([message['text'] for session in batch for message in session['history']])
+                if self.__batch is not None:
+                    results = self.evaluateBatch(batch)
+                else:
+                    results = executor.map(self.evaluate, batch)
+                for session in results:
+                    store.put(session)
+                    if EvaluationPipeline.needsEvaluation(session):
+                        failed += 1
+                    else:
+                        evaluated += 1
+                print("EVALUATED : " + str(start + len(batch)) + "/" + str(len(pending)))
+
+        store.export()
+        return {"evaluated": evaluated, "failed": failed}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the stored sessions of history files.")
+    parser.add_argument("scenario", help="scenario file of the sessions, e.g. DealingProblem/Context/Scenario1.json")
+    parser.add_argument("sessions", nargs="+", help="history files to evaluate")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--force", action="store_true", help="evaluate again all the sessions")
+    parser.add_argument("--batch", choices=["groq", "local"],
+                        help="send the evaluations of each batch as a batch job of Groq, or of a local stand-in (MockLLM)")
+    parser.add_argument("--pack", type=int, default=1, help="evaluations packed in a single request")
+    args = parser.parse_args()
+
+    client = LLM_Evaluator
+    batch = None
+    if args.batch == "local":
+        from MockLLM import MockLLM
+        client = MockLLM
+        batch = BatchLLM(MockLLM, service=LocalBatchService(MockLLM), pack=args.pack, pollInterval=0.1)
+    elif args.batch == "groq":
+        batch = BatchLLM(service=LLM_Evaluator.default()._get_client(), pack=args.pack)
+    elif args.pack > 1:
+        batch = BatchLLM(pack=args.pack, workers=args.workers)
+
+    for path in args.sessions:
+        print(path, EvaluationPipeline(
+            args.scenario, path, client=client, maxWorkers=args.workers, batchSize=args.batch_size,
+            force=args.force, batch=batch
+        ).run())
@@ -61,4 +61,35 @@ class LLamaFormatter(Formatter):
     
     def userMessage(self, message) -> dict:
         return self.messageToPrompt(message, type='user')
-    
\ No newline at end of file
+    
+
+# The PromptCache keeps the formatted messages of a negotiation history, so that at every turn
+# only the new messages of the history are formatted, instead of the whole history.
+# The messages written by role are formatted as model messages, the others as user messages
+# (if role is None, all the messages are user messages).
+# The cache is valid as long as it receives the same history list, extended at the end (as the Arena does):
+# with another list (e.g. the history of a new session) it starts again from scratch.
+# The returned list is shared with the cache, so it must not be modified.
+class PromptCache():
+    def __init__(self, formatter: Formatter, role: str = None):
+        self.__formatter = formatter
+        self.__role = role.lower() if role is not None else None
+        self.__source = None
+        self.__last = None
+        self.__messages = []
+
+    def format(self, history) -> list:
+        count = len(self.__messages)
+        if history is not self.__source or len(history) < count or (count > 0 and history[count - 1] is not self.__last):
+            self.__source = history
+            self.__messages = []
+            count = 0
+
+        for message in history[count:]:
+            if self.__role is not None and self.__role == message['role'].lower():
+                self.__messages.append(self.__formatter.modelMessage(message['text']))
+            else:
+                self.__messages.append(self.__formatter.userMessage(message['text']))
+
+        self.__last = history[-1] if len(history) > 0 else None
+        return self.__messages
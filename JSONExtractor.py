@@ -0,0 +1,167 @@
+import json
+import re
+
+_FENCE = re.compile(r"```[ \t]*(?:json)?[ \t]*\n?(.*?)```", re.DOTALL | re.IGNORECASE)
+_STRUCTURE = re.compile(r'[{}"]')
+_STRING_END = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_DECODER = json.JSONDecoder()
+
+
+# The JSONExtractor finds the JSON objects in the text of an LLM response, in a single pass.
+# It balances the braces, ignoring the ones inside JSON strings (the quotes are tracked only inside an object,
+# so the apostrophes and quotes of the text around the objects don't matter).
+# At every top level brace, the JSON decoder is tried first: a valid object is read at once, without scanning it.
+# Otherwise the object is parsed as soon as it is closed and, if it isn't valid JSON,
+# the objects nested in it are tried instead (e.g. "{note: {"a": 1}}" gives {"a": 1}).
+# With first=True the scan stops at the first object.
+# The text can be fed in chunks (feed), e.g. while a response is streamed: complete() tells when an object has
+# been found, so the generation can be stopped there. close() ends the text: the objects closed inside a brace
+# that is never closed (e.g. a brace in the text before the answer) are taken as if the brace wasn't there.
+# result returns the first object found or, given the expected keys, the object with most of them.
+# When no object can be extracted, it returns a failure: {"Result": "ERROR", "Error": <message>, "Reason": <reason>}
+# where the reason is "empty" (no text), "no-object" (no braces), "truncated" (an object is never closed,
+# e.g. the response hit the token limit) or "invalid-json" (no complete object is valid JSON).
+# The scan is linear, also with braces that are never closed: the text is never scanned again.
+class JSONExtractor():
+    def __init__(self, first: bool = False):
+        self.__first = first
+        self.__text = ""
+        self.__position = 0
+        self.__stack = []
+        self.__spans = []
+        self.__inString = False
+        self.__objects = []
+        self.__firstError = None
+
+    # It scans a new chunk of text and returns the objects completed by it.
+    # Only the braces and the quotes are visited: the regexes skip the rest of the text and the strings.
+    def feed(self, chunk: str) -> list:
+        self.__text += chunk
+        found = len(self.__objects)
+        text = self.__text
+        position = self.__position
+        while not (self.__first and self.__objects):
+            if self.__inString:
+                end = _STRING_END.match(text, position)
+                if end is None:
+                    break
+                position = end.end()
+                self.__inString = False
+                continue
+            match = _STRUCTURE.search(text, position)
+            if match is None:
+                position = len(text)
+                break
+            char, position = match.group(), match.end()
+            if char == '"':
+                self.__inString = len(self.__stack) > 0
+            elif char == "{":
+                if not self.__stack:
+                    try:
+                        obj, end = _DECODER.raw_decode(text, match.start())
+                        self.__objects.append(obj)
+                        position = end
+                        continue
+                    except json.JSONDecodeError:
+                        pass
+                self.__stack.append(match.start())
+            elif self.__stack:
+                start = self.__stack.pop()
+                self.__spans.append((start, position))
+                if not self.__stack:
+                    self._parse(self.__spans)
+                    self.__spans = []
+        self.__position = position
+        return self.__objects[found:]
+
+    # True if at least one object has been found.
+    def complete(self) -> bool:
+        return len(self.__objects) > 0
+
+    def objects(self) -> list:
+        return list(self.__objects)
+
+    # The text fed so far.
+    def text(self) -> str:
+        return self.__text
+
+    # The position of the first brace that hasn't been closed, or None.
+    def unclosed(self):
+        return self.__stack[0] if self.__stack else None
+
+    # It ends the text and returns the objects found in the braces closed inside the ones still open.
+    # They have been balanced by the scan, so they are parsed without scanning the text again.
+    def close(self) -> list:
+        found = len(self.__objects)
+        if self.__stack and self.__spans and not (self.__first and self.__objects):
+            self._parse(self.__spans)
+            self.__spans = []
+        return self.__objects[found:]
+
+    # The first object or, if keys are given, the first of the objects with most of the keys.
+    def result(self, keys=None) -> dict:
+        if self.__objects:
+            if not keys:
+                return self.__objects[0]
+            return max(self.__objects, key=lambda obj: sum(1 for key in keys if key in obj))
+        return self.failure()
+
+    def failure(self) -> dict:
+        if self.__text.strip() == "":
+            return JSONExtractor._failure("empty", "The response is empty.")
+        if self.__stack:
+            return JSONExtractor._failure(
+                "truncated", f"The JSON object starting at {self.__stack[0]} is never closed."
+            )
+        if self.__firstError is not None:
+            return JSONExtractor._failure("invalid-json", self.__firstError)
+        return JSONExtractor._failure("no-object", "No JSON object found in the response.")
+
+    @staticmethod
+    def _failure(reason: str, message: str) -> dict:
+        return {"Result": "ERROR", "Error": message, "Reason": reason}
+
+    # It parses a closed top level object. The spans are the objects closed inside it (inner ones first),
+    # and are tried from the outermost when the enclosing object is not valid JSON.
+    # The spans are decoded in place, so the text is not copied for every nested object.
+    def _parse(self, spans: list):
+        end = 0
+        for start, stop in sorted(spans):
+            if start < end:
+                continue
+            try:
+                obj, objEnd = _DECODER.raw_decode(self.__text, start)
+                if objEnd != stop:
+                    raise json.JSONDecodeError("Extra data", self.__text, objEnd)
+            except json.JSONDecodeError as e:
+                if self.__firstError is None:
+                    self.__firstError = f"Invalid JSON object at {start}: {e}"
+                continue
+            if isinstance(obj, dict):
+                self.__objects.append(obj)
+                end = stop
+
+    # It extracts a JSON object from a complete text. The fenced code blocks (```json ... ```) are searched first,
+    # since they are the answer when the model also writes some text around it.
+    @staticmethod
+    def extract(text, keys=None) -> dict:
+        if not isinstance(text, str):
+            return JSONExtractor._failure("empty", f"The response is not a text: {text!r}")
+        stripped = text.strip()
+        if stripped.startswith("{") and stripped.endswith("}"):
+            try:
+                obj = json.loads(stripped)
+                if isinstance(obj, dict):
+                    return obj
+            except json.JSONDecodeError:
+                pass
+        for block in (_FENCE.findall(text) if "```" in text else []):
+            extractor = JSONExtractor(first=not keys)
+            extractor.feed(block)
+            extractor.close()
+            if extractor.complete():
+                return extractor.result(keys)
+        extractor = JSONExtractor(first=not keys)
+        extractor.feed(text)
+        extractor.close()
+        return extractor.result(keys)
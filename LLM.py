@@ -1,130 +1,436 @@
 
 from abc import ABC, abstractmethod
-from google import genai
-from google.genai import types
+import asyncio
+import functools
+import inspect
 import json
-from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception_type
-from groq import Groq
+import threading
+from tenacity import retry, wait_random_exponential, stop_after_attempt, retry_if_exception_type
 
 from Formatter import Formatter, GemmaFormatter, LLamaFormatter
+from JSONExtractor import JSONExtractor
+from ResponseCache import ResponseCache
+from RateLimiter import RateLimiter
+from Telemetry import Telemetry
+
+# Retry policy of the remote calls. The waits are randomized, so that the calls that failed together
+# (e.g. on a quota error) don't retry all at the same time.
+_retry = retry(
+    wait=wait_random_exponential(multiplier=1, min=4, max=120),
+    stop=stop_after_attempt(7),
+    retry=retry_if_exception_type(Exception)
+)
+
+
+# A method that can be called on an LLM class or on one of its instances. Called on the class,
+# it runs on the default instance of the class (see LLM.default), so the classes can still be used as clients
+# (e.g. GemmaLLM.generate(messages) or GemmaLLM.set_model(name)).
+class hybridmethod():
+    def __init__(self, function):
+        self.__function = function
+        functools.update_wrapper(self, function)
+
+    def __get__(self, instance, owner):
+        target = instance if instance is not None else owner.default()
+        return self.__function.__get__(target, type(target))
+
+
+# The SDK clients of the providers, shared by all the LLMs of a provider with the same API key.
+# The clients are thread safe and keep a pool of HTTP connections, so all the instances
+# (e.g. one per model, in a parallel sweep) reuse the same connections.
+class ClientPool():
+    _clients = {}
+    _lock = threading.Lock()
+
+    # It returns the client of the provider for the key, creating it with create(apiKey) the first time.
+    @staticmethod
+    def get(provider: str, apiKey: str, create):
+        with ClientPool._lock:
+            key = (provider, apiKey)
+            if key not in ClientPool._clients:
+                ClientPool._clients[key] = create(apiKey)
+            return ClientPool._clients[key]
+
+    @staticmethod
+    def clear():
+        with ClientPool._lock:
+            ClientPool._clients = {}
+
 
 # Base class for LLMs
 # A LLM is an entity that can generate text given a list of messages.
 # Since the messages has to be formatted in a specific way for each LLM, 
 # the LLM class also has a method to get the appropriate formatter for the LLM.
-# Since LLMs can come from a family of models, the LLM class also has a method to set the 
-# model to be used for generation.
+# An LLM is an instance with its own model (e.g. GemmaLLM("gemma-3-4b-it")), so many models of the same provider
+# can be used at the same time; their SDK clients come from the ClientPool.
+# Every class also has a default instance with the default model of the class, on which the methods called
+# on the class run (see hybridmethod): set_model on the class changes the model of the default instance.
+# The agenerate method is the asyncio counterpart of generate. By default it runs the call in a worker thread,
+# the LLMs with a native async client override _acreate.
+# The prompt layout (see set_layout) tells the actors and the validators where to put the rules: after the history
+# ("suffix", as the agents have always been prompted) or before it ("prefix"). With the prefix layout the static
+# rules and the scenario (the first message of the history) are a prefix shared by all the calls of an agent,
+# that the providers with prompt caching can reuse.
+# The responses can be cached, for all the LLMs, with set_cache (see ResponseCache).
+# The SDKs of the providers are imported only when a client is created, so importing this module
+# doesn't load the providers that are not used.
+# The remote calls are paced by the RateLimiter of their model, if one has been set with RateLimiter.set_limit.
+# Every generate call is traced by the Telemetry (caller, model, sizes, latency, attempts, cache hit).
+# The output of a call depends on the output profile of its caller (see Telemetry.caller): the maximum number of
+# output tokens and whether the response is streamed and stopped as soon as it contains a complete JSON object.
+# The validator and the evaluators answer with one small JSON object, and the models often keep writing after it,
+# so by default their responses are short and stopped at the object. The actors use the default profile.
+# The packed requests of the BatchLLM (many requests answered by one JSON object) are the packed caller.
+# The profiles are keyed by the callers of the Telemetry (Telemetry.VALIDATOR, ...).
 class LLM(ABC):
-    @staticmethod
+    _defaultModel = None
+    _defaultLayout = "suffix"
+    LAYOUTS = ("suffix", "prefix")
+    _defaults = {}
+    _defaultsLock = threading.Lock()
+    _cache = None
+    _defaultProfile = {"maxTokens": 512, "stopAtJSON": False}
+    _profiles = {
+        Telemetry.VALIDATOR: {"maxTokens": 128, "stopAtJSON": True},
+        Telemetry.EVALUATOR: {"maxTokens": 256, "stopAtJSON": True},
+        Telemetry.DI: {"maxTokens": 256, "stopAtJSON": True},
+        Telemetry.HI: {"maxTokens": 256, "stopAtJSON": True},
+        Telemetry.PACKED: {"maxTokens": 4096, "stopAtJSON": True},
+    }
+
+    # The API key is read from API_KEY.json when it isn't given.
+    def __init__(self, model: str = None, apiKey: str = None, layout: str = None):
+        self._model = model if model is not None else type(self)._defaultModel
+        self._apiKey = apiKey
+        self._layout = type(self)._defaultLayout
+        if layout is not None:
+            self.set_layout(layout)
+
+    # The default instance of the class.
+    @classmethod
+    def default(cls) -> 'LLM':
+        with LLM._defaultsLock:
+            if cls not in LLM._defaults:
+                LLM._defaults[cls] = cls()
+            return LLM._defaults[cls]
+
+    @hybridmethod
+    def generate(self, messages) -> str:
+        return LLM._cached(self._model, messages, self._create)
+
+    @hybridmethod
+    async def agenerate(self, messages) -> str:
+        return await LLM._acached(self._model, messages, self._acreate)
+
+    # It generates the response of model to messages with the output profile (see LLM.profile).
     @abstractmethod
-    def generate(messages) -> str:
+    def _create(self, model: str, messages, profile: dict) -> str:
         pass
 
-    @staticmethod
+    async def _acreate(self, model: str, messages, profile: dict) -> str:
+        return await asyncio.to_thread(self._create, model, messages, profile)
+
+    @hybridmethod
     @abstractmethod
-    def get_formatter() -> Formatter:
+    def get_formatter(self) -> Formatter:
         pass
 
+    @hybridmethod
+    def set_model(self, model_name: str):
+        self._model = model_name
+
+    @hybridmethod
+    def getModel(self) -> str:
+        return self._model
+
+    @hybridmethod
+    def set_layout(self, layout: str):
+        if layout not in LLM.LAYOUTS:
+            raise ValueError(f"Invalid prompt layout: {layout}. It must be one of {LLM.LAYOUTS}.")
+        self._layout = layout
+
+    @hybridmethod
+    def getLayout(self) -> str:
+        return self._layout
+
     @staticmethod
-    @abstractmethod
-    def set_model(model_name: str):
-        pass
+    def _readKey(name: str) -> str:
+        with open("API_KEY.json", "r") as key_file:
+            return json.load(key_file)[name]
+
+    # It enables the response cache shared by all the LLMs. None disables it.
+    @staticmethod
+    def set_cache(cache: ResponseCache):
+        LLM._cache = cache
+
+    # It sets the output profile of a caller (e.g. Telemetry.VALIDATOR), used by all the LLMs.
+    @staticmethod
+    def set_profile(caller: str, maxTokens: int = 512, stopAtJSON: bool = False):
+        LLM._profiles[caller] = {"maxTokens": maxTokens, "stopAtJSON": stopAtJSON}
+
+    @staticmethod
+    def remove_profile(caller: str):
+        LLM._profiles.pop(caller, None)
+
+    # The output profile of the current caller.
+    @staticmethod
+    def profile() -> dict:
+        return LLM._profiles.get(Telemetry.current_caller(), LLM._defaultProfile)
+
+    # The cache key of a call. The profile is part of it, since it changes the response;
+    # the calls with the default profile keep the key they had before the profiles.
+    @staticmethod
+    def _key(model: str, messages, profile: dict) -> str:
+        return ResponseCache.key(model, messages, None if profile == LLM._defaultProfile else profile)
+
+    # It returns the cached response of model for messages, calling generate(model, messages, profile) on a miss.
+    # Empty responses are not stored, since they are usually a failed generation.
+    @staticmethod
+    def _cached(model: str, messages, generate) -> str:
+        profile = LLM.profile()
+        with Telemetry.trace(model, messages) as call:
+            if call is not None:
+                call.max_tokens = profile["maxTokens"]
+            response = LLM._lookup(model, messages, generate, call, profile)
+            if call is not None:
+                call.response_chars = len(response)
+            return response
+
+    @staticmethod
+    def _lookup(model: str, messages, generate, call, profile: dict) -> str:
+        cache = LLM._cache
+        if cache is None:
+            return generate(model, messages, profile)
+        key = LLM._key(model, messages, profile)
+        response = cache.get(key)
+        if response is None:
+            response = generate(model, messages, profile)
+            if response != "":
+                cache.put(key, response)
+        elif call is not None:
+            call.cache_hit = True
+        return response
+
+    # Async version of _cached, agenerate(model, messages, profile) is a coroutine function.
+    @staticmethod
+    async def _acached(model: str, messages, agenerate) -> str:
+        profile = LLM.profile()
+        with Telemetry.trace(model, messages) as call:
+            if call is not None:
+                call.max_tokens = profile["maxTokens"]
+            response = await LLM._alookup(model, messages, agenerate, call, profile)
+            if call is not None:
+                call.response_chars = len(response)
+            return response
+
+    @staticmethod
+    async def _alookup(model: str, messages, agenerate, call, profile: dict) -> str:
+        cache = LLM._cache
+        if cache is None:
+            return await agenerate(model, messages, profile)
+        key = LLM._key(model, messages, profile)
+        response = cache.get(key)
+        if response is None:
+            response = await agenerate(model, messages, profile)
+            if response != "":
+                cache.put(key, response)
+        elif call is not None:
+            call.cache_hit = True
+        return response
+
+    # It reads a streamed response until it contains a complete JSON object, then it closes the stream,
+    # so that the provider stops generating. text(chunk) is the text of a chunk of the stream,
+    # usage(chunk), if given, reports the token usage carried by the chunk to the Telemetry.
+    # A stream closed early never gets to its usage chunk: the tokens not reported are estimated.
+    @staticmethod
+    def _collect(stream, text, usage=None) -> str:
+        extractor = JSONExtractor(first=True)
+        try:
+            for chunk in stream:
+                LLM._readChunk(extractor, chunk, text, usage)
+                if extractor.complete():
+                    Telemetry.early_stop()
+                    break
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+        Telemetry.estimate_usage(len(extractor.text()))
+        return extractor.text()
+
+    # Async version of _collect, for the streams of the async clients.
+    @staticmethod
+    async def _acollect(stream, text, usage=None) -> str:
+        extractor = JSONExtractor(first=True)
+        try:
+            async for chunk in stream:
+                LLM._readChunk(extractor, chunk, text, usage)
+                if extractor.complete():
+                    Telemetry.early_stop()
+                    break
+        finally:
+            close = getattr(stream, "aclose", None) or getattr(stream, "close", None)
+            if close is not None:
+                closing = close()
+                if inspect.isawaitable(closing):
+                    await closing
+        Telemetry.estimate_usage(len(extractor.text()))
+        return extractor.text()
+
+
+    @staticmethod
+    def _readChunk(extractor: JSONExtractor, chunk, text, usage):
+        content = text(chunk) or ""
+        if content != "" and extractor.text() == "":
+            Telemetry.first_token()
+        if usage is not None:
+            usage(chunk)
+        extractor.feed(content)
+
 
 # The Gemma implementation of the LLM class. 
 # It uses the Google GenAI API to generate text.
-# The default model is "gemma-3-27b-it", but it can be changed using the set_model method.
+# The default model is "gemma-3-27b-it", but it can be changed using the set_model method
+# or by creating an instance with another model.
 class GemmaLLM(LLM):
-    _client = None
-    _model = "gemma-3-27b-it"
+    _defaultModel = "gemma-3-27b-it"
+
+    def _get_client(self):
+        def create(apiKey):
+            from google import genai
+            return genai.Client(api_key=apiKey)
+        return ClientPool.get("genai", self._apiKey or LLM._readKey("GENAI_KEY"), create)
 
     @staticmethod
-    def _get_client():
-        if GemmaLLM._client is None:
-            with open("API_KEY.json", "r") as key_file:
-                api_key = json.load(key_file)["GENAI_KEY"]
-            GemmaLLM._client = genai.Client(
-                api_key = api_key
+    def _config(profile: dict):
+        from google.genai import types
+        return types.GenerateContentConfig(
+                temperature=0,
+                max_output_tokens=profile["maxTokens"],
+                top_p=1,
             )
-        return GemmaLLM._client
-    
+
+    # With stopAtJSON the response is streamed and stopped at the first JSON object.
+    @_retry
+    def _create(self, model: str, messages, profile: dict) -> str:
+        Telemetry.attempt()
+        RateLimiter.wait(model, messages, profile["maxTokens"])
+        models = self._get_client().models
+        if profile["stopAtJSON"]:
+            stream = models.generate_content_stream(model=model, contents=messages, config=GemmaLLM._config(profile))
+            return LLM._collect(stream, lambda chunk: chunk.text, GemmaLLM._usage)
+        response = models.generate_content(model=model, contents=messages, config=GemmaLLM._config(profile))
+        GemmaLLM._usage(response)
+        return response.text or ""
+
+    # Same as _create, but it uses the async client of the Google GenAI API.
+    @_retry
+    async def _acreate(self, model: str, messages, profile: dict) -> str:
+        Telemetry.attempt()
+        await RateLimiter.await_turn(model, messages, profile["maxTokens"])
+        models = self._get_client().aio.models
+        if profile["stopAtJSON"]:
+            stream = await models.generate_content_stream(
+                model=model, contents=messages, config=GemmaLLM._config(profile)
+            )
+            return await LLM._acollect(stream, lambda chunk: chunk.text, GemmaLLM._usage)
+        response = await models.generate_content(model=model, contents=messages, config=GemmaLLM._config(profile))
+        GemmaLLM._usage(response)
+        return response.text or ""
+
+    # The input tokens of a response (or of a chunk of a stream), how many of them were cached and the output tokens.
     @staticmethod
-    @retry(
-        wait=wait_exponential(multiplier=1, min=4, max=120),
-        stop=stop_after_attempt(7),
-        retry=retry_if_exception_type(Exception)
-    )
-    def generate(messages) -> str:
-        return GemmaLLM._get_client().models.generate_content(
-                model=GemmaLLM._model,
-                contents=messages,
-                config=types.GenerateContentConfig(
-                        temperature=0,
-                        max_output_tokens=512,
-                        top_p=1,
-                    )
-                ).text or ""
+    def _usage(response):
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None and usage.prompt_token_count is not None:
+            Telemetry.usage(usage.prompt_token_count, usage.cached_content_token_count or 0,
+                            usage.candidates_token_count)
     
-    @staticmethod
-    def get_formatter() -> Formatter:
+    @hybridmethod
+    def get_formatter(self) -> Formatter:
         return GemmaFormatter()
-    
-    @staticmethod
-    def set_model(model_name: str):
-        GemmaLLM._model = model_name
-        
 
 
 # The LLama implementation of the LLM class.
 # It uses the Groq API to generate text.
 # The default model is "llama-3.3-70b-versatile", 
-# but it can be changed using the set_model method.
+# but it can be changed using the set_model method or by creating an instance with another model.
 class LLamaLLM(LLM):
-    _client = None
-    _model = "llama-3.3-70b-versatile"
+    _defaultModel = "llama-3.3-70b-versatile"
 
-    @staticmethod
-    def _get_client():
-        if LLamaLLM._client is None:
-            api_key = ""
-            with open("API_KEY.json", "r") as key_file:
-                api_key = json.load(key_file)["GROQ_KEY"]
-            LLamaLLM._client = Groq(api_key=api_key)
-        return LLamaLLM._client
-    
-    @staticmethod
-    @retry(
-        wait=wait_exponential(multiplier=1, min=4, max=120),
-        stop=stop_after_attempt(7),
-        retry=retry_if_exception_type(Exception)
-    )
-    def generate(messages) -> str:
-        return LLamaLLM._get_client().chat.completions.create(
-            model=LLamaLLM._model,
+    def _get_client(self):
+        def create(apiKey):
+            from groq import Groq
+            return Groq(api_key=apiKey)
+        return ClientPool.get("groq", self._apiKey or LLM._readKey("GROQ_KEY"), create)
+
+    def _get_async_client(self):
+        def create(apiKey):
+            from groq import AsyncGroq
+            return AsyncGroq(api_key=apiKey)
+        return ClientPool.get("groq-async", self._apiKey or LLM._readKey("GROQ_KEY"), create)
+
+    # With stopAtJSON the response is streamed and stopped at the first JSON object.
+    @_retry
+    def _create(self, model: str, messages, profile: dict) -> str:
+        Telemetry.attempt()
+        RateLimiter.wait(model, messages, profile["maxTokens"])
+        response = self._get_client().chat.completions.create(
+            model=model,
             messages=messages,
             temperature=0,
-            max_completion_tokens=512,
+            max_completion_tokens=profile["maxTokens"],
             top_p=1,
-            stream=False,
+            stream=profile["stopAtJSON"],
             stop=None
-        ).choices[0].message.content or ""
-    
+        )
+        if profile["stopAtJSON"]:
+            return LLM._collect(response, LLamaLLM._delta, LLamaLLM._usage)
+        LLamaLLM._usage(response)
+        return response.choices[0].message.content or ""
+
+    # Same as _create, but it uses the async Groq client.
+    @_retry
+    async def _acreate(self, model: str, messages, profile: dict) -> str:
+        Telemetry.attempt()
+        await RateLimiter.await_turn(model, messages, profile["maxTokens"])
+        response = await self._get_async_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=0,
+            max_completion_tokens=profile["maxTokens"],
+            top_p=1,
+            stream=profile["stopAtJSON"],
+            stop=None
+        )
+        if profile["stopAtJSON"]:
+            return await LLM._acollect(response, LLamaLLM._delta, LLamaLLM._usage)
+        LLamaLLM._usage(response)
+        return response.choices[0].message.content or ""
+
+    # The text of a chunk of a streamed chat completion.
     @staticmethod
-    def get_formatter() -> Formatter:
-        return LLamaFormatter()
-    
+    def _delta(chunk) -> str:
+        return chunk.choices[0].delta.content if chunk.choices else ""
+
+    # The input tokens of a completion, how many of them were cached and the output tokens.
+    # In a stream, the usage is in the last chunk.
     @staticmethod
-    def set_model(model_name: str):
-        LLamaLLM._model = model_name
+    def _usage(response):
+        usage = getattr(response, "usage", None) or getattr(getattr(response, "x_groq", None), "usage", None)
+        if usage is not None:
+            details = getattr(usage, "prompt_tokens_details", None)
+            Telemetry.usage(usage.prompt_tokens, getattr(details, "cached_tokens", None) or 0,
+                            getattr(usage, "completion_tokens", None))
+
+    @hybridmethod
+    def get_formatter(self) -> Formatter:
+        return LLamaFormatter()
 
 
 # The LLM Evaluator is the LLM used to generate JSON analysis of the messages (for the critic) 
 # and to evaluate the negotiation session.
 # It is based on llama-3.3-70b, the largest and fastest (and free) model available for me.
+# It has its own default instance, so it doesn't depend on the model set on LLamaLLM.
 class LLM_Evaluator(LLamaLLM):
-    @staticmethod
-    def generate(messages) -> str:
-        actual__model = LLamaLLM._model
-        LLamaLLM.set_model("llama-3.3-70b-versatile")
-        message = LLamaLLM.generate(messages)
-        LLamaLLM.set_model(actual__model)
-        return message
+    _defaultModel = "llama-3.3-70b-versatile"
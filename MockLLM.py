@@ -0,0 +1,449 @@
+import asyncio
+import collections
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from pathlib import Path
+
+from BatchLLM import BatchLLM
+from Formatter import Formatter, LLamaFormatter
+from LLM import LLM, hybridmethod
+from RateLimiter import RateLimiter
+from Telemetry import Telemetry
+
+_PRICE = re.compile(r"\$\s*(\d[\d,]*(?:\.\d+)?)")
+_JSON_OFFER = re.compile(r'"(buyer|seller)"\s*:\s*"?\$?\s*(\d[\d,]*(?:\.\d+)?)', re.IGNORECASE)
+_DEAL = re.compile(r"\b(?:done deal|deal accepted|agreed)\b", re.IGNORECASE)
+_REFUSAL = re.compile(r"\bi refuse\b", re.IGNORECASE)
+
+
+# Errors raised by the MockLLM to simulate the failures of a provider.
+class MockLLMError(Exception):
+    pass
+
+
+# A simulated rate limit response (HTTP 429): the client should wait retryAfter seconds.
+class MockRateLimitError(MockLLMError):
+    def __init__(self, retryAfter: float):
+        super().__init__(f"Rate limit reached, retry after {retryAfter:.2f}s")
+        self.retryAfter = retryAfter
+
+
+# The formatter of the MockLLM. The prompts have the same shape as the Groq chat prompts,
+# so a benchmark with the mock formats the messages as a run with LLamaLLM would.
+class MockFormatter(LLamaFormatter):
+    pass
+
+
+# The MockLLM is an offline LLM, to benchmark the system without API keys and without network.
+# It answers in two modes:
+# - "scripted": a negotiation script. The agents open with an offer (the list price for the seller,
+#   50-70% of it for the buyer), then move towards the last offer of the other agent by a fraction drawn from
+#   concession (small fractions make long negotiations), and say "Done Deal" when the offers are close. The validator, evaluator, DI and HI prompts get well formed JSON answers,
+#   the summaries of the context policies (see RollingSummary) the list of the offers in the summarized messages.
+# - "replay": the recorded messages of the Sessions_* histories. A prompt gets the message that followed
+#   the same history in a recorded session (one of them, if many sessions share it), the evaluator gets the
+#   recorded evaluation and the DI evaluator the recorded DI score. Unknown prompts get a scripted answer.
+# Every call waits a latency drawn from a distribution (see configure) and can fail with a server error
+# or a rate limit response, with the given rates, or with a rate limit when the calls exceed serverRPM.
+# The failed calls are retried with short exponential waits (or the retryAfter of the rate limit).
+# The random choices are seeded with the seed, the prompt and the attempt, so they don't depend on the
+# order of the calls: the same sweep gets the same answers, latencies and failures in every run
+# (except for the serverRPM limit, that depends on the timing).
+# The calls go through the response cache, the RateLimiter and the Telemetry as the real LLMs,
+# and follow the output profile of the caller (see LLM.profile): the reply, followed by chatter characters of text
+# (as the models often write after their answer), is cut at maxTokens tokens of 4 characters or at the first
+# JSON object, and every emitted token adds tokenLatency seconds to the latency.
+# With prefixCache the mock simulates the prompt cache of a provider: the prompt is read in whole messages,
+# and the longest run of leading messages already sent to the same model is cached. The other input tokens
+# (4 characters each) take prefillLatency seconds each before the first token, and the input and cached
+# tokens are reported to the Telemetry, as a provider reports them in the usage of the response.
+class MockLLM(LLM):
+    _defaultModel = "mock"
+    _config = {}
+    _replay = None
+    _replayLock = threading.Lock()
+    _window = collections.deque()
+    _windowLock = threading.Lock()
+    _prefixes = collections.defaultdict(set)
+    _prefixesLock = threading.Lock()
+
+    # It sets the behaviour of the mock. The latency is a dict with the distribution and its parameters:
+    # {"distribution": "constant", "value": s}, {"distribution": "uniform", "low": s, "high": s},
+    # {"distribution": "normal", "mean": s, "std": s}, {"distribution": "lognormal", "median": s, "sigma": x}
+    # or {"distribution": "exponential", "mean": s}. All the waits are multiplied by timeScale.
+    @staticmethod
+    def configure(mode: str = "scripted", latency: dict = None, errorRate: float = 0.0,
+                  rateLimitRate: float = 0.0, retryAfter: float = 1.0, serverRPM: int = None,
+                  maxAttempts: int = 7, backoff: float = 0.05, maxBackoff: float = 1.0,
+                  timeScale: float = 1.0, seed: int = 0, sessionsRoot: str = "DealingProblem",
+                  tokenLatency: float = 0.0, chatter: int = 0, prefixCache: bool = False,
+                  prefillLatency: float = 0.0, concession: tuple = (0.2, 0.5)):
+        if mode not in ("scripted", "replay"):
+            raise ValueError(f"Invalid mode for MockLLM: {mode}. It must be 'scripted' or 'replay'.")
+        MockLLM._config = {
+            "mode": mode,
+            "latency": latency if latency is not None else {"distribution": "constant", "value": 0.0},
+            "errorRate": errorRate,
+            "rateLimitRate": rateLimitRate,
+            "retryAfter": retryAfter,
+            "serverRPM": serverRPM,
+            "maxAttempts": maxAttempts,
+            "backoff": backoff,
+            "maxBackoff": maxBackoff,
+            "timeScale": timeScale,
+            "seed": seed,
+            "sessionsRoot": sessionsRoot,
+            "tokenLatency": tokenLatency,
+            "chatter": chatter,
+            "prefixCache": prefixCache,
+            "prefillLatency": prefillLatency,
+            "concession": tuple(concession),
+        }
+        MockLLM._replay = None
+        with MockLLM._windowLock:
+            MockLLM._window.clear()
+        with MockLLM._prefixesLock:
+            MockLLM._prefixes.clear()
+
+    def _create(self, model: str, messages, profile: dict) -> str:
+        config = MockLLM._getConfig()
+        for attempt in range(1, config["maxAttempts"] + 1):
+            Telemetry.attempt()
+            RateLimiter.wait(model, messages)
+            rng = MockLLM._random(model, messages, attempt)
+            time.sleep(MockLLM._latency(rng, config))
+            try:
+                MockLLM._failure(rng, config)
+            except MockLLMError as e:
+                if attempt == config["maxAttempts"]:
+                    raise
+                time.sleep(MockLLM._backoff(rng, config, attempt, e))
+                continue
+            time.sleep(MockLLM._prefill(model, messages, config))
+            text = MockLLM._emit(MockLLM._reply(rng, messages, config), profile, config)
+            time.sleep(MockLLM._generationTime(text, config))
+            return text
+
+    # Same as _create, but it doesn't block the event loop.
+    async def _acreate(self, model: str, messages, profile: dict) -> str:
+        config = MockLLM._getConfig()
+        for attempt in range(1, config["maxAttempts"] + 1):
+            Telemetry.attempt()
+            await RateLimiter.await_turn(model, messages)
+            rng = MockLLM._random(model, messages, attempt)
+            await asyncio.sleep(MockLLM._latency(rng, config))
+            try:
+                MockLLM._failure(rng, config)
+            except MockLLMError as e:
+                if attempt == config["maxAttempts"]:
+                    raise
+                await asyncio.sleep(MockLLM._backoff(rng, config, attempt, e))
+                continue
+            await asyncio.sleep(MockLLM._prefill(model, messages, config))
+            text = MockLLM._emit(MockLLM._reply(rng, messages, config), profile, config)
+            await asyncio.sleep(MockLLM._generationTime(text, config))
+            return text
+
+    @hybridmethod
+    def get_formatter(self) -> Formatter:
+        return MockFormatter()
+
+    @staticmethod
+    def _getConfig() -> dict:
+        if not MockLLM._config:
+            MockLLM.configure()
+        return MockLLM._config
+
+    @staticmethod
+    def _random(model: str, messages, attempt: int) -> random.Random:
+        prompt = json.dumps(messages, sort_keys=True)
+        digest = hashlib.sha256(f"{MockLLM._config['seed']}:{model}:{attempt}:{prompt}".encode('utf-8')).hexdigest()
+        return random.Random(digest)
+
+    @staticmethod
+    def _latency(rng: random.Random, config: dict) -> float:
+        latency = config["latency"]
+        distribution = latency["distribution"]
+        if distribution == "constant":
+            value = latency["value"]
+        elif distribution == "uniform":
+            value = rng.uniform(latency["low"], latency["high"])
+        elif distribution == "normal":
+            value = rng.gauss(latency["mean"], latency["std"])
+        elif distribution == "lognormal":
+            value = latency["median"] * rng.lognormvariate(0, latency["sigma"])
+        elif distribution == "exponential":
+            value = rng.expovariate(1 / latency["mean"])
+        else:
+            raise ValueError(f"Invalid latency distribution for MockLLM: {distribution}")
+        return max(0.0, value) * config["timeScale"]
+
+    # It raises the simulated failure of the call, if any.
+    @staticmethod
+    def _failure(rng: random.Random, config: dict):
+        draw = rng.random()
+        if draw < config["rateLimitRate"]:
+            raise MockRateLimitError(config["retryAfter"] * config["timeScale"])
+        if draw < config["rateLimitRate"] + config["errorRate"]:
+            raise MockLLMError("Simulated server error")
+
+        if config["serverRPM"] is not None:
+            window = 60 * config["timeScale"]
+            with MockLLM._windowLock:
+                now = time.monotonic()
+                while MockLLM._window and MockLLM._window[0] <= now - window:
+                    MockLLM._window.popleft()
+                if len(MockLLM._window) >= config["serverRPM"]:
+                    raise MockRateLimitError(MockLLM._window[0] + window - now)
+                MockLLM._window.append(now)
+
+    # It reports the input and the cached tokens of the prompt, and returns the time to read the uncached ones.
+    @staticmethod
+    def _prefill(model: str, messages, config: dict) -> float:
+        sizes, digests = [], []
+        digest = hashlib.sha256()
+        for message in messages:
+            text = json.dumps(message, sort_keys=True)
+            digest.update(text.encode('utf-8'))
+            sizes.append(-(-len(text) // 4))
+            digests.append(digest.hexdigest())
+        cached = 0
+        if config["prefixCache"]:
+            with MockLLM._prefixesLock:
+                prefixes = MockLLM._prefixes[model]
+                for size, prefix in zip(sizes, digests):
+                    if prefix not in prefixes:
+                        break
+                    cached += size
+                prefixes.update(digests)
+        Telemetry.usage(sum(sizes), cached)
+        return (sum(sizes) - cached) * config["prefillLatency"] * config["timeScale"]
+
+    # The text emitted for a reply with the output profile of the call, as a stream of tokens of 4 characters.
+    @staticmethod
+    def _emit(reply: str, profile: dict, config: dict) -> str:
+        if config["chatter"] > 0:
+            reply += "\n" + ("Let me explain my answer. " * (config["chatter"] // 26 + 1))[:config["chatter"]]
+        tokens = [reply[i:i + 4] for i in range(0, len(reply), 4)][:profile["maxTokens"]]
+        if profile["stopAtJSON"]:
+            return LLM._collect(iter(tokens), lambda token: token)
+        Telemetry.usage(outputTokens=len(tokens))
+        return "".join(tokens)
+
+    @staticmethod
+    def _generationTime(text: str, config: dict) -> float:
+        return -(-len(text) // 4) * config["tokenLatency"] * config["timeScale"]
+
+    @staticmethod
+    def _backoff(rng: random.Random, config: dict, attempt: int, error: MockLLMError) -> float:
+        if isinstance(error, MockRateLimitError):
+            return error.retryAfter
+        return min(config["maxBackoff"], config["backoff"] * 2 ** (attempt - 1)) * rng.uniform(0.5, 1) * config["timeScale"]
+
+    @staticmethod
+    def _reply(rng: random.Random, messages, config: dict) -> str:
+        packed = BatchLLM.unpack(messages)
+        if packed is not None:
+            return MockLLM._packedReply(rng, packed, config)
+        rules = "\n".join(message["content"] for message in messages if message["role"] == "system")
+        history = [message for message in messages if message["role"] != "system"]
+
+        if config["mode"] == "replay":
+            reply = MockLLM._replayReply(rng, rules, history)
+            if reply is not None:
+                return reply
+
+        if '"Result"' in rules:
+            return MockLLM._evaluatorReply(history)
+        if "NEGOTIATION SUMMARY" in rules:
+            return MockLLM._summaryReply(history)
+        if "PRIORITY RULES" in rules:
+            return MockLLM._validatorReply(history)
+        if "Statement 1" in rules:
+            return json.dumps({"score": round(rng.random(), 2), "reason": "Scripted score."})
+        if "format_violation_score" in rules:
+            return json.dumps({
+                "format_violation_score": round(rng.random() * 0.2, 2),
+                "role_integrity_score": round(rng.random() * 0.2, 2),
+                "reason": "Scripted score."
+            })
+        return MockLLM._actorReply(rng, rules, history, config)
+
+    # The reply to a packed request (see BatchLLM.pack): the JSON replies of its tasks, by task id.
+    @staticmethod
+    def _packedReply(rng: random.Random, packed: dict, config: dict) -> str:
+        replies = {}
+        for id, messages in packed.items():
+            reply = MockLLM._reply(rng, messages, config)
+            try:
+                replies[id] = json.loads(reply)
+            except json.JSONDecodeError:
+                replies[id] = reply
+        return json.dumps(replies)
+
+    # The scripted reply of an actor. The seller is the agent that wrote the context (the first message).
+    @staticmethod
+    def _actorReply(rng: random.Random, rules: str, history: list, config: dict) -> str:
+        isJSON = "MessageType" in rules
+        role = "Seller" if history and history[0]["role"] == "assistant" else "Buyer"
+        listPrice = MockLLM._prices(history[0]["content"])[0] if history and MockLLM._prices(history[0]["content"]) else 1000
+        own = MockLLM._lastOffer(history[1:], "assistant")
+        other = MockLLM._lastOffer(history[1:], "user")
+
+        if own is None:
+            offer = listPrice if role == "Seller" else round(listPrice * rng.uniform(0.5, 0.7))
+        elif other is not None and abs(other - own) <= 0.03 * listPrice:
+            return MockLLM._actorMessage(isJSON, role, "deal", other)
+        elif other is not None:
+            offer = round(own + (other - own) * rng.uniform(*config["concession"]))
+        else:
+            offer = own
+        return MockLLM._actorMessage(isJSON, role, "counter-offer", offer)
+
+    @staticmethod
+    def _actorMessage(isJSON: bool, role: str, type: str, offer: float) -> str:
+        offer = int(offer)
+        if type == "deal":
+            content = f"Done Deal at ${offer}."
+            return json.dumps({"MessageType": "deal", "content": content}) if isJSON else content
+        content = f"My counteroffer is ${offer}."
+        if isJSON:
+            return json.dumps({"MessageType": "counter-offer", role.lower(): str(offer), "content": content})
+        return content
+
+    @staticmethod
+    def _validatorReply(history: list) -> str:
+        text = history[-1]["content"] if history else ""
+        if _DEAL.search(text):
+            return json.dumps({"MessageType": "deal", "content": "Agreement confirmed."})
+        if _REFUSAL.search(text):
+            return json.dumps({"MessageType": "refusal", "content": text})
+        prices = MockLLM._prices(text)
+        if not prices:
+            return json.dumps({"MessageType": "message", "content": text})
+        offers = {"buyer": str(prices[-1]), "seller": str(prices[-1])}
+        for message in reversed(history[:-1]):
+            previous = MockLLM._prices(message["content"])
+            if previous:
+                offers = {"buyer": str(prices[-1]), "seller": str(previous[-1])}
+                break
+        return json.dumps({"MessageType": "counter-offer", **offers, "content": text})
+
+    @staticmethod
+    def _summaryReply(history: list) -> str:
+        text = history[-1]["content"] if history else ""
+        offers = [
+            f"{line.split(':')[0].strip()} ${int(MockLLM._prices(line)[-1])}"
+            for line in text.split("New messages:")[-1].split("\n") if MockLLM._prices(line)
+        ]
+        return "Offers: " + (", ".join(offers) if offers else "none") + "."
+
+    @staticmethod
+    def _evaluatorReply(history: list) -> str:
+        texts = [message["content"] for message in history]
+        listPrice = MockLLM._prices(texts[0])[0] if texts and MockLLM._prices(texts[0]) else float('nan')
+        buyerOffers = [
+            MockLLM._prices(text)[-1] for text in texts[1:]
+            if text.lower().startswith("buyer") and MockLLM._prices(text)
+        ]
+        initialBuyerOffer = buyerOffers[0] if buyerOffers else float('nan')
+        last = texts[-1] if len(texts) > 1 else ""
+        if _DEAL.search(last):
+            offers = [MockLLM._prices(text)[-1] for text in texts[1:] if MockLLM._prices(text)]
+            result, finalPrice = "DEAL", offers[-1] if offers else float('nan')
+        elif _REFUSAL.search(last):
+            result, finalPrice = "REFUSAL", float('nan')
+        else:
+            result, finalPrice = "NO DEAL", float('nan')
+        return json.dumps({
+            "Result": result,
+            "final_price": str(finalPrice),
+            "initial_price": str(listPrice),
+            "initial_buyer_offer": str(initialBuyerOffer)
+        })
+
+    @staticmethod
+    def _prices(text: str) -> list:
+        offers = _JSON_OFFER.findall(text)
+        if offers:
+            return [float(value.replace(",", "")) for _, value in offers]
+        return [float(value.replace(",", "")) for value in _PRICE.findall(text)]
+
+    @staticmethod
+    def _lastOffer(history: list, role: str):
+        for message in reversed(history):
+            if message["role"] == role:
+                prices = MockLLM._prices(message["content"])
+                if prices:
+                    return prices[-1]
+        return None
+
+    # The recorded answer for a prompt, or None if the prompt is not in the recorded sessions.
+    @staticmethod
+    def _replayReply(rng: random.Random, rules: str, history: list):
+        replay = MockLLM._getReplay()
+        texts = [message["content"] for message in history]
+
+        if '"Result"' in rules:
+            evaluation = replay["evaluations"].get(MockLLM._historyKey(texts))
+            return json.dumps(evaluation) if evaluation is not None else None
+        if "Statement 1" in rules:
+            statement = texts[-1].split("Sentence 2:")[0][len("Sentence 1:"):].rstrip("\n") if texts else ""
+            score = replay["DI"].get(statement)
+            return json.dumps({"score": score, "reason": "Replayed score."}) if score is not None else None
+        if "PRIORITY RULES" in rules or "format_violation_score" in rules or "NEGOTIATION SUMMARY" in rules:
+            return None
+
+        candidates = replay["turns"].get(MockLLM._historyKey(texts))
+        if not candidates:
+            return None
+        return rng.choice(candidates)
+
+    @staticmethod
+    def _historyKey(texts: list) -> str:
+        return hashlib.sha256(json.dumps(texts).encode('utf-8')).hexdigest()
+
+    # It indexes the recorded sessions: the messages that followed every history prefix,
+    # the evaluations of the complete histories and the DI scores of the messages.
+    @staticmethod
+    def _getReplay() -> dict:
+        with MockLLM._replayLock:
+            if MockLLM._replay is not None:
+                return MockLLM._replay
+            replay = {"turns": collections.defaultdict(list), "evaluations": {}, "DI": {}}
+            root = Path(MockLLM._getConfig()["sessionsRoot"])
+            for path in sorted(root.glob("Sessions_*/Session*.json")):
+                with open(path, 'r', encoding="utf-8") as f:
+                    data = json.load(f)
+                for session in data.get("sessions", []):
+                    texts = [data.get("scenario", "")]
+                    for message in session.get("history", []):
+                        prefix = message["role"] + " : "
+                        text = message["text"]
+                        replay["turns"][MockLLM._historyKey(texts)].append(
+                            text[len(prefix):] if text.startswith(prefix) else text
+                        )
+                        if message.get("DI_score") is not None:
+                            replay["DI"][text] = message["DI_score"]
+                        texts.append(text)
+                    evaluation = MockLLM._recordedEvaluation(session.get("evaluation") or {})
+                    if evaluation is not None:
+                        replay["evaluations"][MockLLM._historyKey(texts)] = evaluation
+            MockLLM._replay = replay
+            return replay
+
+    @staticmethod
+    def _recordedEvaluation(evaluation: dict):
+        if evaluation.get("result") in (None, "ERROR"):
+            return None
+        offers = {analysis.get("role"): analysis.get("initial_offer") for analysis in evaluation.get("analysis", [])}
+        return {
+            "Result": evaluation["result"],
+            "final_price": str(evaluation.get("final_price", "nan")),
+            "initial_price": str(offers.get("Seller", "nan")),
+            "initial_buyer_offer": str(offers.get("Buyer", "nan"))
+        }
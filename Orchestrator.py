@@ -0,0 +1,251 @@
+import argparse
+import importlib
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+import LLM as LLMs
+from Arena import Arena
+from ConfigRegistry import ConfigRegistry
+from SessionStore import SessionStore
+from SweepManifest import SweepManifest
+from SweepQueue import LeaseLost, SweepQueue
+from TerminationPolicy import default_policy
+from Tournament import Tournament
+from Utilities import Utilities
+
+
+# The Orchestrator runs a sweep (scenarios x buyers x sellers x modes x models) on many processes and machines.
+# plan expands the sweep into the sessions of a SweepQueue. work starts a pool of worker processes that take
+# the sessions from the queue until it is empty. Each process is initialized once (the spaCy model of the analysis
+# is loaded there, and the LLM clients are created once per process and model) and plays threads sessions at a time:
+# the processes spread the CPU bound work that holds the GIL (the analysis of the sessions, the JSON serialization),
+# the threads keep the LLM requests in flight.
+# Every process writes its sessions to its own shard (shards/<host>-<pid>/<model>/Session<n>_<mode>.json),
+# so no file is written by two processes; merge collects the shards in the history files
+# (<outputDir>/<model>/Session<n>_<mode>.json) and exports them.
+# To use many machines, plan once, run work on every machine with the queue and the output directory on a shared
+# file system, then merge.
+# setup is called in every worker process after its initialization, e.g. to set the rate limits of the process
+# (the RateLimiter is per process, so the limits of the provider have to be divided among the processes).
+# The contextPolicy of plan, if given, bounds the prompts of the agents in the long negotiations (see ContextPolicy).
+# The evaluator of plan, if given, is the (LLM class name, model) pair of the validators, of the HI and DI evaluators
+# and of the evaluation of every session (see Tournament); the model can be None for the default model of the class.
+class Orchestrator():
+    _clients = {}
+    _clientsLock = threading.Lock()
+
+    def __init__(self, queuePath: str, outputDir: str, processes: int = None, threads: int = 4,
+                 leaseSeconds: float = 900, maxAttempts: int = 3, pollSeconds: float = 5, setup=None):
+        self.__queue = SweepQueue(queuePath, leaseSeconds, maxAttempts)
+        self.__outputDir = outputDir
+        self.__processes = processes if processes is not None else os.cpu_count()
+        self.__threads = threads
+        self.__leaseSeconds = leaseSeconds
+        self.__maxAttempts = maxAttempts
+        self.__pollSeconds = pollSeconds
+        self.__setup = setup
+
+    def getQueue(self) -> SweepQueue:
+        return self.__queue
+
+    # It returns the sessions of the sweep. The models are (LLM class name, model) pairs,
+    # the modes are the values of isJSON.
+    @staticmethod
+    def expand(scenarioPaths: list, modes=(False, True), models=(("LLamaLLM", "llama-3.3-70b-versatile"),)) -> list:
+        tasks = []
+        for scenarioPath in scenarioPaths:
+            scenario = ConfigRegistry.scenario(scenarioPath)
+            for client, model in models:
+                for isJSON in modes:
+                    for buyer in scenario['buyers']:
+                        for seller in scenario['sellers']:
+                            tasks.append({
+                                "key": SweepManifest.session_key(
+                                    Path(scenarioPath).stem, buyer['name'], seller['name'], isJSON, model
+                                ),
+                                "scenario": scenarioPath,
+                                "buyer": buyer['name'],
+                                "seller": seller['name'],
+                                "isJSON": isJSON,
+                                "client": client,
+                                "model": model,
+                            })
+        return tasks
+
+    # It adds the sessions of the sweep to the queue, with the configuration of the negotiations,
+    # and returns how many sessions have been added (the ones already in the queue are kept).
+    def plan(self, scenarioPaths: list, modes=(False, True), models=(("LLamaLLM", "llama-3.3-70b-versatile"),),
+             maxRounds: int = 10, evaluate: bool = True, earlyStop: bool = False, speculative: bool = True,
+             contextPolicy: str = None, evaluator: tuple = None) -> int:
+        self.__queue.setConfig({
+            "maxRounds": maxRounds, "evaluate": evaluate, "earlyStop": earlyStop, "speculative": speculative,
+            "contextPolicy": contextPolicy, "evaluator": list(evaluator) if evaluator is not None else None
+        })
+        return self.__queue.add(Orchestrator.expand(scenarioPaths, modes, models))
+
+    # It plays the sessions of the queue on the worker processes, until there are no sessions left.
+    def work(self) -> dict:
+        args = (self.__queue.getPath(), self.__outputDir, self.__threads, self.__leaseSeconds, self.__maxAttempts,
+                self.__pollSeconds)
+        with ProcessPoolExecutor(max_workers=self.__processes, initializer=Orchestrator._initWorker,
+                                 initargs=(self.__setup,)) as pool:
+            results = [future.result() for future in
+                       [pool.submit(Orchestrator._runWorker, *args) for _ in range(self.__processes)]]
+        return {
+            "completed": sum(result["completed"] for result in results),
+            "failed": sum(result["failed"] for result in results),
+            "queue": self.__queue.counts(),
+        }
+
+    @staticmethod
+    def _initWorker(setup):
+        Utilities._get_nlp()
+        if setup is not None:
+            setup()
+
+    # The loop of a worker process: threads threads claim and play the sessions of the queue.
+    # A thread stops when nothing can be claimed and no session is running (a running session can still fail
+    # or lose its lease, and go back to the queue).
+    @staticmethod
+    def _runWorker(queuePath: str, outputDir: str, threads: int, leaseSeconds: float, maxAttempts: int,
+                   pollSeconds: float) -> dict:
+        queue = SweepQueue(queuePath, leaseSeconds, maxAttempts)
+        config = queue.getConfig()
+        shard = Path(outputDir) / "shards" / f"{socket.gethostname()}-{os.getpid()}"
+        stats = {"completed": 0, "failed": 0}
+        lock = threading.Lock()
+
+        def loop(index: int):
+            worker = f"{shard.name}-{index}"
+            while True:
+                task = queue.claim(worker)
+                if task is None:
+                    if queue.counts()["running"] == 0:
+                        return
+                    time.sleep(pollSeconds)
+                    continue
+                try:
+                    Orchestrator._play(task, config, queue, worker, shard)
+                    if queue.complete(task['key'], worker):
+                        with lock:
+                            stats["completed"] += 1
+                except LeaseLost as e:
+                    # The session belongs to another worker now: it is neither completed nor failed here
+                    print(f"Stopped {task['buyer']} vs {task['seller']} ({task['model']}): {e}")
+                except Exception as e:
+                    print(f"Error during {task['buyer']} vs {task['seller']} ({task['model']}): {e}")
+                    queue.fail(task['key'], worker, f"{type(e).__name__}: {e}")
+                    with lock:
+                        stats["failed"] += 1
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(loop, range(threads)))
+        return stats
+
+    # It plays a session and writes it to the shard of the process. The lease is renewed after every turn:
+    # if it has been lost, the session is stopped with LeaseLost.
+    @staticmethod
+    def _play(task: dict, config: dict, queue: SweepQueue, worker: str, shard: Path):
+        scenario = ConfigRegistry.scenario(task['scenario'])
+        path = str(shard / Orchestrator.historyFile(task))
+        evaluator = Orchestrator._client(*config['evaluator']) if config.get('evaluator') is not None else None
+        arena = Tournament.buildArena(
+            task['scenario'], Orchestrator._client(task['client'], task['model']), task['buyer'], task['seller'],
+            task['isJSON'], 'hidden_info' in scenario, path, config['speculative'], config.get('contextPolicy'),
+            evaluator
+        )
+        def checkpoint(arena):
+            if not queue.renew(task['key'], worker):
+                raise LeaseLost(f"the lease of {task['key']} is held by another worker")
+        arena.set_checkpoint(checkpoint)
+        arena.negotiate(
+            maxRounds=config['maxRounds'], save=False,
+            terminationPolicy=default_policy() if config['earlyStop'] else None
+        )
+        Arena.write_session(path, {**arena.build_session(config['evaluate']), "key": task['key']})
+
+    # The history file of a session, relative to the output directory (or to a shard).
+    @staticmethod
+    def historyFile(task: dict) -> Path:
+        name = Path(task['scenario']).stem.replace("Scenario", "Session") + ("_JSA" if task['isJSON'] else "_NA")
+        return Path(task['model'].replace("/", "_")) / f"{name}.json"
+
+    # The LLM of the process for a class name (of the LLM module, or of its own module, e.g. MockLLM) and a model.
+    @staticmethod
+    def _client(name: str, model: str):
+        with Orchestrator._clientsLock:
+            if (name, model) not in Orchestrator._clients:
+                Orchestrator._clients[(name, model)] = Tournament.llmClass(name)(model)
+            return Orchestrator._clients[(name, model)]
+
+    # It collects the sessions of the shards in the history files of the output directory and exports them.
+    # It returns the number of sessions of every history file. The sessions already merged are skipped.
+    @staticmethod
+    def merge(outputDir: str) -> dict:
+        root = Path(outputDir)
+        shards = root / "shards"
+        targets = set()
+        for log in sorted(shards.glob("*/**/*.jsonl")):
+            target = root.joinpath(*log.relative_to(shards).parts[1:]).with_suffix(".json")
+            shard = SessionStore(str(log.with_suffix(".json")), sync=False)
+            store = SessionStore.open(str(target))
+            for session in shard.sessions():
+                if store.get(session['id']) != session:
+                    store.put({**session, "scenario": shard.getScenario()})
+            targets.add(str(target))
+
+        for target in targets:
+            SessionStore.open(target).export()
+        return {target: len(SessionStore.open(target)) for target in sorted(targets)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a sweep on many processes and machines.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    plan = commands.add_parser("plan", help="add the sessions of a sweep to the queue")
+    plan.add_argument("queue", help="queue database, e.g. DealingProblem/Sweeps/sweep.sqlite")
+    plan.add_argument("scenarios", nargs="+", help="scenario files, e.g. DealingProblem/Context/Scenario1.json")
+    plan.add_argument("--modes", nargs="+", choices=["NA", "JSA"], default=["NA", "JSA"])
+    plan.add_argument("--models", nargs="+", default=["LLamaLLM:llama-3.3-70b-versatile"],
+                      help="LLM class and model, e.g. GemmaLLM:gemma-3-4b-it")
+    plan.add_argument("--rounds", type=int, default=10)
+    plan.add_argument("--no-evaluate", action="store_true")
+    plan.add_argument("--early-stop", action="store_true", help="use the default termination policy")
+    plan.add_argument("--context", default=None,
+                      help="context policy of the agents: full, last-k[:K], offer-digest[:K] or rolling-summary[:K]")
+    plan.add_argument("--evaluator", default=None,
+                      help="LLM class and optional model of the validators and evaluators, e.g. MockLLM")
+    work = commands.add_parser("work", help="play the sessions of the queue on this machine")
+    work.add_argument("queue")
+    work.add_argument("output", help="output directory of the history files")
+    work.add_argument("--processes", type=int, default=None)
+    work.add_argument("--threads", type=int, default=4, help="sessions played at a time by every process")
+    work.add_argument("--lease", type=float, default=900, help="seconds after which a silent session is reclaimed")
+    merge = commands.add_parser("merge", help="merge the shards of the workers in the history files")
+    merge.add_argument("output")
+    status = commands.add_parser("status", help="sessions of the queue per status")
+    status.add_argument("queue")
+    retry = commands.add_parser("retry", help="put the failed sessions back in the queue")
+    retry.add_argument("queue")
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        models = [tuple(model.split(":", 1)) for model in args.models]
+        print(Orchestrator(args.queue, None).plan(
+            args.scenarios, modes=[mode == "JSA" for mode in args.modes], models=models, maxRounds=args.rounds,
+            evaluate=not args.no_evaluate, earlyStop=args.early_stop, contextPolicy=args.context,
+            evaluator=(args.evaluator.split(":", 1) + [None])[:2] if args.evaluator is not None else None
+        ), "sessions added")
+    elif args.command == "work":
+        print(Orchestrator(args.queue, args.output, processes=args.processes, threads=args.threads,
+                           leaseSeconds=args.lease).work())
+    elif args.command == "merge":
+        print(Orchestrator.merge(args.output))
+    elif args.command == "status":
+        print(SweepQueue(args.queue).counts())
+    else:
+        print(SweepQueue(args.queue).retryFailed(), "sessions put back in the queue")
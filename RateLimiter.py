@@ -0,0 +1,120 @@
+import asyncio
+import json
+import threading
+import time
+
+
+# The RateLimiter paces the calls to one model so that they stay just under the requests per minute (RPM)
+# and tokens per minute (TPM) limits of the provider, instead of hitting the quota and backing off.
+# It is a token bucket: each bucket refills at (limit * headroom) per minute, and every call reserves
+# one request and its estimated tokens. When a bucket is empty the reservation is scheduled in the future,
+# so the callers wait in the same order in which they arrived (fair queueing), and nobody retries.
+# The limiters are shared by all the LLMs through a registry keyed by model name (see set_limit).
+class RateLimiter():
+    _limiters = {}
+    _registryLock = threading.Lock()
+
+    def __init__(self, requestsPerMinute: float, tokensPerMinute: float = None, headroom: float = 0.95):
+        self.__lock = threading.Lock()
+        self.__requestRate = requestsPerMinute * headroom / 60
+        self.__requestCapacity = max(1.0, requestsPerMinute * headroom)
+        self.__requests = self.__requestCapacity
+        self.__tokenRate = tokensPerMinute * headroom / 60 if tokensPerMinute else None
+        self.__tokenCapacity = tokensPerMinute * headroom if tokensPerMinute else None
+        self.__tokens = self.__tokenCapacity
+        self.__last = time.monotonic()
+        self.__waiting = 0
+        self.calls = 0
+        self.waitedSeconds = 0.0
+
+    # It sets the limits of a model. All the LLMs using that model share the same limiter.
+    @staticmethod
+    def set_limit(model: str, requestsPerMinute: float, tokensPerMinute: float = None, headroom: float = 0.95):
+        with RateLimiter._registryLock:
+            RateLimiter._limiters[model] = RateLimiter(requestsPerMinute, tokensPerMinute, headroom)
+
+    @staticmethod
+    def remove_limit(model: str):
+        with RateLimiter._registryLock:
+            RateLimiter._limiters.pop(model, None)
+
+    @staticmethod
+    def for_model(model: str):
+        return RateLimiter._limiters.get(model)
+
+    # It estimates the tokens of a request: about 4 characters per token for the prompt, plus the maximum output.
+    @staticmethod
+    def estimate_tokens(messages, maxOutputTokens: int = 512) -> int:
+        return len(json.dumps(messages, ensure_ascii=False)) // 4 + maxOutputTokens
+
+    # It blocks until a call to model can be sent. It does nothing if the model has no limits.
+    @staticmethod
+    def wait(model: str, messages, maxOutputTokens: int = 512):
+        limiter = RateLimiter.for_model(model)
+        if limiter is not None:
+            limiter.acquire(RateLimiter.estimate_tokens(messages, maxOutputTokens))
+
+    # Async version of wait.
+    @staticmethod
+    async def await_turn(model: str, messages, maxOutputTokens: int = 512):
+        limiter = RateLimiter.for_model(model)
+        if limiter is not None:
+            await limiter.aacquire(RateLimiter.estimate_tokens(messages, maxOutputTokens))
+
+    def acquire(self, tokens: int = 0):
+        delay = self._reserve(tokens)
+        if delay > 0:
+            try:
+                time.sleep(delay)
+            finally:
+                self._done()
+
+    async def aacquire(self, tokens: int = 0):
+        delay = self._reserve(tokens)
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self._done()
+
+    # Number of calls that are waiting for their turn.
+    def queueDepth(self) -> int:
+        return self.__waiting
+
+    def stats(self) -> dict:
+        with self.__lock:
+            self._refill(time.monotonic())
+            return {
+                "queued": self.__waiting,
+                "calls": self.calls,
+                "waited_seconds": round(self.waitedSeconds, 3),
+                "available_requests": round(self.__requests, 2),
+                "available_tokens": round(self.__tokens, 2) if self.__tokens is not None else None,
+            }
+
+    def _refill(self, now: float):
+        elapsed = now - self.__last
+        self.__last = now
+        self.__requests = min(self.__requestCapacity, self.__requests + elapsed * self.__requestRate)
+        if self.__tokenRate is not None:
+            self.__tokens = min(self.__tokenCapacity, self.__tokens + elapsed * self.__tokenRate)
+
+    # It takes a request and the tokens from the buckets, that can go negative,
+    # and returns how long the caller has to wait before its call.
+    def _reserve(self, tokens: int) -> float:
+        with self.__lock:
+            self._refill(time.monotonic())
+            self.calls += 1
+            self.__requests -= 1
+            delay = max(0.0, -self.__requests / self.__requestRate)
+            if self.__tokenRate is not None:
+                self.__tokens -= min(tokens, self.__tokenCapacity)
+                delay = max(delay, -self.__tokens / self.__tokenRate)
+            if delay > 0:
+                self.__waiting += 1
+                self.waitedSeconds += delay
+            return delay
+
+    def _done(self):
+        with self.__lock:
+            self.__waiting -= 1
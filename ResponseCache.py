@@ -0,0 +1,120 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+
+# The ResponseCache stores the responses of the LLMs, keyed by the model name and a hash of the formatted messages.
+# All the calls run at temperature 0, so the same prompt sent to the same model can reuse the stored response:
+# re-running or re-evaluating a session doesn't cost any API call.
+# It has two tiers: an in memory LRU with at most memorySize responses, and a persistent SQLite database.
+# The database is trimmed to maxDiskBytes, removing the least recently used responses first.
+# If path is None, only the in memory tier is used.
+class ResponseCache():
+    def __init__(self, path: str = "DealingProblem/Cache/responses.sqlite", memorySize: int = 4096,
+                 maxDiskBytes: int = 256 * 1024 * 1024):
+        self.__memory = OrderedDict()
+        self.__memorySize = memorySize
+        self.__maxDiskBytes = maxDiskBytes
+        self.__lock = threading.Lock()
+        self.__db = None
+        self.__diskBytes = 0
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self.__db = sqlite3.connect(path, check_same_thread=False)
+            self.__db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, last_used REAL)"
+            )
+            self.__db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            self.__db.commit()
+            self.__diskBytes = self.__db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    # It returns the key of a request: the model name plus the hash of the formatted message list
+    # and, if given, of the output profile of the request (see LLM.profile).
+    @staticmethod
+    def key(model: str, messages, profile: dict = None) -> str:
+        request = messages if profile is None else {"messages": messages, "profile": profile}
+        payload = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return model + ":" + hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    # It returns the stored response for the key, or None if it is not in the cache.
+    def get(self, key: str):
+        with self.__lock:
+            if key in self.__memory:
+                self.__memory.move_to_end(key)
+                self.hits += 1
+                return self.__memory[key]
+
+            if self.__db is not None:
+                row = self.__db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.__db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+                    self.__db.commit()
+                    self._remember(key, row[0])
+                    self.hits += 1
+                    self.diskHits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, response: str):
+        with self.__lock:
+            self._remember(key, response)
+            if self.__db is None:
+                return
+
+            size = len(key) + len(response.encode('utf-8'))
+            old = self.__db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.__db.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, key.split(":", 1)[0], response, size, time.time())
+            )
+            self.__diskBytes += size - (old[0] if old is not None else 0)
+            if self.__diskBytes > self.__maxDiskBytes:
+                self._evict()
+            self.__db.commit()
+
+    def clear(self):
+        with self.__lock:
+            self.__memory.clear()
+            if self.__db is not None:
+                self.__db.execute("DELETE FROM responses")
+                self.__db.commit()
+                self.__diskBytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.diskHits,
+            "misses": self.misses,
+            "memory_entries": len(self.__memory),
+            "disk_bytes": self.__diskBytes,
+        }
+
+    def _remember(self, key: str, response: str):
+        self.__memory[key] = response
+        self.__memory.move_to_end(key)
+        while len(self.__memory) > self.__memorySize:
+            self.__memory.popitem(last=False)
+
+    # It removes the least recently used responses until the database is back to 90% of its maximum size,
+    # so that the eviction doesn't run again at every put.
+    def _evict(self):
+        target = self.__maxDiskBytes * 0.9
+        rows = self.__db.execute("SELECT key, size FROM responses ORDER BY last_used ASC").fetchall()
+        removed = []
+        for key, size in rows:
+            if self.__diskBytes <= target:
+                break
+            removed.append((key,))
+            self.__diskBytes -= size
+        self.__db.executemany("DELETE FROM responses WHERE key = ?", removed)
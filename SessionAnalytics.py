@@ -0,0 +1,200 @@
+import json
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from Utilities import Utilities
+
+_SESSION_FILE = re.compile(r"Session(\d+)_(NA|JSA)\.json$")
+_TABLES = ("sessions", "agents", "messages")
+
+
+# The SessionAnalytics loads all the session files of the corpus (DealingProblem/Sessions_<model>/SessionN_{NA,JSA}.json)
+# once, and flattens them in three columnar tables (pandas DataFrames):
+# - sessions: one row per session (model, scenario, mode, buyer, seller, result, rounds, final_price, ...)
+# - agents: one row per agent of a session (role, utility, retries, format_errors, avg_msg_length, HI, DI scores, ...)
+# - messages: one row per message of a session (turn, role, length, retry_counts, format_error, DI_score)
+# Every row has the keys model, scenario, mode and session_id (ids are unique only within a file).
+# The tables are cached in cacheDir, together with the modification time of every source file:
+# they are rebuilt only if a file is added, removed or modified.
+# The aggregations of Analysis.ipynb are computed on the tables with vectorized group-bys.
+class SessionAnalytics():
+    def __init__(self, sessions: pd.DataFrame, agents: pd.DataFrame, messages: pd.DataFrame):
+        self.sessions = sessions
+        self.agents = agents
+        self.messages = messages
+
+    @staticmethod
+    def load(root: str = "DealingProblem", cacheDir: str = "DealingProblem/Cache/analytics",
+             refresh: bool = False) -> 'SessionAnalytics':
+        files = SessionAnalytics.session_files(root)
+        manifest = {str(path): path.stat().st_mtime_ns for path in files}
+        cache = Path(cacheDir)
+
+        if not refresh:
+            cached = SessionAnalytics._readCache(cache, manifest)
+            if cached is not None:
+                return cached
+
+        rows = {table: [] for table in _TABLES}
+        for path in files:
+            SessionAnalytics._flatten(path, rows)
+        analytics = SessionAnalytics(*(SessionAnalytics._toFrame(table, rows[table]) for table in _TABLES))
+        analytics._writeCache(cache, manifest)
+        return analytics
+
+    # It returns the session files of the corpus.
+    @staticmethod
+    def session_files(root: str = "DealingProblem") -> list:
+        return sorted(
+            path for path in Path(root).glob("Sessions_*/Session*.json") if _SESSION_FILE.search(path.name)
+        )
+
+    # Number of accepted deals, refusals and sessions without agreement for each model, scenario and mode.
+    # Sessions without evaluation are not counted.
+    def result_counts(self) -> pd.DataFrame:
+        sessions = self._evaluated()
+        outcome = np.select(
+            [sessions['result'] == 'DEAL', sessions['result'] == 'REFUSAL'], ['accepted', 'refused'], 'no_agreements'
+        )
+        counts = sessions.groupby(['model', 'scenario', 'mode', outcome]).size().unstack(fill_value=0)
+        return counts.reindex(columns=['accepted', 'refused', 'no_agreements'], fill_value=0)
+
+    # Average rounds for each model, scenario and mode, overall and by outcome.
+    def avg_rounds(self) -> pd.DataFrame:
+        sessions = self._evaluated()
+        keys = ['model', 'scenario', 'mode']
+        overall = sessions.groupby(keys)['rounds'].mean().rename('avg_rounds_overall')
+        byResult = sessions.pivot_table(index=keys, columns='result', values='rounds', aggfunc='mean')
+        byResult.columns = ['avg_rounds_' + str(column) for column in byResult.columns]
+        return pd.concat([overall, byResult], axis=1).round(2)
+
+    # Average utility of buyer and seller for each model, scenario and mode, over the deals in which
+    # both utilities are valid and positive (as in Analysis.ipynb).
+    def avg_utility(self) -> pd.DataFrame:
+        keys = ['model', 'scenario', 'mode', 'session_id']
+        utilities = self.agents.pivot_table(index=keys, columns='role', values='utility', aggfunc='first')
+        deals = self._evaluated()
+        deals = deals[deals['result'] == 'DEAL'].set_index(keys)
+        utilities = utilities.reindex(deals.index)
+        valid = utilities.notna().all(axis=1) & (utilities > 0).all(axis=1)
+        utilities = utilities[valid].rename(columns={'Buyer': 'buyer_avg_utility', 'Seller': 'seller_avg_utility'})
+        return utilities.groupby(level=['model', 'scenario', 'mode']).mean()
+
+    # Sum of retries and format errors, and average message length, for each model, scenario, mode and role.
+    def agent_stats(self) -> pd.DataFrame:
+        return self.agents.groupby(['model', 'scenario', 'mode', 'role']).agg(
+            retries=('retries', 'sum'),
+            format_errors=('format_errors', 'sum'),
+            avg_msg_length=('avg_msg_length', 'mean'),
+            HI=('HI', 'mean'),
+        )
+
+    # Average and maximum DI scores of the messages, for each model and mode.
+    def DI_stats(self) -> pd.DataFrame:
+        scored = self.messages[self.messages['DI_score'].notna()]
+        return scored.groupby(['model', 'scenario', 'mode'])['DI_score'].agg(['mean', 'max', 'count'])
+
+    def _evaluated(self) -> pd.DataFrame:
+        return self.sessions[self.sessions['result'].notna()]
+
+    @staticmethod
+    def _flatten(path: Path, rows: dict):
+        match = _SESSION_FILE.search(path.name)
+        base = {
+            "model": path.parent.name[len("Sessions_"):],
+            "scenario": int(match.group(1)),
+            "mode": match.group(2),
+        }
+        with open(path, 'r', encoding="utf-8") as f:
+            data = json.load(f)
+
+        for session in data.get('sessions', []):
+            key = {**base, "session_id": str(session['id'])}
+            agents = {agent['role']: agent['name'] for agent in session.get('agents', [])}
+            evaluation = session.get('evaluation') or {}
+            history = session.get('history', [])
+            rows['sessions'].append({
+                **key,
+                "buyer": agents.get('Buyer'),
+                "seller": agents.get('Seller'),
+                "result": evaluation.get('result'),
+                "rounds": evaluation.get('rounds'),
+                "final_price": Utilities.safe_float(evaluation.get('final_price')),
+                "messages": len(history),
+            })
+            for analysis in evaluation.get('analysis', []):
+                rows['agents'].append({
+                    **key,
+                    "role": analysis.get('role'),
+                    "name": agents.get(analysis.get('role')),
+                    "utility": Utilities.safe_float(analysis.get('utility')),
+                    "initial_offer": Utilities.safe_float(analysis.get('initial_offer')),
+                    "avg_msg_length": Utilities.safe_float(analysis.get('avg_msg_length')),
+                    "retries": Utilities.safe_float(analysis.get('retries', 0)),
+                    "format_errors": Utilities.safe_float(analysis.get('format_errors', 0)),
+                    "HI": Utilities.safe_float(analysis.get('HI')),
+                    "max_DI": Utilities.safe_float(analysis.get('max_DI')),
+                    "avg_DI": Utilities.safe_float(analysis.get('avg_DI')),
+                    "IOI": Utilities.safe_float(analysis.get('IOI')),
+                })
+            for turn, message in enumerate(history):
+                rows['messages'].append({
+                    **key,
+                    "turn": turn,
+                    "role": message.get('role'),
+                    "length": len(message.get('text', "")),
+                    "retry_counts": message.get('retry_counts', 0),
+                    "format_error": message.get('format_error', 0),
+                    "DI_score": Utilities.safe_float(message.get('DI_score')),
+                })
+
+    @staticmethod
+    def _toFrame(table: str, rows: list) -> pd.DataFrame:
+        frame = pd.DataFrame(rows)
+        for column in ('model', 'mode', 'role', 'result'):
+            if column in frame:
+                frame[column] = frame[column].astype('category')
+        return frame
+
+    # The tables are stored as Parquet files if pyarrow is installed, otherwise as pickles.
+    @staticmethod
+    def _format() -> str:
+        try:
+            import pyarrow
+            return "parquet"
+        except ImportError:
+            return "pkl"
+
+    @staticmethod
+    def _readCache(cache: Path, manifest: dict):
+        manifestPath = cache / "manifest.json"
+        if not manifestPath.exists():
+            return None
+        with open(manifestPath, 'r') as f:
+            stored = json.load(f)
+        if stored.get('files') != manifest:
+            return None
+
+        format = stored.get('format')
+        tables = []
+        for table in _TABLES:
+            path = cache / f"{table}.{format}"
+            if not path.exists():
+                return None
+            tables.append(pd.read_parquet(path) if format == "parquet" else pd.read_pickle(path))
+        return SessionAnalytics(*tables)
+
+    def _writeCache(self, cache: Path, manifest: dict):
+        cache.mkdir(parents=True, exist_ok=True)
+        format = SessionAnalytics._format()
+        for table in _TABLES:
+            frame = getattr(self, table)
+            if format == "parquet":
+                frame.to_parquet(cache / f"{table}.parquet", index=False)
+            else:
+                frame.to_pickle(cache / f"{table}.pkl")
+        with open(cache / "manifest.json", 'w') as f:
+            json.dump({"format": format, "files": manifest}, f)
@@ -0,0 +1,200 @@
+import argparse
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+
+# The SessionStore keeps the sessions of a history file in an append-only JSON Lines log, next to the JSON file
+# used by the notebooks (e.g. Session1_NA.json is stored in Session1_NA.jsonl).
+# Saving a session appends a single line, instead of re-reading and re-writing the whole history file,
+# so the cost of a save doesn't grow with the number of sessions.
+# Each line is a record: {"type": "scenario", "scenario": ...} or {"type": "session", "session": {...}}.
+# A session saved again with the same id overwrites the previous one: the log keeps both records
+# and the in memory index (id -> offset of the latest record) points to the last one.
+# A crash during a write can only leave a truncated last line, which is dropped when the log is opened again.
+# A corrupt line in the middle of the log is skipped (and dropped by compact), the records after it are kept.
+# compact rewrites the log keeping only the latest records, export writes the JSON file in the usual shape
+# ({"scenario": ..., "sessions": [...]}). Both replace the file atomically.
+# If the log doesn't exist but the JSON file does, the sessions of the JSON file are imported in the log.
+class SessionStore():
+    _stores = {}
+    _storesLock = threading.Lock()
+
+    def __init__(self, path: str, sync: bool = True):
+        self.__jsonPath = Path(path)
+        self.__logPath = self.__jsonPath.with_suffix('.jsonl')
+        self.__sync = sync
+        self.__lock = threading.Lock()
+        self.__index = OrderedDict()
+        self.__scenario = None
+        self.__records = 0
+
+        self.__logPath.parent.mkdir(parents=True, exist_ok=True)
+        if not self.__logPath.exists():
+            self._importJSON()
+        self._scan()
+
+    # It returns the store of a history file. The stores are shared in the process, so the log is scanned once.
+    @staticmethod
+    def open(path: str) -> 'SessionStore':
+        key = str(Path(path).resolve())
+        with SessionStore._storesLock:
+            if key not in SessionStore._stores:
+                SessionStore._stores[key] = SessionStore(path)
+            return SessionStore._stores[key]
+
+    def getPath(self) -> str:
+        return str(self.__jsonPath)
+
+    def getScenario(self):
+        return self.__scenario
+
+    # It saves a session, as built by Arena.build_session (the "scenario" field is stored once per file).
+    def put(self, session: dict):
+        session = dict(session)
+        scenario = session.pop('scenario', None)
+        with self.__lock:
+            if self.__scenario is None and scenario is not None:
+                self._append({"type": "scenario", "scenario": scenario})
+                self.__scenario = scenario
+            if session['id'] in self.__index:
+                print("Session already exists in history file. Overwriting.")
+            offset = self._append({"type": "session", "session": session})
+            self.__index.pop(session['id'], None)
+            self.__index[session['id']] = offset
+
+    def get(self, id):
+        with self.__lock:
+            offset = self.__index.get(id)
+            if offset is None:
+                return None
+            with open(self.__logPath, 'rb') as f:
+                f.seek(offset)
+                return json.loads(f.readline())['session']
+
+    def ids(self) -> list:
+        return list(self.__index.keys())
+
+    def __len__(self) -> int:
+        return len(self.__index)
+
+    # It returns the latest version of every session, in the order in which they were last saved.
+    def sessions(self) -> list:
+        with self.__lock:
+            offsets = set(self.__index.values())
+            sessions = []
+            with open(self.__logPath, 'rb') as f:
+                offset = 0
+                for line in f:
+                    if offset in offsets:
+                        sessions.append(json.loads(line)['session'])
+                    offset += len(line)
+            return sessions
+
+    # It rewrites the log keeping only the latest record of every session.
+    def compact(self):
+        sessions = self.sessions()
+        with self.__lock:
+            records = []
+            if self.__scenario is not None:
+                records.append({"type": "scenario", "scenario": self.__scenario})
+            records.extend({"type": "session", "session": session} for session in sessions)
+            self._replace(self.__logPath, "".join(json.dumps(record) + "\n" for record in records))
+            self._scan()
+
+    # It writes the sessions in the JSON format read by the notebooks, by default in the JSON file of the store.
+    def export(self, path: str = None):
+        JSON = OrderedDict()
+        JSON['scenario'] = self.__scenario if self.__scenario is not None else ""
+        JSON['sessions'] = self.sessions()
+        target = Path(path) if path is not None else self.__jsonPath
+        target.parent.mkdir(parents=True, exist_ok=True)
+        self._replace(target, json.dumps(JSON, indent=4, sort_keys=False))
+        return target
+
+    def _append(self, record: dict) -> int:
+        line = (json.dumps(record) + "\n").encode('utf-8')
+        fd = os.open(self.__logPath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            offset = os.lseek(fd, 0, os.SEEK_END)
+            os.write(fd, line)
+            if self.__sync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.__records += 1
+        return offset
+
+    # It builds the index reading the log, and drops a truncated last line left by a crash.
+    def _scan(self):
+        self.__index = OrderedDict()
+        self.__records = 0
+        offset = 0
+        corrupt = None
+        with open(self.__logPath, 'rb') as f:
+            for line in f:
+                if corrupt is not None:
+                    print(f"Skipping corrupt record at offset {corrupt} of {self.__logPath}")
+                    corrupt = None
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    corrupt = offset
+                    offset += len(line)
+                    continue
+                if record.get('type') == 'scenario':
+                    self.__scenario = record['scenario']
+                elif record.get('type') == 'session':
+                    id = record['session']['id']
+                    self.__index.pop(id, None)
+                    self.__index[id] = offset
+                self.__records += 1
+                offset += len(line)
+        if corrupt is not None:
+            print(f"Dropping truncated record at the end of {self.__logPath}")
+            os.truncate(self.__logPath, corrupt)
+
+    def _importJSON(self):
+        records = []
+        if self.__jsonPath.exists():
+            with open(self.__jsonPath, 'r', encoding="utf-8") as f:
+                raw = json.load(f)
+            if 'scenario' in raw:
+                records.append({"type": "scenario", "scenario": raw['scenario']})
+            records.extend({"type": "session", "session": session} for session in raw.get('sessions', []))
+        self._replace(self.__logPath, "".join(json.dumps(record) + "\n" for record in records))
+
+    # It writes content to a temporary file and then renames it over path, so readers never see a partial file.
+    # The temporary file has a unique name, so two processes exporting the same file don't write the same one.
+    def _replace(self, path: Path, content: str):
+        fd, tmp = tempfile.mkstemp(prefix=path.name + ".", suffix=".tmp", dir=path.parent)
+        try:
+            os.chmod(tmp, 0o644)
+            with open(fd, 'w', encoding="utf-8") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export or compact the session logs of history files.")
+    parser.add_argument("command", choices=["export", "compact"],
+                        help="export: write the JSON files read by the notebooks; compact: rewrite the logs")
+    parser.add_argument("paths", nargs="+", help="history files, e.g. DealingProblem/Sessions_Gemma_12b/Session1_NA.json")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        store = SessionStore.open(path)
+        if args.command == "export":
+            print(f"{len(store)} sessions exported to {store.export()}")
+        else:
+            store.compact()
+            print(f"{len(store)} sessions left in the log of {path}")
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+
+# The SweepManifest keeps track of the sessions of a tournament sweep, so that an interrupted sweep
+# (a crash, or a quota exhausted after all the retries) can be resumed instead of restarted.
+# It is a directory with:
+# - manifest.json: the configuration of the sweep and the status of every session
+#   ("pending", "running", "completed" or "failed"), keyed by a stable session key (see session_key)
+# - checkpoints/<key>.json: the state of the negotiations in progress (history and state of the agents),
+#   saved after every turn and removed when the session is written to the history file.
+# All the files are replaced atomically, so a crash never leaves a partial manifest or checkpoint.
+class SweepManifest():
+    def __init__(self, path: str):
+        self.__dir = Path(path)
+        self.__path = self.__dir / "manifest.json"
+        self.__checkpoints = self.__dir / "checkpoints"
+        self.__lock = threading.Lock()
+        self.__config = {}
+        self.__sessions = {}
+
+        self.__checkpoints.mkdir(parents=True, exist_ok=True)
+        if self.__path.exists():
+            with open(self.__path, 'r', encoding="utf-8") as f:
+                data = json.load(f)
+            self.__config = data.get('config', {})
+            self.__sessions = data.get('sessions', {})
+
+    # The key of a session: unlike the id of the session (Arena._generateHashcode), that depends only on
+    # the names and roles of the agents, it also depends on the scenario, the mode (JSON or natural) and the model.
+    @staticmethod
+    def session_key(scenario: str, buyer: str, seller: str, isJSON: bool, model: str) -> str:
+        identity = json.dumps([scenario, buyer, seller, "JSA" if isJSON else "NA", model])
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()[:16]
+
+    def getPath(self) -> str:
+        return str(self.__dir)
+
+    def getConfig(self) -> dict:
+        return self.__config
+
+    def setConfig(self, config: dict):
+        with self.__lock:
+            self.__config = config
+            self._save()
+
+    def entries(self) -> dict:
+        with self.__lock:
+            return {key: dict(entry) for key, entry in self.__sessions.items()}
+
+    def status(self, key: str) -> str:
+        with self.__lock:
+            return self.__sessions.get(key, {}).get('status')
+
+    # It adds a session to the sweep, if it is not there yet.
+    def register(self, key: str, **info):
+        with self.__lock:
+            if key not in self.__sessions:
+                self.__sessions[key] = {**info, "status": "pending"}
+                self._save()
+
+    def mark(self, key: str, status: str, **info):
+        with self.__lock:
+            self.__sessions.setdefault(key, {}).update(info, status=status)
+            self._save()
+
+    # It forgets all the sessions and checkpoints, to start the sweep again.
+    def reset(self):
+        with self.__lock:
+            self.__sessions = {}
+            for checkpoint in self.__checkpoints.glob("*.json"):
+                checkpoint.unlink()
+            self._save()
+
+    def save_checkpoint(self, key: str, state: dict):
+        self._replace(self.__checkpoints / f"{key}.json", json.dumps(state))
+
+    def load_checkpoint(self, key: str):
+        path = self.__checkpoints / f"{key}.json"
+        if not path.exists():
+            return None
+        with open(path, 'r', encoding="utf-8") as f:
+            return json.load(f)
+
+    def drop_checkpoint(self, key: str):
+        path = self.__checkpoints / f"{key}.json"
+        if path.exists():
+            path.unlink()
+
+    def _save(self):
+        self._replace(self.__path, json.dumps({"config": self.__config, "sessions": self.__sessions}, indent=4))
+
+    @staticmethod
+    def _replace(path: Path, content: str):
+        tmp = path.with_name(path.name + f".{threading.get_ident()}.tmp")
+        with open(tmp, 'w', encoding="utf-8") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
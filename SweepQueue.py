@@ -0,0 +1,141 @@
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+# Raised to stop a session whose lease has been lost (it expired and the session was claimed by another worker).
+class LeaseLost(Exception):
+    pass
+
+
+# The SweepQueue is the work queue of a sweep run by many processes, possibly on many machines (see Orchestrator).
+# It is a SQLite database: one row per session to play (scenario, buyer, seller, mode, client and model) with its
+# status (pending, running, completed, failed), plus the configuration of the sweep, so every worker plays
+# the sessions in the same way.
+# A worker claims a pending session with a lease: if the worker dies, the lease expires and the session goes back
+# to the other workers. The lease is renewed while the session is played (after every turn).
+# A session that fails is retried until maxAttempts, then it is marked as failed.
+# Every operation opens its own connection in an immediate transaction, so the queue can be shared by threads,
+# processes and, on a shared file system with working locks, by machines.
+class SweepQueue():
+    def __init__(self, path: str, leaseSeconds: float = 900, maxAttempts: int = 3):
+        self.__path = Path(path)
+        self.__leaseSeconds = leaseSeconds
+        self.__maxAttempts = maxAttempts
+        self.__path.parent.mkdir(parents=True, exist_ok=True)
+        with self._transaction() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "key TEXT PRIMARY KEY, scenario TEXT, buyer TEXT, seller TEXT, isJSON INTEGER, client TEXT, "
+                "model TEXT, status TEXT, worker TEXT, lease_until REAL, attempts INTEGER, error TEXT)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status)")
+            db.execute("CREATE TABLE IF NOT EXISTS config (name TEXT PRIMARY KEY, value TEXT)")
+
+    def getPath(self) -> str:
+        return str(self.__path)
+
+    @contextmanager
+    def _transaction(self):
+        db = sqlite3.connect(self.__path, timeout=60, isolation_level=None)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        finally:
+            db.close()
+
+    def setConfig(self, config: dict):
+        with self._transaction() as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO config (name, value) VALUES (?, ?)",
+                [(name, json.dumps(value)) for name, value in config.items()]
+            )
+
+    def getConfig(self) -> dict:
+        with self._transaction() as db:
+            return {name: json.loads(value) for name, value in db.execute("SELECT name, value FROM config")}
+
+    # It adds the tasks (dicts with key, scenario, buyer, seller, isJSON, client, model) that are not in the queue yet,
+    # and returns how many have been added.
+    def add(self, tasks: list) -> int:
+        with self._transaction() as db:
+            before = db.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+            db.executemany(
+                "INSERT OR IGNORE INTO tasks (key, scenario, buyer, seller, isJSON, client, model, status, attempts, error) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, 'pending', 0, '')",
+                [(task['key'], task['scenario'], task['buyer'], task['seller'], int(task['isJSON']), task['client'],
+                  task['model']) for task in tasks]
+            )
+            return db.execute("SELECT COUNT(*) FROM tasks").fetchone()[0] - before
+
+    # It claims the next pending session (or a running one whose lease has expired) for the worker.
+    # It returns the task, or None if there is nothing left to claim.
+    def claim(self, worker: str):
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT key, scenario, buyer, seller, isJSON, client, model, attempts FROM tasks "
+                "WHERE status = 'pending' OR (status = 'running' AND lease_until < ?) ORDER BY rowid LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE tasks SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE key = ?",
+                (worker, now + self.__leaseSeconds, row[0])
+            )
+        key, scenario, buyer, seller, isJSON, client, model, attempts = row
+        return {"key": key, "scenario": scenario, "buyer": buyer, "seller": seller, "isJSON": bool(isJSON),
+                "client": client, "model": model, "attempt": attempts + 1}
+
+    # It extends the lease of a session. It returns False if the worker doesn't hold it anymore.
+    def renew(self, key: str, worker: str) -> bool:
+        with self._transaction() as db:
+            return db.execute(
+                "UPDATE tasks SET lease_until = ? WHERE key = ? AND worker = ? AND status = 'running'",
+                (time.time() + self.__leaseSeconds, key, worker)
+            ).rowcount == 1
+
+    # It marks a session as completed. It returns False if the worker doesn't hold it anymore.
+    def complete(self, key: str, worker: str) -> bool:
+        with self._transaction() as db:
+            return db.execute(
+                "UPDATE tasks SET status = 'completed', lease_until = NULL WHERE key = ? AND worker = ?", (key, worker)
+            ).rowcount == 1
+
+    def fail(self, key: str, worker: str, error: str):
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "error = ?, lease_until = NULL WHERE key = ? AND worker = ?",
+                (self.__maxAttempts, error, key, worker)
+            )
+
+    # It puts the failed sessions back in the queue, with new attempts.
+    def retryFailed(self) -> int:
+        with self._transaction() as db:
+            return db.execute(
+                "UPDATE tasks SET status = 'pending', attempts = 0, error = '' WHERE status = 'failed'"
+            ).rowcount
+
+    # Number of sessions per status.
+    def counts(self) -> dict:
+        with self._transaction() as db:
+            counts = {"pending": 0, "running": 0, "completed": 0, "failed": 0}
+            counts.update(dict(db.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status")))
+            return counts
+
+    def tasks(self, status: str = None) -> list:
+        with self._transaction() as db:
+            query = "SELECT key, scenario, buyer, seller, isJSON, client, model, status, worker, attempts, error FROM tasks"
+            rows = db.execute(query + " WHERE status = ?", (status,)) if status else db.execute(query)
+            fields = ["key", "scenario", "buyer", "seller", "isJSON", "client", "model", "status", "worker",
+                      "attempts", "error"]
+            return [dict(zip(fields, row)) for row in rows]
@@ -0,0 +1,278 @@
+import contextvars
+import csv
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+_caller = contextvars.ContextVar("telemetry_caller", default="unknown")
+_session = contextvars.ContextVar("telemetry_session", default=None)
+_call = contextvars.ContextVar("telemetry_call", default=None)
+
+
+# A CallTrace is the record of a single generate call.
+class CallTrace():
+    FIELDS = ["session", "caller", "model", "prompt_messages", "prompt_chars", "response_chars",
+              "latency", "ttft", "input_tokens", "cached_tokens", "output_tokens", "estimated_tokens", "attempts",
+              "cache_hit", "max_tokens", "stopped_early", "error", "start"]
+
+    def __init__(self, model: str, messages):
+        self.session = _session.get()
+        self.caller = _caller.get()
+        self.model = model
+        self.prompt_messages = len(messages)
+        self.prompt_chars = len(json.dumps(messages, ensure_ascii=False))
+        self.response_chars = 0
+        self.latency = 0.0
+        self.ttft = 0.0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.output_tokens = 0
+        self.estimated_tokens = False
+        self.attempts = 0
+        self.cache_hit = False
+        self.max_tokens = 0
+        self.stopped_early = False
+        self.error = ""
+        self.start = time.time()
+        self.started = time.perf_counter()
+
+    def toDict(self) -> dict:
+        return {field: getattr(self, field) for field in CallTrace.FIELDS}
+
+
+# The Telemetry records every generate call of the LLMs: who made it (actor, validator, evaluator, HI, DI),
+# in which session, with which model, the size of the prompt and of the response, the latency,
+# the number of attempts made by the retry policy, whether the response came from the cache, the output limit
+# of the call and whether the streamed response was stopped at the first JSON object (see LLM.profile).
+# The LLMs that report them also record the input and output tokens of the call, how many input tokens came from
+# the prompt cache of the provider, and the time to the first token of a streamed response (for the other calls,
+# the latency). A stream stopped at the first JSON object is closed before its last chunk, where the providers
+# report the usage: the tokens of such a call are estimated from the characters (see estimate_usage).
+# The caller and the session are context variables: Actor, Validator and Arena set them around their calls
+# (with Telemetry.caller and Telemetry.session), so they follow the calls in threads and in asyncio tasks.
+# The records can be aggregated (e.g. per session and caller) and exported as JSON, CSV or in the Prometheus text format.
+# Only the last maxRecords records are kept (see set_max_records), so a long sweep doesn't grow the memory without
+# limit; the aggregates per session, caller and model are kept for all the calls, so the summaries by these fields
+# (and the Prometheus metrics) count every call. The summaries by other fields count the records kept.
+# The callers are the constants below: the output profiles of the LLMs are keyed by them (see LLM.profile).
+class Telemetry():
+    ACTOR = "actor"
+    VALIDATOR = "validator"
+    EVALUATOR = "evaluator"
+    HI = "HI"
+    DI = "DI"
+    SUMMARY = "summary"
+    PACKED = "packed"
+    CHARS_PER_TOKEN = 4
+
+    enabled = True
+    maxRecords = 10000
+    _records = deque(maxlen=maxRecords)
+    _totals = {}
+    _lock = threading.Lock()
+    _KEYS = ("session", "caller", "model")
+
+    @staticmethod
+    @contextmanager
+    def caller(name: str):
+        token = _caller.set(name)
+        try:
+            yield
+        finally:
+            _caller.reset(token)
+
+    @staticmethod
+    def current_caller() -> str:
+        return _caller.get()
+
+    @staticmethod
+    @contextmanager
+    def session(name):
+        token = _session.set(name)
+        try:
+            yield
+        finally:
+            _session.reset(token)
+
+    # It traces a generate call: the body of the with statement is the call.
+    @staticmethod
+    @contextmanager
+    def trace(model: str, messages):
+        if not Telemetry.enabled:
+            yield None
+            return
+        call = CallTrace(model, messages)
+        token = _call.set(call)
+        try:
+            yield call
+        except Exception as e:
+            call.error = type(e).__name__
+            raise
+        finally:
+            call.latency = time.perf_counter() - call.started
+            if call.ttft == 0 and not call.cache_hit:
+                call.ttft = call.latency
+            _call.reset(token)
+            record = call.toDict()
+            with Telemetry._lock:
+                Telemetry._records.append(call)
+                key = tuple(record[field] for field in Telemetry._KEYS)
+                Telemetry._add(Telemetry._totals.setdefault(key, Telemetry._emptyGroup()), record)
+
+    # It counts an attempt of the current call (it is called by the remote calls, once per retry).
+    @staticmethod
+    def attempt():
+        call = _call.get()
+        if call is not None:
+            call.attempts += 1
+
+    # It records the input tokens of the current call, how many of them were cached by the provider
+    # and the output tokens (the ones that are None are not reported).
+    @staticmethod
+    def usage(inputTokens: int = None, cachedTokens: int = 0, outputTokens: int = None):
+        call = _call.get()
+        if call is None:
+            return
+        if inputTokens is not None:
+            call.input_tokens = inputTokens
+            call.cached_tokens = cachedTokens
+        if outputTokens is not None:
+            call.output_tokens = outputTokens
+
+    # It estimates the tokens that the provider hasn't reported for the current call (CHARS_PER_TOKEN characters
+    # per token), e.g. for a stream closed before its usage chunk: the input tokens from the prompt,
+    # the output tokens from the responseChars characters read.
+    @staticmethod
+    def estimate_usage(responseChars: int):
+        call = _call.get()
+        if call is None:
+            return
+        if call.input_tokens == 0:
+            call.input_tokens = -(-call.prompt_chars // Telemetry.CHARS_PER_TOKEN)
+            call.estimated_tokens = True
+        if call.output_tokens == 0 and responseChars > 0:
+            call.output_tokens = -(-responseChars // Telemetry.CHARS_PER_TOKEN)
+            call.estimated_tokens = True
+
+    # It records the time to the first token of the current call (the first call only counts).
+    @staticmethod
+    def first_token():
+        call = _call.get()
+        if call is not None and call.ttft == 0:
+            call.ttft = time.perf_counter() - call.started
+
+    # It marks the current call as stopped before the end of the response.
+    @staticmethod
+    def early_stop():
+        call = _call.get()
+        if call is not None:
+            call.stopped_early = True
+
+    @staticmethod
+    def records() -> list:
+        with Telemetry._lock:
+            return [call.toDict() for call in Telemetry._records]
+
+    @staticmethod
+    def reset():
+        with Telemetry._lock:
+            Telemetry._records = deque(maxlen=Telemetry.maxRecords)
+            Telemetry._totals = {}
+
+    # It sets how many records are kept (the oldest ones are dropped first).
+    @staticmethod
+    def set_max_records(maxRecords: int):
+        with Telemetry._lock:
+            Telemetry.maxRecords = maxRecords
+            Telemetry._records = deque(Telemetry._records, maxlen=maxRecords)
+
+    # It aggregates the calls by the given fields (by default per session and caller).
+    @staticmethod
+    def summary(by=("session", "caller")) -> list:
+        groups = defaultdict(Telemetry._emptyGroup)
+        if all(field in Telemetry._KEYS for field in by):
+            with Telemetry._lock:
+                totals = [(dict(zip(Telemetry._KEYS, key)), dict(total)) for key, total in Telemetry._totals.items()]
+            for fields, total in totals:
+                group = groups[tuple(fields[field] for field in by)]
+                for name, value in total.items():
+                    group[name] = max(group[name], value) if name == "max_latency" else group[name] + value
+        else:
+            for record in Telemetry.records():
+                Telemetry._add(groups[tuple(record[field] for field in by)], record)
+
+        summary = []
+        for key, group in groups.items():
+            group["avg_latency"] = group["latency"] / group["calls"]
+            group["avg_ttft"] = group["ttft"] / group["calls"]
+            summary.append({**dict(zip(by, key)), **group})
+        return summary
+
+    @staticmethod
+    def _emptyGroup() -> dict:
+        return {
+            "calls": 0, "latency": 0.0, "max_latency": 0.0, "attempts": 0, "retries": 0,
+            "cache_hits": 0, "early_stops": 0, "errors": 0, "prompt_chars": 0, "response_chars": 0,
+            "ttft": 0.0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "estimated_usage": 0
+        }
+
+    @staticmethod
+    def _add(group: dict, record: dict):
+        group["calls"] += 1
+        group["latency"] += record["latency"]
+        group["max_latency"] = max(group["max_latency"], record["latency"])
+        group["attempts"] += record["attempts"]
+        group["retries"] += max(0, record["attempts"] - 1)
+        group["cache_hits"] += int(record["cache_hit"])
+        group["early_stops"] += int(record["stopped_early"])
+        group["errors"] += int(record["error"] != "")
+        group["prompt_chars"] += record["prompt_chars"]
+        group["response_chars"] += record["response_chars"]
+        group["ttft"] += record["ttft"]
+        group["input_tokens"] += record["input_tokens"]
+        group["cached_tokens"] += record["cached_tokens"]
+        group["output_tokens"] += record["output_tokens"]
+        group["estimated_usage"] += int(record["estimated_tokens"])
+
+    @staticmethod
+    def export_json(path: str, by=("session", "caller")):
+        with open(path, "w") as f:
+            json.dump({"summary": Telemetry.summary(by), "calls": Telemetry.records()}, f, indent=4)
+
+    @staticmethod
+    def export_csv(path: str):
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=CallTrace.FIELDS)
+            writer.writeheader()
+            writer.writerows(Telemetry.records())
+
+    # It returns the aggregated metrics per caller and model in the Prometheus text exposition format.
+    @staticmethod
+    def prometheus() -> str:
+        metrics = [
+            ("llm_calls_total", "counter", "Number of generate calls.", "calls"),
+            ("llm_latency_seconds_sum", "counter", "Total latency of the generate calls.", "latency"),
+            ("llm_latency_seconds_max", "gauge", "Maximum latency of a generate call.", "max_latency"),
+            ("llm_retries_total", "counter", "Retries made by the retry policy.", "retries"),
+            ("llm_cache_hits_total", "counter", "Calls answered by the response cache.", "cache_hits"),
+            ("llm_early_stops_total", "counter", "Streamed responses stopped at the first JSON object.", "early_stops"),
+            ("llm_errors_total", "counter", "Calls that failed after all the attempts.", "errors"),
+            ("llm_prompt_chars_total", "counter", "Characters sent in the prompts.", "prompt_chars"),
+            ("llm_response_chars_total", "counter", "Characters received in the responses.", "response_chars"),
+            ("llm_input_tokens_total", "counter", "Input tokens reported by the providers.", "input_tokens"),
+            ("llm_cached_tokens_total", "counter", "Input tokens read from the prompt cache of the providers.",
+             "cached_tokens"),
+            ("llm_output_tokens_total", "counter", "Output tokens generated, as reported or estimated.", "output_tokens"),
+            ("llm_estimated_usage_total", "counter", "Calls whose tokens were estimated, e.g. stopped streams.",
+             "estimated_usage"),
+        ]
+        summary = Telemetry.summary(by=("caller", "model"))
+        lines = []
+        for name, type, help, field in metrics:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+            for group in summary:
+                lines.append(f'{name}{{caller="{group["caller"]}",model="{group["model"]}"}} {group[field]}')
+        return "\n".join(lines) + "\n"
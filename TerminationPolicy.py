@@ -0,0 +1,104 @@
+from abc import ABC, abstractmethod
+
+
+# Base class for termination policies.
+# A termination policy is checked by the Arena after every round of a negotiation without agreement.
+# It looks at the history and at the offer trajectories of the validators of the agents (see Validator.getOfferTrajectory),
+# and returns the reason to stop the negotiation early, or None to go on.
+# The policies don't keep any state, so the same policy can be shared by many arenas.
+# Stopping a negotiation that is clearly stuck saves the actor and validator calls of the remaining rounds.
+class TerminationPolicy(ABC):
+    @abstractmethod
+    def check(self, history, agents) -> str:
+        pass
+
+    # It returns the counter-offers made by an agent, in order (the offers of its own role in the trajectory).
+    @staticmethod
+    def ownOffers(agent) -> list:
+        role = agent.getDescription()['role'].lower()
+        return [
+            entry[role] for entry in agent.getOfferTrajectory()
+            if entry['type'] == "counter-offer" and entry[role] == entry[role]
+        ]
+
+
+# It stops when an agent repeats the same counter-offer `repeats` times in a row.
+class RepeatedOfferPolicy(TerminationPolicy):
+    def __init__(self, repeats: int = 3):
+        self.__repeats = repeats
+
+    def check(self, history, agents) -> str:
+        for agent in agents:
+            offers = TerminationPolicy.ownOffers(agent)[-self.__repeats:]
+            if len(offers) == self.__repeats and len(set(offers)) == 1:
+                return f"repeated-offer: {agent.getDescription()['role']} repeated {offers[-1]} {self.__repeats} times"
+        return None
+
+
+# It stops when no agent has improved its best accepted offer (the actual offers of the validators)
+# in the last `turns` turns of every agent. Agents that haven't made a valid offer yet are not stalled.
+class StalledOfferPolicy(TerminationPolicy):
+    def __init__(self, turns: int = 3):
+        self.__turns = turns
+
+    def check(self, history, agents) -> str:
+        for agent in agents:
+            trajectory = agent.getOfferTrajectory()
+            if len(trajectory) <= self.__turns:
+                return None
+            key = "actualBuyerOffer" if agent.getDescription()['role'] == "Buyer" else "actualSellerOffer"
+            recent = [entry[key] for entry in trajectory[-(self.__turns + 1):]]
+            if len(set(recent)) > 1 or recent[0] in (float('inf'), -float('inf')):
+                return None
+        return f"stalemate: no offer improved in the last {self.__turns} turns"
+
+
+# It stops when an agent oscillates between two counter-offers (A, B, A, B, ...) for `length` offers.
+class OscillationPolicy(TerminationPolicy):
+    def __init__(self, length: int = 4):
+        self.__length = length
+
+    def check(self, history, agents) -> str:
+        for agent in agents:
+            offers = TerminationPolicy.ownOffers(agent)[-self.__length:]
+            if len(offers) < self.__length or len(set(offers)) != 2:
+                continue
+            if all(offers[i] != offers[i + 1] for i in range(len(offers) - 1)):
+                return f"oscillation: {agent.getDescription()['role']} alternates between {offers[-2]} and {offers[-1]}"
+        return None
+
+
+# It stops when the gap between the buyer and the seller offers hasn't shrunk by more than `tolerance`
+# (relative to the gap) in the last `rounds` offers of both agents: the agents are not converging to a deal.
+class NoConvergencePolicy(TerminationPolicy):
+    def __init__(self, rounds: int = 3, tolerance: float = 0.05):
+        self.__rounds = rounds
+        self.__tolerance = tolerance
+
+    def check(self, history, agents) -> str:
+        offers = {agent.getDescription()['role']: TerminationPolicy.ownOffers(agent) for agent in agents}
+        gaps = [seller - buyer for buyer, seller in zip(offers.get("Buyer", []), offers.get("Seller", []))]
+        if len(gaps) <= self.__rounds:
+            return None
+        old, new = gaps[-(self.__rounds + 1)], gaps[-1]
+        if old > 0 and (old - new) / old <= self.__tolerance:
+            return f"no-convergence: the gap is still {new} after {self.__rounds} offers"
+        return None
+
+
+# It stops as soon as one of its policies asks to stop.
+class AnyPolicy(TerminationPolicy):
+    def __init__(self, *policies: TerminationPolicy):
+        self.__policies = policies
+
+    def check(self, history, agents) -> str:
+        for policy in self.__policies:
+            reason = policy.check(history, agents)
+            if reason is not None:
+                return reason
+        return None
+
+
+# The default policy for long sweeps: repeated offers, oscillations or stalemates.
+def default_policy() -> TerminationPolicy:
+    return AnyPolicy(RepeatedOfferPolicy(), OscillationPolicy(), StalledOfferPolicy())
@@ -0,0 +1,362 @@
+import argparse
+import asyncio
+import importlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import LLM as LLMs
+from Arena import Arena
+from Agent import Agent
+from DeceptiveSeller import DeceptiveSeller
+from LLM import LLM, LLM_Evaluator
+from ConfigRegistry import ConfigRegistry
+from ContextPolicy import context_policy
+from SweepManifest import SweepManifest
+from TerminationPolicy import TerminationPolicy, default_policy
+
+
+# The SessionWriter is the single writer of a tournament.
+# The arenas running concurrently put their finished sessions in a queue, and a dedicated thread
+# writes them to the history file one at a time, so that concurrent runs never corrupt the file.
+# When it is closed, the JSON file is exported from the session log.
+# onWritten, if given, is called with every session after it has been written.
+class SessionWriter():
+    def __init__(self, path: str, onWritten=None):
+        self.__path = path
+        self.__onWritten = onWritten
+        self.__queue = queue.Queue()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.written = 0
+
+    def start(self):
+        self.__thread.start()
+        return self
+
+    def put(self, session: dict):
+        self.__queue.put(session)
+
+    # It waits until all the queued sessions have been written, then stops the writer thread.
+    def close(self):
+        self.__queue.put(None)
+        self.__thread.join()
+        Arena.export_history(self.__path)
+
+    def __run(self):
+        while True:
+            session = self.__queue.get()
+            if session is None:
+                return
+            try:
+                Arena.write_session(self.__path, session)
+                self.written += 1
+                if self.__onWritten is not None:
+                    self.__onWritten(session)
+            except Exception as e:
+                print(f"Error while writing session {session.get('id')}: {e}")
+
+
+# The Tournament runs every buyer against every seller of a scenario file.
+# The sessions do not depend on each other, so they are executed in parallel on a thread pool
+# (each one blocks on the remote LLM calls), with at most maxConcurrency sessions in flight.
+# With arun the sessions are executed as coroutines on the async LLM clients instead, so a single thread
+# can keep many more requests in flight.
+# Every pairing gets freshly built agents, since agents keep the state of the negotiation (agreement, last offers).
+# If the scenario has hidden information, the sellers are built as deceptive sellers (as in the third benchmark).
+# If evaluate is False, the sessions are saved without evaluation, to be evaluated later by the EvaluationPipeline.
+# The terminationPolicy is used by all the arenas to stop the stuck negotiations early (see TerminationPolicy).
+# The sweep is tracked in a SweepManifest (by default next to the save path, e.g. Session1_NA.sweep):
+# every session has a stable key, and the negotiations in progress are checkpointed after every turn.
+# run and arun with resume=True skip the completed sessions and go on with the others from their last turn.
+# With speculative (the default) the side evaluations of the messages, e.g. the DI scores of the deceptive sellers,
+# run concurrently with the next turns (see Arena.set_speculative).
+# The contextPolicy, if given, is the name of the context policy of every agent (see ContextPolicy.context_policy),
+# to bound the prompts of the long negotiations.
+# The evaluator, if given, is the LLM of the validators, of the HI and DI evaluators and of the evaluation of the sessions
+# (by default LLM_Evaluator and LLamaLLM): with client and evaluator both MockLLM a tournament makes no remote call.
+class Tournament():
+    def __init__(self, scenarioPath: str, client: LLM, savePath: str, maxConcurrency: int = 8,
+                 isJSON: bool = False, maxRounds: int = 10, deceptive: bool = None, evaluate: bool = True,
+                 terminationPolicy: TerminationPolicy = None, manifestPath: str = None, speculative: bool = True,
+                 contextPolicy: str = None, evaluator: LLM = None):
+        self.__scenarioPath = scenarioPath
+        self.__client = client
+        self.__evaluator = evaluator
+        self.__savePath = savePath
+        self.__maxConcurrency = maxConcurrency
+        self.__isJSON = isJSON
+        self.__maxRounds = maxRounds
+        self.__evaluate = evaluate
+        self.__terminationPolicy = terminationPolicy
+        self.__speculative = speculative
+        self.__contextPolicy = contextPolicy
+
+        self.__scenario = ConfigRegistry.scenario(scenarioPath)
+        self.__deceptive = 'hidden_info' in self.__scenario if deceptive is None else deceptive
+        self.__model = Tournament.modelName(client)
+        self.__manifest = SweepManifest(
+            manifestPath if manifestPath is not None else str(Path(savePath).with_suffix('.sweep'))
+        )
+
+    # It rebuilds the tournament of a sweep from its manifest, to resume it.
+    # The client (and the evaluator) is an instance of the LLM class saved in the manifest, with its model,
+    # if it isn't given. A sweep that used a termination policy is resumed with the default policy.
+    @staticmethod
+    def fromManifest(manifestPath: str, client: LLM = None, maxConcurrency: int = 8, evaluator: LLM = None) -> 'Tournament':
+        config = SweepManifest(manifestPath).getConfig()
+        if client is None:
+            client = Tournament.llmClass(config['client'])(config['model'])
+        if evaluator is None and config.get('evaluator') is not None:
+            evaluator = Tournament.llmClass(config['evaluator'])(config['evaluatorModel'])
+        return Tournament(
+            config['scenarioPath'], client, config['savePath'], maxConcurrency=maxConcurrency,
+            isJSON=config['isJSON'], maxRounds=config['maxRounds'], deceptive=config['deceptive'],
+            evaluate=config['evaluate'], terminationPolicy=default_policy() if config['earlyStop'] else None,
+            manifestPath=manifestPath, contextPolicy=config.get('contextPolicy'), evaluator=evaluator
+        )
+
+    @staticmethod
+    def modelName(client) -> str:
+        if hasattr(client, 'getModel'):
+            return client.getModel()
+        return getattr(client, '__name__', type(client).__name__)
+
+    @staticmethod
+    def className(client) -> str:
+        return getattr(client, '__name__', type(client).__name__)
+
+    # The LLM class with the given name, from the LLM module or from its own module (e.g. MockLLM).
+    @staticmethod
+    def llmClass(name: str):
+        return getattr(LLMs, name, None) or getattr(importlib.import_module(name), name)
+
+    def getManifest(self) -> SweepManifest:
+        return self.__manifest
+
+    def config(self) -> dict:
+        return {
+            "scenarioPath": self.__scenarioPath,
+            "savePath": self.__savePath,
+            "client": Tournament.className(self.__client),
+            "model": self.__model,
+            "evaluator": Tournament.className(self.__evaluator) if self.__evaluator is not None else None,
+            "evaluatorModel": Tournament.modelName(self.__evaluator) if self.__evaluator is not None else None,
+            "isJSON": self.__isJSON,
+            "maxRounds": self.__maxRounds,
+            "deceptive": self.__deceptive,
+            "evaluate": self.__evaluate,
+            "earlyStop": self.__terminationPolicy is not None,
+            "contextPolicy": self.__contextPolicy,
+        }
+
+    def sessionKey(self, buyerName: str, sellerName: str) -> str:
+        return SweepManifest.session_key(
+            Path(self.__scenarioPath).stem, buyerName, sellerName, self.__isJSON, self.__model
+        )
+
+    # It returns the list of (buyer name, seller name) pairings of the scenario.
+    def pairings(self) -> list[tuple[str, str]]:
+        return [
+            (buyer['name'], seller['name'])
+            for buyer in self.__scenario['buyers']
+            for seller in self.__scenario['sellers']
+        ]
+
+    def _buildArena(self, buyerName: str, sellerName: str) -> Arena:
+        return Tournament.buildArena(
+            self.__scenarioPath, self.__client, buyerName, sellerName, self.__isJSON, self.__deceptive,
+            self.__savePath, self.__speculative, self.__contextPolicy, self.__evaluator
+        )
+
+    # It builds the arena of a pairing of the scenario, with freshly built agents (see also Orchestrator).
+    # The evaluator, if given, is the LLM of the validators, of the HI and DI evaluators and of the evaluation.
+    @staticmethod
+    def buildArena(scenarioPath: str, client: LLM, buyerName: str, sellerName: str, isJSON: bool, deceptive: bool,
+                   savePath: str, speculative: bool = True, contextPolicy: str = None, evaluator: LLM = None) -> Arena:
+        buyer = Agent.fromJSON(
+            path=scenarioPath,
+            agentType="buyers",
+            name=buyerName,
+            isJSON=isJSON,
+            client=client,
+            evaluator=evaluator
+        )
+        if deceptive:
+            seller = DeceptiveSeller.fromJSON_DeceptiveSeller(
+                path=scenarioPath,
+                agentType="sellers",
+                name=sellerName,
+                isJSON=isJSON,
+                client=client,
+                evaluator=evaluator
+            )
+        else:
+            seller = Agent.fromJSON(
+                path=scenarioPath,
+                agentType="sellers",
+                name=sellerName,
+                isJSON=isJSON,
+                client=client,
+                evaluator=evaluator
+            )
+        if contextPolicy is not None:
+            for agent in (buyer, seller):
+                agent.set_context_policy(context_policy(contextPolicy, client))
+
+        return Arena.load_session(
+            scenarioPath,
+            evaluator if evaluator is not None else LLM_Evaluator
+        ).loadAgents(
+            buyer
+        ).loadAgents(
+            seller
+        ).set_fileName(
+            savePath
+        ).set_speculative(
+            speculative
+        )
+
+    # It returns the pairings to play. Without resume the sweep starts again: the manifest is cleared.
+    def _pending(self, resume: bool) -> list[tuple[str, str]]:
+        if not resume:
+            self.__manifest.reset()
+        self.__manifest.setConfig(self.config())
+        pending = []
+        for buyer, seller in self.pairings():
+            key = self.sessionKey(buyer, seller)
+            self.__manifest.register(key, buyer=buyer, seller=seller)
+            if self.__manifest.status(key) != "completed":
+                pending.append((buyer, seller))
+        return pending
+
+    # It builds the arena of a pairing, restored from its checkpoint if the negotiation was interrupted.
+    def _startArena(self, buyerName: str, sellerName: str) -> tuple[str, Arena]:
+        key = self.sessionKey(buyerName, sellerName)
+        arena = self._buildArena(buyerName, sellerName)
+        checkpoint = self.__manifest.load_checkpoint(key)
+        if checkpoint is not None:
+            arena.restore(checkpoint)
+            print(f"Resuming {buyerName} vs {sellerName} from turn {len(checkpoint['history']) - 1}")
+        arena.set_checkpoint(lambda arena: self.__manifest.save_checkpoint(key, arena.getState()))
+        self.__manifest.mark(key, "running")
+        return key, arena
+
+    # It runs a single pairing and returns its session, without writing it.
+    def _play(self, buyerName: str, sellerName: str) -> dict:
+        key, arena = self._startArena(buyerName, sellerName)
+        arena.negotiate(maxRounds=self.__maxRounds, save=False, terminationPolicy=self.__terminationPolicy)
+        return {**arena.build_session(self.__evaluate), "key": key}
+
+    # Async version of _play.
+    async def _aplay(self, buyerName: str, sellerName: str) -> dict:
+        key, arena = self._startArena(buyerName, sellerName)
+        await arena.anegotiate(maxRounds=self.__maxRounds, save=False, terminationPolicy=self.__terminationPolicy)
+        return {**(await arena.abuild_session(self.__evaluate)), "key": key}
+
+    # A session is completed only when it has been written to the history file.
+    def _written(self, session: dict):
+        self.__manifest.mark(session['key'], "completed")
+        self.__manifest.drop_checkpoint(session['key'])
+
+    def _failed(self, buyer: str, seller: str, error: Exception):
+        print(f"Error during {buyer} vs {seller}: {error}")
+        self.__manifest.mark(self.sessionKey(buyer, seller), "failed", error=str(error))
+
+    # It runs all the pairings and writes the sessions to the save path as they complete.
+    # With resume, the completed sessions of the manifest are skipped and the interrupted ones go on from their checkpoint.
+    # It returns the number of completed sessions and the list of pairings that failed.
+    def run(self, resume: bool = False) -> dict:
+        pairings = self._pending(resume)
+        failed = []
+        completed = 0
+
+        writer = SessionWriter(self.__savePath, self._written).start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.__maxConcurrency) as executor:
+                futures = {executor.submit(self._play, buyer, seller): (buyer, seller) for buyer, seller in pairings}
+                for future in as_completed(futures):
+                    buyer, seller = futures[future]
+                    try:
+                        writer.put(future.result())
+                        completed += 1
+                        print(buyer, " vs ", seller)
+                        print("COMPLETED : " + str(completed) + "/" + str(len(pairings)))
+                    except Exception as e:
+                        self._failed(buyer, seller, e)
+                        failed.append((buyer, seller))
+        finally:
+            writer.close()
+
+        return {"completed": completed, "failed": failed}
+
+    # Async version of run: at most maxConcurrency sessions are negotiated at the same time on the event loop.
+    async def arun(self, resume: bool = False) -> dict:
+        pairings = self._pending(resume)
+        failed = []
+        completed = 0
+        semaphore = asyncio.Semaphore(self.__maxConcurrency)
+
+        async def play(buyer, seller):
+            async with semaphore:
+                try:
+                    return buyer, seller, await self._aplay(buyer, seller), None
+                except Exception as e:
+                    return buyer, seller, None, e
+
+        writer = SessionWriter(self.__savePath, self._written).start()
+        try:
+            for task in asyncio.as_completed([play(buyer, seller) for buyer, seller in pairings]):
+                buyer, seller, session, error = await task
+                if error is not None:
+                    self._failed(buyer, seller, error)
+                    failed.append((buyer, seller))
+                    continue
+                writer.put(session)
+                completed += 1
+                print(buyer, " vs ", seller)
+                print("COMPLETED : " + str(completed) + "/" + str(len(pairings)))
+        finally:
+            writer.close()
+
+        return {"completed": completed, "failed": failed}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run or resume a tournament sweep.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="start a new sweep")
+    run.add_argument("scenario", help="scenario file, e.g. DealingProblem/Context/Scenario1.json")
+    run.add_argument("save", help="history file of the sessions, e.g. DealingProblem/Sessions_llama/Session1_NA.json")
+    run.add_argument("--client", default="LLamaLLM", help="LLM class of the agents (GemmaLLM, LLamaLLM, MockLLM)")
+    run.add_argument("--model", default=None)
+    run.add_argument("--evaluator", default=None,
+                     help="LLM class of the validators, of the HI/DI evaluators and of the evaluation, e.g. MockLLM")
+    run.add_argument("--json", action="store_true", help="JSON mode")
+    run.add_argument("--rounds", type=int, default=10)
+    run.add_argument("--no-evaluate", action="store_true")
+    run.add_argument("--early-stop", action="store_true", help="use the default termination policy")
+    run.add_argument("--context", default=None,
+                     help="context policy of the agents: full, last-k[:K], offer-digest[:K] or rolling-summary[:K]")
+    resume = commands.add_parser("resume", help="resume an interrupted sweep")
+    resume.add_argument("manifest", help="directory of the sweep, e.g. DealingProblem/Sessions_llama/Session1_NA.sweep")
+    for command in (run, resume):
+        command.add_argument("--workers", type=int, default=8)
+        command.add_argument("--async", dest="asynchronous", action="store_true", help="use the async clients")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        client = Tournament.llmClass(args.client)
+        if args.model is not None:
+            client = client(args.model)
+        tournament = Tournament(
+            args.scenario, client, args.save, maxConcurrency=args.workers, isJSON=args.json,
+            maxRounds=args.rounds, evaluate=not args.no_evaluate,
+            terminationPolicy=default_policy() if args.early_stop else None, contextPolicy=args.context,
+            evaluator=Tournament.llmClass(args.evaluator) if args.evaluator is not None else None
+        )
+    else:
+        tournament = Tournament.fromManifest(args.manifest, maxConcurrency=args.workers)
+
+    resuming = args.command == "resume"
+    print(asyncio.run(tournament.arun(resuming)) if args.asynchronous else tournament.run(resuming))
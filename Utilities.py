@@ -1,20 +1,20 @@
-import re
-import spacy
+import threading
 from collections import defaultdict
-import json
+
+from JSONExtractor import JSONExtractor
 
 class Utilities:
-    _nlp = spacy.load("en_core_web_sm")
+    _nlp = None
+    _nlpLock = threading.Lock()
+    _tokenCounts = {}
+    _tokenCountsLock = threading.Lock()
+    _TOKEN_COUNTS_SIZE = 200000
     
     # It computes the average message length in terms of number of tokens (only alphabetic tokens are considered) for a list of messages.
     # It is based on the linguistic-based tokenizer spacy
     @staticmethod
     def avg_msg_length(documents: list[str]) -> float:
-        total_length = 0
-
-        for text in documents:
-            doc = Utilities._nlp(text)
-            total_length += len(list(token.lemma_.lower() for token in doc if token.is_alpha))
+        total_length = sum(Utilities.token_counts(documents))
 
         avg_length = (total_length / len(documents)) if len(documents) > 0 else 0.0
         return round(avg_length, 4)
@@ -23,26 +23,49 @@ class Utilities:
     # It is based on the linguistic-based tokenizer spacy
     @staticmethod
     def total_number_of_tokens(documents: list[str]) -> int:
-        total_tokens = 0
+        return sum(Utilities.token_counts(documents))
 
-        for text in documents:
-            doc = Utilities._nlp(text)
-            total_tokens += len(list(token.lemma_.lower() for token in doc if token.is_alpha))
+    # It returns the spacy model, loading it the first time it is needed (loading it costs seconds and hundreds of MB).
+    @staticmethod
+    def _get_nlp():
+        if Utilities._nlp is None:
+            with Utilities._nlpLock:
+                if Utilities._nlp is None:
+                    import spacy
+                    Utilities._nlp = spacy.load("en_core_web_sm")
+        return Utilities._nlp
 
-        return total_tokens
+    # It returns the number of alphabetic tokens of each document.
+    # The documents are processed in batches with nlp.pipe, and the counts are memoized by text,
+    # so the same message is tokenized only once (e.g. when analysing many sessions).
+    # Only the tokenizer is needed to find the alphabetic tokens, so all the pipeline components
+    # (tagger, parser, NER, lemmatizer...) are disabled. n_process > 1 uses multiple processes.
+    # The memoized counts are copied under the lock, since another thread can clear the memo at any time.
+    @staticmethod
+    def token_counts(documents: list[str], n_process: int = 1, batch_size: int = 256) -> list[int]:
+        texts = dict.fromkeys(documents)
+        with Utilities._tokenCountsLock:
+            counts = {text: Utilities._tokenCounts[text] for text in texts if text in Utilities._tokenCounts}
+        missing = [text for text in texts if text not in counts]
+        if len(missing) > 0:
+            nlp = Utilities._get_nlp()
+            docs = nlp.pipe(missing, disable=nlp.pipe_names, n_process=n_process, batch_size=batch_size)
+            computed = {text: sum(1 for token in doc if token.is_alpha) for text, doc in zip(missing, docs)}
+            with Utilities._tokenCountsLock:
+                if len(Utilities._tokenCounts) + len(computed) > Utilities._TOKEN_COUNTS_SIZE:
+                    Utilities._tokenCounts.clear()
+                Utilities._tokenCounts.update(computed)
+            counts.update(computed)
 
+        return [counts[text] for text in documents]
+
+    # It extracts the JSON object of an LLM response with a single pass over the text (see JSONExtractor):
+    # the first valid object or, if the expected keys are given, the object with most of them.
+    # If there is no valid object it returns a failure, {"Result": "ERROR", "Error": ..., "Reason": ...}.
     @staticmethod
-    def extract_json(text):
-        try:
-            match = re.search(r'(\{.*\})', text, re.DOTALL)
-
-            if match:
-                json_str = match.group(1)
-                return json.loads(json_str)
-                
-        except (json.JSONDecodeError, Exception) as e:
-            return {"Result": "ERROR", "Error": str(e)}
-        
+    def extract_json(text, keys=None):
+        return JSONExtractor.extract(text, keys)
+
 
     @staticmethod
     def safe_float(val, default=float('nan')):
@@ -1,4 +1,5 @@
 import re
+import threading
 import time
 import json
 
@@ -6,27 +7,90 @@ from abc import ABC, abstractmethod
 from Actor import Actor
 from LLM import GemmaLLM, LLM_Evaluator
 from Utilities import Utilities
+from Formatter import PromptCache
+from Telemetry import Telemetry
 
 # The Validator class represents the validator module of an agent.
 # It is responsible for evaluating the agent's response and providing feedback to the actor module.
+# Before asking the LLM to format a response, it tries to format it locally (fast path):
+# a JSON response or a natural response with a single clear marker ("My counteroffer is $X", "Done Deal",
+# "I refuse to ...") is formatted without any API call. Only the phrasing of the validator rules is read as an offer
+# of the speaker: any other mention of a counteroffer (e.g. "your counteroffer of $400") goes to the LLM. The counters of the fast path are kept per validator
+# and in total for all the validators (see getFastPathStats and fastPathStats).
 class Validator():
-    def __init__(self, description, client = LLM_Evaluator):
+    _COUNTER_OFFER = re.compile(r"\bmy\s+counter[- ]?offer\s+is\s*:?\s*\$?\s*(\d[\d,]*(?:\.\d+)?)", re.IGNORECASE)
+    _COUNTER_OFFER_MENTION = re.compile(r"counter[- ]?offer", re.IGNORECASE)
+    _DEAL = re.compile(r"\bdone deal\b", re.IGNORECASE)
+    _REFUSAL = re.compile(r"\bi refuse to (?:buy|sell)\b", re.IGNORECASE)
+    _AMBIGUOUS = re.compile(r"\b(?:deal|agree|agreed|accept|accepted|refuse|decline|counter[- ]?offer)\b", re.IGNORECASE)
+    _PRICE = re.compile(r"\$\s*(\d[\d,]*(?:\.\d+)?)")
+    _MESSAGE_TYPES = {"message", "counter-offer", "deal", "refusal"}
+
+    _fastPathLock = threading.Lock()
+    _fastPathTotals = {"local": 0, "llm": 0}
+
+    def __init__(self, description, client = LLM_Evaluator, fastPath: bool = True):
         self.__description = description
+        self.__fastPath = fastPath
+        self.localHits = 0
+        self.llmFallbacks = 0
         self._actualBuyerOffer = -float('inf')
         self._actualSellerOffer = float('inf')
+        self._offerTrajectory = []
         self.client = client
         self.__description = description
         self.__formatter = self.client.get_formatter()
+        self.__promptCache = PromptCache(self.__formatter)
+        self.__contextPolicy = None
+        self.__ruleMessage = self.__formatter.ruleMessage(
+            self.getDescription()["init"] + "\n".join(self.getDescription()["rules"])
+        )
         return
 
 
     def getDescription(self):
         return self.__description
     
+    # It returns the offers seen by the validator, one entry per evaluated message:
+    # the type of the message, the offers in it (NaN if it is not a counter-offer), the evaluation,
+    # and the best buyer and seller offers accepted so far.
+    def getOfferTrajectory(self) -> list:
+        return self._offerTrajectory
+
+    def resetTrajectory(self):
+        self._offerTrajectory = []
+
+    # The state of the validator, saved in the checkpoints of a sweep: the best offers and the offer trajectory.
+    def getState(self) -> dict:
+        return {
+            "actualBuyerOffer": self._actualBuyerOffer,
+            "actualSellerOffer": self._actualSellerOffer,
+            "offerTrajectory": list(self._offerTrajectory),
+        }
+
+    def setState(self, state: dict):
+        self._actualBuyerOffer = state["actualBuyerOffer"]
+        self._actualSellerOffer = state["actualSellerOffer"]
+        self._offerTrajectory = list(state["offerTrajectory"])
+        return self
+
     # It receves a JSON formatted message and evaluates it according to the validator rules
     # It returns a JSON formatted evaluation that contains at least a field "MessageType" that can be "VALID", "INVALID", "DEAL" or "REFUSAL".
     # The "INVALID" type must also contain a field "Hint" that explains why the message is invalid and how to fix it.
+    # The evaluated offers are added to the offer trajectory.
     def evaluateFormattedMessage(self, JSONMessage):
+        evaluation = self._evaluateFormattedMessage(JSONMessage)
+        self._offerTrajectory.append({
+            "type": JSONMessage.get("MessageType", "").lower(),
+            "buyer": Utilities.safe_float(JSONMessage.get("buyer", 'nan')),
+            "seller": Utilities.safe_float(JSONMessage.get("seller", 'nan')),
+            "evaluation": evaluation.get("MessageType", "") if evaluation is not None else "",
+            "actualBuyerOffer": self._actualBuyerOffer,
+            "actualSellerOffer": self._actualSellerOffer,
+        })
+        return evaluation
+
+    def _evaluateFormattedMessage(self, JSONMessage):
         messagetype = JSONMessage.get("MessageType", "").lower()
 
         if messagetype == "message":
@@ -86,14 +150,192 @@ class Validator():
 
     # It receives the history of the negotiation and ask the underlying LLM to write an analysis in structured language    
     def formatResponse(self, history, lastMessage):
-        newHistory = [self.__formatter.userMessage(msg['text']) for msg in history]
-        newHistory.append(self.__formatter.userMessage(lastMessage))
+        local = self._formatLocally(history, lastMessage)
+        if local is not None:
+            return local
+        with Telemetry.caller(Telemetry.VALIDATOR):
+            clientResponse = self.client.generate(self._buildPrompt(history, lastMessage))
+        return Utilities.extract_json(clientResponse, keys=("MessageType",))
+
+    # Async version of formatResponse.
+    async def aformatResponse(self, history, lastMessage):
+        local = self._formatLocally(history, lastMessage)
+        if local is not None:
+            return local
+        with Telemetry.caller(Telemetry.VALIDATOR):
+            clientResponse = await self.client.agenerate(await self._abuildPrompt(history, lastMessage))
+        return Utilities.extract_json(clientResponse, keys=("MessageType",))
+
+    # With a context policy only a part of the history is sent to the LLM (see ContextPolicy).
+    # The fast path still reads the whole history.
+    def set_context_policy(self, policy):
+        self.__contextPolicy = policy
+        return self
+
+    def getFastPathStats(self) -> dict:
+        return Validator._hitRate(self.localHits, self.llmFallbacks)
+
+    # Counters of the fast path of all the validators.
+    @staticmethod
+    def fastPathStats() -> dict:
+        return Validator._hitRate(Validator._fastPathTotals["local"], Validator._fastPathTotals["llm"])
+
+    @staticmethod
+    def _hitRate(local, llm) -> dict:
+        total = local + llm
+        return {"local": local, "llm": llm, "hit_rate": local / total if total > 0 else float('nan')}
+
+    # It formats the last message without the LLM, in the same JSON the LLM would write.
+    # It returns None if the message is ambiguous, so that the LLM is asked instead.
+    def _formatLocally(self, history, lastMessage):
+        formatted = None
+        if self.__fastPath:
+            formatted = self._parseJSONMessage(history, lastMessage)
+            if formatted is None:
+                formatted = self._parseNaturalMessage(history, lastMessage)
+
+        with Validator._fastPathLock:
+            if formatted is not None:
+                self.localHits += 1
+                Validator._fastPathTotals["local"] += 1
+            else:
+                self.llmFallbacks += 1
+                Validator._fastPathTotals["llm"] += 1
+        return formatted
+
+    # A response of a JSON agent is already a JSON message, only the offer of the other agent has to be added.
+    def _parseJSONMessage(self, history, lastMessage):
+        text = lastMessage.strip()
+        if not text.startswith("{"):
+            return None
+        try:
+            message = json.loads(text)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(message, dict):
+            return None
+
+        messageType = str(message.get("MessageType", "")).lower()
+        if messageType not in Validator._MESSAGE_TYPES:
+            return None
+        if messageType != "counter-offer":
+            return {"MessageType": messageType}
+
+        ownOffer = Utilities.safe_float(message.get(self._ownKey(), 'nan'))
+        if ownOffer != ownOffer:
+            return None
+        return self._counterOffer(history, ownOffer)
+
+    # A response of a natural agent is formatted only if it contains exactly one of:
+    # a single counter-offer ("My counteroffer is $X"), "Done Deal" or "I refuse to buy/sell".
+    # Without any of them it is a plain message, unless it talks about deals, agreements or offers in other words.
+    def _parseNaturalMessage(self, history, lastMessage):
+        offers = Validator._ownOffers(lastMessage)
+        if offers is None:
+            return None
+        deal = Validator._DEAL.search(lastMessage) is not None
+        refusal = Validator._REFUSAL.search(lastMessage) is not None
+
+        if len(offers) + deal + refusal > 1:
+            return None
+        if deal:
+            return {"MessageType": "deal"}
+        if refusal:
+            return {"MessageType": "refusal"}
+        if len(offers) == 1:
+            ownOffer = offers.pop()
+            return self._counterOffer(history, ownOffer) if ownOffer == ownOffer else None
+        if Validator._AMBIGUOUS.search(lastMessage) is not None:
+            return None
+        return {"MessageType": "message"}
+
+    def _counterOffer(self, history, ownOffer):
+        otherOffer = self._lastOtherOffer(history)
+        if otherOffer is None:
+            return None
+        offers = {self._ownKey(): ownOffer, self._otherKey(): otherOffer}
+        return {
+            "MessageType": "counter-offer",
+            "buyer": Validator._formatPrice(offers["buyer"]),
+            "seller": Validator._formatPrice(offers["seller"])
+        }
 
-        rules = self.getDescription()["init"] + "\n".join(self.getDescription()["rules"])
-        newHistory.append(self.__formatter.ruleMessage(rules))
+    # It finds the last offer of the other agent in the history.
+    # If the other agent hasn't made any offer yet, the buyer validator uses the initial price of the scenario
+    # and the seller validator uses 0, as the validator rules ask.
+    def _lastOtherOffer(self, history):
+        other = self._otherKey()
+        for message in reversed(history[1:]):
+            if message['role'].lower() != other:
+                continue
+            text = message['text'].split(" : ", 1)[-1].strip()
+            if text.startswith("{"):
+                try:
+                    offer = Utilities.safe_float(json.loads(text).get(other, 'nan'))
+                    if offer == offer:
+                        return offer
+                    continue
+                except (json.JSONDecodeError, AttributeError):
+                    pass
+            offers = Validator._ownOffers(text)
+            if offers is None or len(offers) > 1:
+                return None
+            if len(offers) == 1:
+                offer = offers.pop()
+                return offer if offer == offer else None
 
-        clientResponse = self.client.generate(newHistory)
-        return Utilities.extract_json(clientResponse)
+        if other == "buyer":
+            return 0.0
+        prices = Validator._PRICE.findall(history[0]['text']) if len(history) > 0 else []
+        if len(prices) != 1:
+            return None
+        return Utilities.safe_float(prices[0].replace(",", ""), None)
+
+    # The offers made by the speaker of a natural message ("My counteroffer is $X"),
+    # or None if the message mentions counteroffers in other words (e.g. quoting the offer of the other agent).
+    @staticmethod
+    def _ownOffers(text: str):
+        matches = Validator._COUNTER_OFFER.findall(text)
+        if len(Validator._COUNTER_OFFER_MENTION.findall(text)) != len(matches):
+            return None
+        return {Utilities.safe_float(offer.replace(",", "")) for offer in matches}
+
+    def _ownKey(self) -> str:
+        return self.__description['type'].lower()
+
+    def _otherKey(self) -> str:
+        return "seller" if self._ownKey() == "buyer" else "buyer"
+
+    @staticmethod
+    def _formatPrice(price: float) -> str:
+        return str(int(price)) if price == int(price) else str(price)
+
+    # Only the new messages of the history are formatted at every turn (see PromptCache), and the rules are formatted once.
+    # With the "prefix" layout of the client (see LLM.set_layout) the rules come before the history.
+    def _buildPrompt(self, history, lastMessage) -> list:
+        formatted = self.__promptCache.format(history)
+        if self.__contextPolicy is not None:
+            formatted = self.__contextPolicy.select(history, formatted, self.__formatter, self)
+        return self._layout(formatted, lastMessage)
+
+    async def _abuildPrompt(self, history, lastMessage) -> list:
+        formatted = self.__promptCache.format(history)
+        if self.__contextPolicy is not None:
+            formatted = await self.__contextPolicy.aselect(history, formatted, self.__formatter, self)
+        return self._layout(formatted, lastMessage)
+
+    def _layout(self, formatted: list, lastMessage) -> list:
+        if self.client.getLayout() == "prefix":
+            return [
+                self.__ruleMessage,
+                *formatted,
+                self.__formatter.userMessage(lastMessage)
+            ]
+        return [
+            *formatted,
+            self.__formatter.userMessage(lastMessage),
+            self.__ruleMessage
+        ]
 
 
 # NonReflexiveValidator is the validator that always return valid for any message that is not a deal, and deal for any message that is a deal. 
@@ -112,5 +354,8 @@ class NonReflexiveValidator(Validator):
         except:
             print("Failed to parse JSON from validator response: " + lastMessage)
             return None
+
+    async def aformatResponse(self, history, lastMessage):
+        return self.formatResponse(history, lastMessage)
         
 
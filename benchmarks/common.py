@@ -0,0 +1,158 @@
+import json
+import os
+import statistics
+import sys
+import timeit
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+BASELINES = ROOT / "benchmarks" / "baselines"
+
+# The benchmarks import the modules of the project from the root of the repository,
+# and read the data files (DealingProblem/...) relative to it.
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
+
+
+CALIBRATION = "_calibration"
+
+
+# It times fn, as timeit does: the number of calls per run is calibrated to last at least 0.2s,
+# and the result is the time per call of the best and of the median of repeat runs.
+# The time is CPU bound, so it is compared with the baseline at the speed of the machine (see calibrate).
+def bench(fn, repeat: int = 5, number: int = None) -> dict:
+    timer = timeit.Timer(fn)
+    if number is None:
+        number, _ = timer.autorange()
+    runs = [elapsed / number for elapsed in timer.repeat(repeat=repeat, number=number)]
+    return cpu({"value": min(runs), "median": statistics.median(runs), "unit": "s", "better": "lower", "calls": number})
+
+
+# It marks a metric as CPU bound: its baseline is scaled by the speed of the machine before the comparison.
+def cpu(metric: dict) -> dict:
+    return {**metric, "cpu": True}
+
+
+# The time of a fixed CPU bound workload (JSON and string processing, as in the hot paths of the project).
+# It is stored in the baselines: the CPU bound metrics are compared with their baseline scaled by the ratio of
+# the calibrations, so a baseline recorded on another machine (or on a throttled one) doesn't give false regressions.
+def calibrate() -> dict:
+    messages = [{"role": "buyer", "text": f"buyer : My counteroffer is ${i}. " * 8} for i in range(200)]
+    return bench(lambda: [json.loads(json.dumps(message)).get("text", "").split() for message in messages], repeat=7)
+
+
+# A metric for which a higher value is better (e.g. a throughput).
+def rate(value: float, unit: str) -> dict:
+    return {"value": value, "unit": unit, "better": "higher"}
+
+
+# A metric for which a lower value is better, that is not a time (e.g. a number of tokens).
+def amount(value: float, unit: str) -> dict:
+    return {"value": value, "unit": unit, "better": "lower"}
+
+
+# It runs the benchmarks (name -> function returning a metric), recording the error of the failed ones.
+def run_all(benchmarks: dict, only: list = None) -> dict:
+    results = {}
+    for name, benchmark in benchmarks.items():
+        if only and not any(pattern in name for pattern in only):
+            continue
+        try:
+            results[name] = benchmark()
+        except Exception as e:
+            results[name] = {"error": f"{type(e).__name__}: {e}"}
+        print(f"{name:45s} {format_metric(results[name])}")
+    return results
+
+
+def format_metric(metric: dict) -> str:
+    if "error" in metric:
+        return "ERROR " + metric["error"]
+    if metric["unit"] == "s":
+        return f"{metric['value'] * 1e6:12.1f} us"
+    return f"{metric['value']:12.1f} {metric['unit']}"
+
+
+# It compares the results with a baseline, and returns the metrics that got worse by more than tolerance.
+# speed is the time of the calibration now over its time in the baseline (see calibrate).
+def compare(results: dict, baseline: dict, tolerance: float = 0.2, speed: float = 1.0) -> list:
+    regressions = []
+    for name, metric in results.items():
+        reference = baseline.get(name)
+        if reference is None or "error" in metric or "error" in reference:
+            continue
+        expected = reference["value"]
+        if metric.get("cpu"):
+            expected = expected * speed if metric["better"] == "lower" else expected / speed
+        worse, better = (metric["value"], expected) if metric["better"] == "lower" else (expected, metric["value"])
+        # A metric that was 0 (e.g. the heavy modules of an import) regresses as soon as it grows.
+        if better <= 0:
+            change = float('inf') if worse > better else 0.0
+        else:
+            change = worse / better - 1
+        if change > tolerance:
+            regressions.append({"name": name, "baseline": expected, "value": metric["value"],
+                                "change": round(change, 3)})
+    return regressions
+
+
+def load_baseline(name: str) -> dict:
+    path = BASELINES / f"{name}.json"
+    if not path.exists():
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_baseline(name: str, results: dict):
+    BASELINES.mkdir(parents=True, exist_ok=True)
+    with open(BASELINES / f"{name}.json", "w") as f:
+        json.dump(results, f, indent=4)
+
+
+# The common command line of the benchmarks: run (a subset of) the suite, compare it with the baseline,
+# and update the baseline. The exit code is 1 if a metric regressed.
+# In CI mode (--ci, or the CI environment variable set, as the CI services do) the exit code is also 1
+# if the baseline is missing, if a metric has no baseline or if a benchmark failed, so the suite can't pass
+# without checking anything.
+def main(name: str, benchmarks: dict, args) -> int:
+    # The best of a calibration before and one after the benchmarks, since the speed of a shared machine varies
+    calibration = calibrate()
+    results = run_all(benchmarks, args.only)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=4)
+    calibration = min(calibration, calibrate(), key=lambda metric: metric["value"])
+    if args.update:
+        save_baseline(name, {**load_baseline(name), **results, CALIBRATION: calibration})
+        print(f"Baseline benchmarks/baselines/{name}.json updated")
+        return 0
+
+    baseline = load_baseline(name)
+    if not baseline:
+        print(f"No baseline for {name}: run with --update to create it")
+        return 1 if args.ci else 0
+    speed = calibration["value"] / baseline[CALIBRATION]["value"] if CALIBRATION in baseline else 1.0
+    print(f"Machine speed with respect to the baseline: {1 / speed:.2f}x")
+    regressions = compare(results, baseline, args.tolerance, speed)
+    for regression in regressions:
+        print(f"REGRESSION {regression['name']}: {regression['baseline']:.6g} -> {regression['value']:.6g} "
+              f"(+{regression['change'] * 100:.0f}%)")
+    if not args.ci:
+        return 1 if regressions else 0
+
+    unchecked = [metric for metric in results if metric not in baseline or "error" in results[metric]]
+    for metric in unchecked:
+        print(f"UNCHECKED {metric}: " + (results[metric]["error"] if "error" in results[metric] else "no baseline"))
+    return 1 if regressions or unchecked else 0
+
+
+def add_arguments(parser):
+    parser.add_argument("--only", nargs="*", help="run only the benchmarks whose name contains one of these")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--update", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before a regression")
+    parser.add_argument("--ci", action="store_true", default=bool(os.environ.get("CI")),
+                        help="fail if the baseline or the baseline of a metric is missing, or if a benchmark fails")
+    return parser
@@ -0,0 +1,227 @@
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+from common import ROOT, add_arguments, bench, main
+
+from Actor import Actor
+from Arena import Arena
+from ConfigRegistry import ConfigRegistry
+from LLM import LLM
+from MockLLM import MockLLM
+from SessionStore import SessionStore
+from Telemetry import Telemetry
+from Utilities import Utilities
+from Validator import Validator
+
+# The session file used by the benchmarks: one of the largest histories of the corpus (about 4k lines).
+SESSION_FILE = ROOT / "DealingProblem" / "Sessions_Gemma_27b" / "Session1_JSA.json"
+SCENARIO_FILE = ROOT / "DealingProblem" / "Context" / "Scenario1.json"
+STORE_SIZES = [10, 100, 1000]
+
+
+def _corpus() -> dict:
+    with open(SESSION_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# A history of the corpus with its context message, as the Arena builds it.
+def _history(corpus: dict, messages: int = 20) -> list:
+    longest = max(corpus["sessions"], key=lambda session: len(session["history"]))
+    return [{"role": "seller", "text": corpus["scenario"]}, *longest["history"][:messages]]
+
+
+# Prompt formatting of Actor.ask: the whole history formatted from scratch (the first turn of an actor,
+# or an actor that sees a new history) and the incremental formatting of one new message.
+def actor_benchmarks(corpus: dict) -> dict:
+    scenario = ConfigRegistry.scenario(str(SCENARIO_FILE))
+    history = _history(corpus)
+
+    def cold():
+        Actor(ConfigRegistry.thaw(scenario["buyers"][0]), MockLLM)._buildPrompt(history)
+
+    actor = Actor(ConfigRegistry.thaw(scenario["buyers"][0]), MockLLM)
+    growing = list(history[:1])
+
+    def incremental():
+        if len(growing) == len(history):
+            del growing[1:]
+        growing.append(history[len(growing)])
+        actor._buildPrompt(growing)
+
+    MockLLM.configure()
+    return {
+        "actor.format_history_20": lambda: bench(cold),
+        "actor.format_incremental": lambda: bench(incremental),
+        "actor.ask_mock": lambda: bench(lambda: actor.ask(history)),
+    }
+
+
+# Validator.evaluateFormattedMessage on a negotiation of 20 counter-offers that converge,
+# and the local formatting of the natural language messages of the corpus.
+def validator_benchmarks(corpus: dict) -> dict:
+    rules = ConfigRegistry.rules()
+    offers = [
+        {"MessageType": "counter-offer", "buyer": str(300 + 10 * i), "seller": str(600 - 10 * i)} for i in range(20)
+    ]
+
+    def evaluate():
+        validator = Validator(rules["Buyer"], client=MockLLM)
+        for offer in offers:
+            validator.evaluateFormattedMessage(offer)
+
+    history = _history(corpus)
+    validator = Validator(rules["Buyer"], client=MockLLM)
+    lastMessages = [message["text"][len("Buyer : "):] for message in history[1:] if message["role"] == "Buyer"]
+
+    def formatLocally():
+        for message in lastMessages:
+            validator._formatLocally(history, message)
+
+    return {
+        "validator.evaluate_20_offers": lambda: bench(evaluate),
+        "validator.format_locally": lambda: bench(formatLocally),
+    }
+
+
+# Utilities.extract_json on the JSON messages of the corpus (wrapped in text as the LLM answers are),
+# and Utilities.avg_msg_length with and without the memoized token counts.
+def utilities_benchmarks(corpus: dict) -> dict:
+    texts = [message["text"].split(" : ", 1)[-1] for session in corpus["sessions"] for message in session["history"]]
+    answers = [f"Here is the analysis:\n{text}\nI hope it helps." for text in texts if "{" in text][:500]
+    messages = texts[:500]
+
+    def cold():
+        Utilities._tokenCounts.clear()
+        Utilities.avg_msg_length(messages)
+
+    return {
+        "utilities.extract_json_500": lambda: bench(lambda: [Utilities.extract_json(answer) for answer in answers]),
+        "utilities.avg_msg_length_500_cold": lambda: bench(cold, repeat=3),
+        "utilities.avg_msg_length_500_memoized": lambda: bench(lambda: Utilities.avg_msg_length(messages)),
+    }
+
+
+# A validator call with its output profile (at most 128 tokens, stopped at the JSON object) and with the
+# default one (512 tokens), on a mock that writes 400 characters after its answer at 5ms per token.
+def profile_benchmarks() -> dict:
+    messages = [{"role": "system", "content": "PRIORITY RULES"}, {"role": "user", "content": "Buyer : I offer $300"}]
+
+    def call(profile: dict):
+        MockLLM.configure(tokenLatency=0.005, chatter=400)
+        saved = LLM._profiles.get(Telemetry.VALIDATOR)
+        LLM._profiles[Telemetry.VALIDATOR] = profile
+        try:
+            with Telemetry.caller(Telemetry.VALIDATOR):
+                return bench(lambda: MockLLM.generate(messages), repeat=3)
+        finally:
+            LLM._profiles[Telemetry.VALIDATOR] = saved
+            MockLLM.configure()
+
+    return {
+        "llm.validator_stop_at_json": lambda: call(LLM._profiles[Telemetry.VALIDATOR]),
+        "llm.validator_default_profile": lambda: call(LLM._defaultProfile),
+    }
+
+
+# Arena.save_history (Arena.write_session) on history files that already have n sessions,
+# and the export of the JSON file of the notebooks.
+def store_benchmarks(corpus: dict) -> dict:
+    template = corpus["sessions"][0]
+    benchmarks = {}
+
+    def filled(size: int) -> tuple[Path, str]:
+        directory = Path(tempfile.mkdtemp())
+        path = str(directory / f"Session_{size}.json")
+        store = SessionStore(path, sync=False)
+        for id in range(size):
+            store.put({**template, "id": id, "scenario": corpus["scenario"]})
+        return directory, path
+
+    def save(size: int):
+        directory, path = filled(size)
+        ids = iter(range(size, 10 ** 9))
+        try:
+            return bench(lambda: Arena.write_session(path, {**template, "id": next(ids), "scenario": corpus["scenario"]}),
+                         number=50)
+        finally:
+            shutil.rmtree(directory)
+
+    def export(size: int):
+        directory, path = filled(size)
+        try:
+            return bench(lambda: Arena.export_history(path), repeat=3, number=1)
+        finally:
+            shutil.rmtree(directory)
+
+    for size in STORE_SIZES:
+        benchmarks[f"arena.save_history_{size}"] = lambda size=size: save(size)
+        benchmarks[f"arena.export_history_{size}"] = lambda size=size: export(size)
+    return benchmarks
+
+
+# Loading the session files: the JSON file, the session log of the store (first open, with the import
+# of the JSON file, and a rescan) and the columnar tables of the analytics.
+def loading_benchmarks() -> dict:
+    def loadJSON():
+        with open(SESSION_FILE, "r", encoding="utf-8") as f:
+            json.load(f)
+
+    def openStore():
+        directory = Path(tempfile.mkdtemp())
+        shutil.copy(SESSION_FILE, directory / SESSION_FILE.name)
+        try:
+            return bench(lambda: SessionStore(str(directory / SESSION_FILE.name)), repeat=3)
+        finally:
+            shutil.rmtree(directory)
+
+    def importStore():
+        directory = Path(tempfile.mkdtemp())
+        path = directory / SESSION_FILE.name
+        shutil.copy(SESSION_FILE, path)
+
+        def fresh():
+            path.with_suffix(".jsonl").unlink(missing_ok=True)
+            SessionStore(str(path))
+        try:
+            return bench(fresh, repeat=3)
+        finally:
+            shutil.rmtree(directory)
+
+    def analytics(refresh: bool):
+        from SessionAnalytics import SessionAnalytics
+        cache = tempfile.mkdtemp()
+        try:
+            SessionAnalytics.load(str(ROOT / "DealingProblem"), cacheDir=cache)
+            return bench(lambda: SessionAnalytics.load(str(ROOT / "DealingProblem"), cacheDir=cache, refresh=refresh),
+                         repeat=3, number=1)
+        finally:
+            shutil.rmtree(cache)
+
+    return {
+        "loading.json_session_file": lambda: bench(loadJSON, repeat=3),
+        "loading.session_store_import": importStore,
+        "loading.session_store_scan": openStore,
+        "loading.analytics_rebuild": lambda: analytics(True),
+        "loading.analytics_cached": lambda: analytics(False),
+    }
+
+
+def benchmarks() -> dict:
+    corpus = _corpus()
+    return {
+        **actor_benchmarks(corpus),
+        **validator_benchmarks(corpus),
+        **utilities_benchmarks(corpus),
+        **profile_benchmarks(),
+        **store_benchmarks(corpus),
+        **loading_benchmarks(),
+    }
+
+
+if __name__ == "__main__":
+    parser = add_arguments(argparse.ArgumentParser(description="Microbenchmarks of the hot paths."))
+    sys.exit(main("components", benchmarks(), parser.parse_args()))
@@ -0,0 +1,67 @@
+import argparse
+import sys
+import tempfile
+from pathlib import Path
+
+from common import ROOT, add_arguments, amount, main, rate
+
+from ConfigRegistry import ConfigRegistry
+from MockLLM import MockLLM
+from Telemetry import Telemetry
+from Tournament import Tournament
+
+SCENARIO_FILE = str(ROOT / "DealingProblem" / "Context" / "Scenario1.json")
+CALLERS = (Telemetry.ACTOR, Telemetry.VALIDATOR, Telemetry.SUMMARY)
+POLICIES = (None, "last-k:4", "offer-digest:2", "rolling-summary:4")
+
+
+# It plays long mock negotiations (the agents concede little at every turn) with a context policy, and returns
+# the input tokens per session of the actor, validator and summary calls and the tokens saved per session
+# recorded by the policies in the sessions.
+def context(spec, sessions: int, maxRounds: int, concession: float) -> dict:
+    MockLLM.configure(concession=(concession / 2, concession))
+    scenario = ConfigRegistry.scenario(SCENARIO_FILE)
+    pairings = [(buyer['name'], seller['name']) for buyer in scenario['buyers'] for seller in scenario['sellers']]
+    savePath = str(Path(tempfile.mkdtemp()) / "ContextPolicy.json")
+    Telemetry.reset()
+    saved = 0
+    for i in range(sessions):
+        arena = Tournament.buildArena(SCENARIO_FILE, MockLLM, *pairings[i % len(pairings)], i % 2 == 1, False, savePath,
+                                      False, spec)
+        arena.negotiate(maxRounds=maxRounds, save=False)
+        saved += sum(stats["savedTokens"] for stats in arena.build_session(False).get("context", {}).values())
+    inputTokens = sum(record["input_tokens"] for record in Telemetry.records() if record["caller"] in CALLERS)
+    name = spec.split(":")[0] if spec is not None else "none"
+    return {
+        f"context.{name}.input_tokens": amount(inputTokens / sessions, "tokens/session"),
+        f"context.{name}.saved_tokens": rate(saved / sessions, "tokens/session"),
+    }
+
+
+# The metrics of a policy come from the same sessions, played once when the first of them is run.
+def benchmarks(sessions: int, maxRounds: int, concession: float) -> dict:
+    results = {}
+    for spec in POLICIES:
+        metrics = {}
+        name = spec.split(":")[0] if spec is not None else "none"
+
+        def measure(key: str, spec=spec, metrics=metrics) -> dict:
+            if not metrics:
+                metrics.update(context(spec, sessions, maxRounds, concession))
+            return metrics[key]
+        for metric in ("input_tokens", "saved_tokens") if spec is not None else ("input_tokens",):
+            key = f"context.{name}.{metric}"
+            results[key] = lambda key=key, measure=measure: measure(key)
+    return results
+
+
+if __name__ == "__main__":
+    parser = add_arguments(argparse.ArgumentParser(
+        description="Input tokens per session of long mock negotiations with the context policies."
+    ))
+    parser.add_argument("--sessions", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=30)
+    parser.add_argument("--concession", type=float, default=0.06,
+                        help="largest fraction of the gap conceded by a mock agent at every turn")
+    args = parser.parse_args()
+    sys.exit(main("context_policy", benchmarks(args.sessions, args.rounds, args.concession), args))
@@ -0,0 +1,79 @@
+import argparse
+import json
+import re
+import sys
+
+from common import ROOT, add_arguments, bench, main, rate
+
+from Utilities import Utilities
+
+
+# The extractor used before the JSONExtractor: a greedy regex from the first "{" to the last "}".
+def greedy(text):
+    try:
+        match = re.search(r'(\{.*\})', text, re.DOTALL)
+        if match:
+            return json.loads(match.group(1))
+    except (json.JSONDecodeError, Exception) as e:
+        return {"Result": "ERROR", "Error": str(e)}
+
+
+# The JSON messages of the stored sessions (the JSON mode, *_JSA.json), and the same messages
+# in the shapes in which the LLMs often answer: with text around, with a second object, in a code fence,
+# after many braces that are never closed.
+def responses() -> dict:
+    messages = []
+    for path in sorted(ROOT.glob("DealingProblem/Sessions_*/Session*_JSA.json")):
+        with open(path, "r", encoding="utf-8") as f:
+            for session in json.load(f)["sessions"]:
+                for message in session["history"]:
+                    text = message["text"].split(" : ", 1)[-1]
+                    try:
+                        expected = json.loads(text)
+                    except json.JSONDecodeError:
+                        continue
+                    if isinstance(expected, dict):
+                        messages.append((text, expected))
+    return {
+        "plain": messages,
+        "prose": [(f"Here is my answer: {text}\nLet me know {{if}} you agree.", expected) for text, expected in messages],
+        "two_objects": [(f"{text}\nThe previous offer was {{\"old\": 1}}.", expected) for text, expected in messages],
+        "fenced": [(f"Sure!\n```json\n{text}\n```\nNote: {{braces}} in text.", expected) for text, expected in messages],
+        "unclosed": [("{x " * 200 + text, expected) for text, expected in messages],
+    }
+
+
+def accuracy(extract, cases: list) -> float:
+    return sum(1 for text, expected in cases if extract(text) == expected) / len(cases) * 100
+
+
+def benchmarks() -> dict:
+    cases = responses()
+    results = {}
+    for shape, shapeCases in cases.items():
+        texts = [text for text, _ in shapeCases]
+        results[f"extract_json.{shape}.accuracy"] = lambda shapeCases=shapeCases: rate(
+            accuracy(Utilities.extract_json, shapeCases), "% correct"
+        )
+        results[f"extract_json.{shape}.greedy_accuracy"] = lambda shapeCases=shapeCases: rate(
+            accuracy(greedy, shapeCases), "% correct"
+        )
+        results[f"extract_json.{shape}.time"] = lambda texts=texts: bench(
+            lambda: [Utilities.extract_json(text) for text in texts], repeat=3
+        )
+        results[f"extract_json.{shape}.greedy_time"] = lambda texts=texts: bench(
+            lambda: [greedy(text) for text in texts], repeat=3
+        )
+    # A response made only of braces that are never closed: the time must grow linearly with the braces.
+    for braces in (2000, 16000):
+        results[f"extract_json.unclosed_{braces}.time"] = lambda braces=braces: bench(
+            lambda: Utilities.extract_json("{x " * braces), repeat=3
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = add_arguments(argparse.ArgumentParser(
+        description="Utilities.extract_json against the greedy regex, on the JSON messages of the stored sessions."
+    ))
+    sys.exit(main("extract_json", benchmarks(), parser.parse_args()))
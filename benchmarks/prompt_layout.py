@@ -0,0 +1,106 @@
+import argparse
+import importlib
+import sys
+import tempfile
+from pathlib import Path
+
+from common import ROOT, add_arguments, amount, main, rate
+
+import LLM as LLMs
+from Actor import Actor
+from Agent import Agent
+from Arena import Arena
+from ConfigRegistry import ConfigRegistry
+from LLM import LLM
+from MockLLM import MockLLM
+from Telemetry import Telemetry
+from Validator import Validator
+
+SCENARIO_FILE = str(ROOT / "DealingProblem" / "Context" / "Scenario1.json")
+CALLERS = (Telemetry.ACTOR, Telemetry.VALIDATOR)
+
+
+# A buyer and a seller of the scenario whose actor and validator use the client.
+def _arena(client: LLM, buyer: dict, seller: dict, savePath: str) -> Arena:
+    rules = ConfigRegistry.rules()
+    scenario = ConfigRegistry.scenario(SCENARIO_FILE)
+    arena = Arena([], scenario['scenario'], savePath, client)
+    for agent in (buyer, seller):
+        arena.loadAgents(Agent(Actor(ConfigRegistry.thaw(agent), client), Validator(rules[agent['role']], client=client), False))
+    return arena
+
+
+# It plays the sessions with the prompt layout, and returns the Telemetry records of the actor and validator calls.
+# The actors are streamed (see LLM.profile), so the time to the first token is measured for them too.
+def _play(client: LLM, layout: str, sessions: int, maxRounds: int) -> list:
+    client.set_layout(layout)
+    scenario = ConfigRegistry.scenario(SCENARIO_FILE)
+    pairings = [(buyer, seller) for buyer in scenario['buyers'] for seller in scenario['sellers']]
+    savePath = str(Path(tempfile.mkdtemp()) / "PromptLayout.json")
+    Telemetry.reset()
+    LLM.set_profile(Telemetry.ACTOR, maxTokens=512, stopAtJSON=True)
+    try:
+        for i in range(sessions):
+            _arena(client, *pairings[i % len(pairings)], savePath).negotiate(maxRounds=maxRounds, save=False)
+    finally:
+        LLM.remove_profile(Telemetry.ACTOR)
+    return [record for record in Telemetry.records() if record["caller"] in CALLERS and not record["cache_hit"]]
+
+
+# Time to first token, input tokens and billed input tokens per call of a layout. The cached input tokens
+# are billed at (1 - discount) of the price of the others, as the providers with prompt caching do.
+def layout(makeClient, name: str, sessions: int, maxRounds: int, discount: float) -> dict:
+    records = _play(makeClient(), name, sessions, maxRounds)
+    calls = len(records)
+    inputTokens = sum(record["input_tokens"] for record in records)
+    cachedTokens = sum(record["cached_tokens"] for record in records)
+    return {
+        f"prompt_layout.{name}.ttft": amount(sum(record["ttft"] for record in records) / calls, "s"),
+        f"prompt_layout.{name}.input_tokens": amount(inputTokens / calls, "tokens/call"),
+        f"prompt_layout.{name}.cached_share": rate(cachedTokens / max(1, inputTokens) * 100, "% cached"),
+        f"prompt_layout.{name}.billed_input_tokens": amount(
+            (inputTokens - cachedTokens * discount) / calls, "tokens/call"
+        ),
+    }
+
+
+# The metrics of a layout come from the same sessions, played once when the first of them is run.
+def benchmarks(makeClient, sessions: int, maxRounds: int, discount: float) -> dict:
+    results = {}
+    for name in LLM.LAYOUTS:
+        metrics = {}
+
+        def measure(metric: str, name=name, metrics=metrics) -> dict:
+            if not metrics:
+                metrics.update(layout(makeClient, name, sessions, maxRounds, discount))
+            return metrics[metric]
+        for metric in ("ttft", "input_tokens", "cached_share", "billed_input_tokens"):
+            key = f"prompt_layout.{name}.{metric}"
+            results[key] = lambda key=key, measure=measure: measure(key)
+    return results
+
+
+if __name__ == "__main__":
+    parser = add_arguments(argparse.ArgumentParser(
+        description="Time to first token and billed input tokens of the suffix and prefix prompt layouts."
+    ))
+    parser.add_argument("--sessions", type=int, default=6)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--discount", type=float, default=0.5, help="discount of the cached input tokens")
+    parser.add_argument("--latency", type=float, default=0.02, help="mock latency of a call, in seconds")
+    parser.add_argument("--prefill", type=float, default=0.0002, help="mock time to read an input token, in seconds")
+    parser.add_argument("--client", help="LLM class to benchmark instead of the MockLLM, e.g. LLamaLLM")
+    parser.add_argument("--model", default=None)
+    args = parser.parse_args()
+
+    if args.client is None:
+        def makeClient():
+            MockLLM.configure(latency={"distribution": "constant", "value": args.latency}, prefixCache=True,
+                              prefillLatency=args.prefill)
+            return MockLLM(args.model)
+    else:
+        llm = getattr(LLMs, args.client, None) or getattr(importlib.import_module(args.client), args.client)
+
+        def makeClient():
+            return llm(args.model)
+    sys.exit(main("prompt_layout", benchmarks(makeClient, args.sessions, args.rounds, args.discount), args))
@@ -0,0 +1,72 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from common import ROOT, add_arguments, amount, cpu, main
+
+# The entry points of the project: the modules imported by the notebooks and the scripts.
+ENTRY_POINTS = ["LLM", "Utilities", "Agent", "DeceptiveSeller", "Arena", "Tournament", "EvaluationPipeline"]
+
+# Each import is measured in a fresh interpreter, since the modules are cached after the first import.
+# The child prints the import time and the growth of its max resident set size (RSS).
+_PROBE = """
+import json, resource, sys, time
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{"import_seconds": elapsed, "rss_mb": after / 1024, "rss_delta_mb": (after - before) / 1024,
+                  "heavy_modules": sorted(m for m in ("spacy", "google.genai", "groq") if m in sys.modules)}}))
+"""
+
+
+# It measures the import time and memory of an entry point, as the best of repeat runs.
+def measure(module: str, repeat: int = 3) -> dict:
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(module=module)],
+            cwd=ROOT, capture_output=True, text=True, env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"}
+        )
+        if output.returncode != 0:
+            return {"error": output.stderr.strip().splitlines()[-1]}
+        runs.append(json.loads(output.stdout))
+    best = min(runs, key=lambda run: run["import_seconds"])
+    best["import_seconds"] = round(best["import_seconds"], 4)
+    best["rss_mb"] = round(best["rss_mb"], 1)
+    best["rss_delta_mb"] = round(best["rss_delta_mb"], 1)
+    return best
+
+
+# The metrics of an entry point: import time, max resident memory and heavy modules (spaCy and the provider SDKs)
+# imported with it. They come from the same runs, made once when the first of them is run.
+def benchmarks(repeat: int) -> dict:
+    results = {}
+    for module in ENTRY_POINTS:
+        runs = {}
+
+        def metric(key: str, module=module, runs=runs) -> dict:
+            if not runs:
+                runs.update(measure(module, repeat))
+            if "error" in runs:
+                raise RuntimeError(runs["error"])
+            if key == "import_seconds":
+                return cpu(amount(runs[key], "s"))
+            if key == "rss_mb":
+                return amount(runs[key], "MB")
+            return amount(len(runs[key]), "modules")
+        for key in ("import_seconds", "rss_mb", "heavy_modules"):
+            results[f"startup.{module}.{key}"] = lambda key=key, metric=metric: metric(key)
+    return results
+
+
+if __name__ == "__main__":
+    parser = add_arguments(argparse.ArgumentParser(description="Measure import time and memory of the entry points."))
+    parser.add_argument("--repeat", type=int, default=5)
+    # The import times depend on the file system cache too: only large slowdowns are regressions
+    parser.set_defaults(tolerance=0.5)
+    args = parser.parse_args()
+    sys.exit(main("startup", benchmarks(args.repeat), args))
@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from common import ROOT, add_arguments, cpu, main, rate
+
+from Actor import Actor
+from Agent import Agent
+from Arena import Arena
+from ConfigRegistry import ConfigRegistry
+from MockLLM import MockLLM
+from Validator import Validator
+
+SCENARIO_FILE = str(ROOT / "DealingProblem" / "Context" / "Scenario1.json")
+
+
+# A buyer and a seller of the scenario whose actor, validator and evaluator all use the MockLLM,
+# so that no call leaves the process.
+def _arena(buyer: dict, seller: dict, savePath: str) -> Arena:
+    rules = ConfigRegistry.rules()
+    scenario = ConfigRegistry.scenario(SCENARIO_FILE)
+    agents = [
+        Agent(Actor(ConfigRegistry.thaw(agent), MockLLM), Validator(rules[agent['role']], client=MockLLM), False)
+        for agent in (buyer, seller)
+    ]
+    arena = Arena([], scenario['scenario'], savePath, MockLLM)
+    for agent in agents:
+        arena.loadAgents(agent)
+    return arena
+
+
+def _pairings(sessions: int) -> list:
+    scenario = ConfigRegistry.scenario(SCENARIO_FILE)
+    pairings = [(buyer, seller) for buyer in scenario['buyers'] for seller in scenario['sellers']]
+    return [pairings[i % len(pairings)] for i in range(sessions)]
+
+
+def _play(pairing, savePath: str, maxRounds: int) -> dict:
+    arena = _arena(*pairing, savePath)
+    arena.negotiate(maxRounds=maxRounds, save=False)
+    return arena.build_session()
+
+
+async def _aplay(pairing, savePath: str, maxRounds: int) -> dict:
+    arena = _arena(*pairing, savePath)
+    await arena.anegotiate(maxRounds=maxRounds, save=False)
+    return await arena.abuild_session()
+
+
+# Sessions per minute of Arena.negotiate (with the evaluation), one session at a time or concurrently
+# on threads or on the event loop, with a mock latency per call.
+def throughput(mode: str, sessions: int, workers: int, latency: float, maxRounds: int) -> dict:
+    MockLLM.configure(latency={"distribution": "constant", "value": latency})
+    savePath = str(Path(tempfile.mkdtemp()) / "Throughput.json")
+    pairings = _pairings(sessions)
+
+    start = time.perf_counter()
+    if mode == "serial":
+        for pairing in pairings:
+            _play(pairing, savePath, maxRounds)
+    elif mode == "threads":
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda pairing: _play(pairing, savePath, maxRounds), pairings))
+    else:
+        async def run():
+            semaphore = asyncio.Semaphore(workers)
+
+            async def play(pairing):
+                async with semaphore:
+                    return await _aplay(pairing, savePath, maxRounds)
+            await asyncio.gather(*(play(pairing) for pairing in pairings))
+        asyncio.run(run())
+    elapsed = time.perf_counter() - start
+    # Without latency the sessions are CPU bound (see common.cpu)
+    metric = rate(sessions / elapsed * 60, "sessions/min")
+    return cpu(metric) if latency == 0 else metric
+
+
+def benchmarks(sessions: int, workers: int, latency: float, maxRounds: int) -> dict:
+    return {
+        "negotiate.serial_no_latency": lambda: throughput("serial", sessions, 1, 0.0, maxRounds),
+        f"negotiate.serial_{latency}s": lambda: throughput("serial", max(1, sessions // workers), 1, latency, maxRounds),
+        f"negotiate.threads_{workers}_{latency}s": lambda: throughput("threads", sessions, workers, latency, maxRounds),
+        f"negotiate.async_{workers}_{latency}s": lambda: throughput("async", sessions, workers, latency, maxRounds),
+    }
+
+
+if __name__ == "__main__":
+    parser = add_arguments(argparse.ArgumentParser(description="Session throughput of Arena.negotiate with the MockLLM."))
+    parser.add_argument("--sessions", type=int, default=36)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="mock latency of a call, in seconds")
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+    sys.exit(main("throughput", benchmarks(args.sessions, args.workers, args.latency, args.rounds), args))
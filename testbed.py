@@ -3,7 +3,6 @@ from Arena import Arena
 from Agent import Agent
 from DeceptiveSeller import DeceptiveSeller
 from LLM import GemmaLLM, LLamaLLM
-from openai import OpenAI
 
 LLamaLLM.set_model("llama-3.3-70b-versatile")
 
@@ -29,4 +28,5 @@ arena = Arena.load_session(
     "DealingProblem/TEST/TEST.json"
 )
 
-arena.negotiate(maxRounds=10)
\ No newline at end of file
+arena.negotiate(maxRounds=10)
+Arena.export_history("DealingProblem/TEST/TEST.json")
\ No newline at end of file
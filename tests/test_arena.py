@@ -0,0 +1,31 @@
+from ConfigRegistry import ConfigRegistry
+from MockLLM import MockLLM
+from TerminationPolicy import TerminationPolicy
+from Tournament import Tournament
+
+SCENARIO_FILE = "DealingProblem/Context/Scenario1.json"
+
+
+# It stops every negotiation after its first round.
+class StopAfterFirstRound(TerminationPolicy):
+    def check(self, history, agents) -> str:
+        return "stop-after-first-round"
+
+
+def _arena(tmp_path):
+    scenario = ConfigRegistry.scenario(SCENARIO_FILE)
+    buyer, seller = scenario['buyers'][0]['name'], scenario['sellers'][0]['name']
+    return Tournament.buildArena(SCENARIO_FILE, MockLLM, buyer, seller, False, False, str(tmp_path / "Session.json"))
+
+
+def test_checkpoint_keeps_the_termination(tmp_path):
+    checkpoints = []
+    arena = _arena(tmp_path).set_checkpoint(lambda arena: checkpoints.append(arena.getState()))
+    arena.negotiate(maxRounds=5, save=False, terminationPolicy=StopAfterFirstRound())
+    assert checkpoints[-1]["termination"]["reason"] == "stop-after-first-round"
+
+    # A crash after the termination and before the save: the restored negotiation isn't played again.
+    restored = _arena(tmp_path).restore(checkpoints[-1])
+    restored.negotiate(maxRounds=5, save=False)
+    assert restored.getHistory() == arena.getHistory()
+    assert restored.getTermination() == arena.getTermination()
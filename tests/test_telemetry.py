@@ -0,0 +1,37 @@
+from LLM import LLM
+from Telemetry import Telemetry
+
+
+# A stream whose last chunk carries the token usage, as the providers send it.
+def _stream():
+    yield {"text": '{"Result": "DEAL", '}
+    yield {"text": '"Reason": "the offers match"}'}
+    yield {"text": " and some more text"}
+    yield {"usage": (100, 0, 20)}
+
+
+def _record(stream):
+    Telemetry.reset()
+    messages = [{"role": "user", "content": "x" * 400}]
+    with Telemetry.caller(Telemetry.VALIDATOR), Telemetry.trace("model", messages):
+        response = LLM._collect(
+            stream, lambda chunk: chunk.get("text"),
+            lambda chunk: Telemetry.usage(*chunk["usage"]) if "usage" in chunk else None
+        )
+    return response, Telemetry.records()[-1]
+
+
+def test_stopped_stream_estimates_its_usage():
+    response, record = _record(_stream())
+    assert response == '{"Result": "DEAL", "Reason": "the offers match"}'
+    # The usage chunk is never read: both the input and the output tokens are estimated.
+    assert record["stopped_early"]
+    assert record["estimated_tokens"]
+    assert record["input_tokens"] == -(-record["prompt_chars"] // Telemetry.CHARS_PER_TOKEN)
+    assert record["output_tokens"] == -(-len(response) // Telemetry.CHARS_PER_TOKEN)
+
+
+def test_reported_usage_is_not_estimated():
+    response, record = _record(iter([{"text": "no JSON here"}, {"usage": (100, 0, 20)}]))
+    assert not record["estimated_tokens"]
+    assert (record["input_tokens"], record["output_tokens"]) == (100, 20)
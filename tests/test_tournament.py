@@ -0,0 +1,42 @@
+import asyncio
+
+import pytest
+
+from LLM import GemmaLLM, LLamaLLM
+from MockLLM import MockLLM
+from SessionStore import SessionStore
+from Tournament import Tournament
+
+SCENARIO_FILE = "DealingProblem/Context/Scenario3.json"
+
+
+# Any call to the remote LLMs (which read API_KEY.json) fails the test at once, without the retries.
+@pytest.fixture
+def offline(monkeypatch):
+    def remote(*args, **kwargs):
+        raise AssertionError("remote LLM call in an offline tournament")
+    for llm in (LLamaLLM, GemmaLLM):
+        for name in ("generate", "agenerate"):
+            monkeypatch.setattr(llm, name, remote)
+
+
+def test_mock_tournament_is_offline(offline, tmp_path):
+    savePath = str(tmp_path / "Session3_NA.json")
+    tournament = Tournament(SCENARIO_FILE, MockLLM, savePath, maxConcurrency=4, maxRounds=3, evaluator=MockLLM)
+    result = tournament.run()
+
+    assert result["failed"] == []
+    assert result["completed"] == len(tournament.pairings())
+    sessions = SessionStore.open(savePath).sessions()
+    assert len(sessions) == len(tournament.pairings())
+    assert all(session["evaluation"] for session in sessions)
+
+
+def test_mock_tournament_is_offline_async(offline, tmp_path):
+    savePath = str(tmp_path / "Session3_JSA.json")
+    tournament = Tournament(SCENARIO_FILE, MockLLM, savePath, maxConcurrency=4, isJSON=True, maxRounds=3,
+                            evaluator=MockLLM)
+    result = asyncio.run(tournament.arun())
+
+    assert result["failed"] == []
+    assert len(SessionStore.open(savePath)) == len(tournament.pairings())
@@ -0,0 +1,52 @@
+import json
+
+from ConfigRegistry import ConfigRegistry
+from MockLLM import MockLLM
+from Validator import Validator
+
+
+# A validator LLM that formats every response as a plain message, and counts its calls.
+class FormatterLLM(MockLLM):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def generate(self, messages):
+        self.calls += 1
+        return json.dumps({"MessageType": "message", "content": messages[-1]["content"]})
+
+
+def _history(*messages):
+    return [{"role": "seller", "text": "A TV is for sale at $600."}] + [
+        {"role": role, "text": f"{role}-agent : {text}"} for role, text in messages
+    ]
+
+
+def test_quoted_counteroffer_is_not_a_deal():
+    client = FormatterLLM()
+    validator = Validator(ConfigRegistry.thaw(ConfigRegistry.rules()["Seller"]), client=client)
+    history = _history(("buyer", "My counteroffer is $400."))
+    response = "Thank you for your counteroffer of $400, but I cannot go that low."
+
+    assert validator._formatLocally(history, response) is None
+    evaluation = validator.evaluateFormattedMessage(validator.formatResponse(history, response))
+    assert evaluation["MessageType"] != "DEAL"
+    assert client.calls == 1
+
+
+def test_quoted_counteroffer_is_not_read_as_the_other_offer():
+    validator = Validator(ConfigRegistry.thaw(ConfigRegistry.rules()["Seller"]), client=FormatterLLM())
+    history = _history(("buyer", "Your counteroffer of $550 is too high. My counteroffer is $400."))
+
+    assert validator._formatLocally(history, "My counteroffer is $550.") is None
+
+
+def test_own_counteroffer_is_formatted_locally():
+    client = FormatterLLM()
+    validator = Validator(ConfigRegistry.thaw(ConfigRegistry.rules()["Seller"]), client=client)
+    history = _history(("buyer", "My counteroffer is $400."))
+
+    formatted = validator.formatResponse(history, "I can lower the price. My counteroffer is $550.")
+    assert formatted == {"MessageType": "counter-offer", "buyer": "400", "seller": "550"}
+    assert validator.evaluateFormattedMessage(formatted)["MessageType"] == "VALID"
+    assert client.calls == 0